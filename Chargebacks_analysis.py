@@ -8,22 +8,23 @@ Created on Mon Jul 22 13:47:46 2019
 from ...globals import COLNAMES_PE, COLNAMES_CHARGEBACK
 import pandas as pd
 from os.path import join, dirname
-import pickle
 import inspect
 from wepair.plugins.plugin import Plugin
-import plotly.graph_objs as go
-from reportlab.platypus import Paragraph, Table, Image
-from reportlab.lib import colors
-from ...utils.report import Report
-import plotly.io as pio
+from .render_service import RenderService
+from .result_bus import ResultBus
+from .plugin_hooks import instrument_plugin
 from wepair.utils_common.log import Log
+from .lazy_import import lazy_module, lazy_names
+
+# rendering libraries, imported on first use in plot() / report() (see lazy_import)
+go = lazy_module('plotly.graph_objs')
+Paragraph, Table, Image = lazy_names('reportlab.platypus', 'Paragraph', 'Table', 'Image')
+colors = lazy_module('reportlab.lib.colors')
+Report = lazy_names('...utils.report', 'Report', package=__package__)
 
 # log
 logger = Log(__name__).get_logger()
 
-# orca config
-pio.orca.config.use_xvfb = 'auto'
-
 # Constants: define the column names
 TRANSACTION_DATE = COLNAMES_PE['Transaction Creation Date and Time']
 AMOUNT_IN_EUR = COLNAMES_PE['Amount in EUR']
@@ -52,15 +53,15 @@ class ChargebacksAnalysis(Plugin):
             #####################################################################################
             # Creating  Overview Pie Chart
             #####################################################################################
-            data[data_source + '_pie_reasons'] = list(map(lambda x: str(x)[:35] + '...' if len(str(x)) > 35 else str(x),
-                                                          data[data_source + '_pie_reasons']))
+            pie_reasons = list(map(lambda x: str(x)[:35] + '...' if len(str(x)) > 35 else str(x),
+                                   data[data_source + '_pie_reasons']))
 
             if data_source=='VISA':
                 fig = {
                     "data": [
                         {
                             "values": data[data_source + '_pie_n_chargebacks'],
-                            "labels": data[data_source + '_pie_reasons'],
+                            "labels": pie_reasons,
                             "name": "Chargebacks Overview",
                             "sort": True,
                             "hole": .75,
@@ -114,7 +115,7 @@ class ChargebacksAnalysis(Plugin):
                     "data": [
                         {
                             "values": data[data_source + '_pie_n_chargebacks'],
-                            "labels": data[data_source + '_pie_reasons'],
+                            "labels": pie_reasons,
                             "name": "Chargebacks Overview",
                             "sort": True,
                             "hole": .75,
@@ -158,7 +159,7 @@ class ChargebacksAnalysis(Plugin):
                         }
                     }
                 }
-            pio.write_image(fig, join(self.plot_output_folder, output_png_filename), scale=2)
+            RenderService.write_image(fig, join(self.plot_output_folder, output_png_filename), scale=2)
 
     def plot_chargebacks_monthly_analysis_overview(self, data, cmap):
         for data_source in ['VISA', 'MASTERCARD']:
@@ -225,7 +226,7 @@ class ChargebacksAnalysis(Plugin):
                 }
             )
             fig = go.Figure(data=traces, layout=layout)
-            pio.write_image(fig,  output_png_filename, scale=2)
+            RenderService.write_image(fig,  output_png_filename, scale=2)
 
     def plot_number_chargebacks_per_month(self, data, cmap):
 
@@ -307,7 +308,7 @@ class ChargebacksAnalysis(Plugin):
                 "width": 1000
             }
         }
-        pio.write_image(fig, output_png_filename, format='png', scale=4)
+        RenderService.write_image(fig, output_png_filename, format='png', scale=4)
 
     def plot_amount_chargebacks_per_month(self, data, cmap):
 
@@ -392,7 +393,7 @@ class ChargebacksAnalysis(Plugin):
             }
         }
 
-        pio.write_image(fig, output_png_filename, format='png', scale=4)
+        RenderService.write_image(fig, output_png_filename, format='png', scale=4)
 
     def plot_ratio_chargebacks_per_month(self, data, cmap):
 
@@ -475,12 +476,13 @@ class ChargebacksAnalysis(Plugin):
                 "width": 1000
             }
         }
-        pio.write_image(fig, output_png_filename, format='png', scale=4)
+        RenderService.write_image(fig, output_png_filename, format='png', scale=4)
 
     def __init__(self, plugin_folder, id, options=None):
         self.plugin_name = "Chargebacks Analysis"
         super().__init__(plugin_folder, id, options)
         self.required_input_data = ['tx.pickle', 'tx_chbck.pickle']
+        instrument_plugin(self)
 
     def process(self, *args, **kwargs):
 
@@ -507,7 +509,7 @@ class ChargebacksAnalysis(Plugin):
         # Check that all the required columns are present
         necessary_keys = [CB_DATE, CB_CURRENCY, CB_AMOUNT, CB_DISPUTE_STATUS, CB_CASE_STATUS, CB_REASON, CB_CARD_BRAND,
                           CB_SHOP_SHORT_NAME]
-                if not all(key in chargeback_transactions.columns for key in necessary_keys):
+        if not all(key in chargeback_transactions.columns for key in necessary_keys):
             logger.warning('{fct_name}: necessary keys are missing: {keys}'
                             .format(fct_name=inspect.stack()[0][3],
                                     keys=[key for key in necessary_keys if key not in chargeback_transactions.columns]))
@@ -526,12 +528,13 @@ class ChargebacksAnalysis(Plugin):
                                   n=len(chargeback_transactions[chargeback_transactions
                                         .duplicated(subset=CB_TRANSACTION_REF_ID,
                                                     keep='first')])))
-            chargeback_transactions.drop_duplicates(subset=CB_TRANSACTION_REF_ID, keep='first', inplace=True)
+            chargeback_transactions = chargeback_transactions.drop_duplicates(subset=CB_TRANSACTION_REF_ID,
+                                                                              keep='first')
 
         # For VISA
 
-        chargebacks_visa = chargeback_transactions[chargeback_transactions[CB_CARD_BRAND] == 'Visa'][
-            [CB_DATE, CB_AMOUNT]].copy()
+        chargebacks_visa = chargeback_transactions.loc[chargeback_transactions[CB_CARD_BRAND] == 'Visa',
+                                                       [CB_DATE, CB_AMOUNT]]
 
         # chargebacks_visa.sort_values(CB_DATE, ascending=True, inplace=True)
 
@@ -541,8 +544,8 @@ class ChargebacksAnalysis(Plugin):
         })
 
         # For MasterCard
-        chargebacks_mc = chargeback_transactions[chargeback_transactions[CB_CARD_BRAND] == 'Master Card'][
-            [CB_DATE, CB_AMOUNT]].copy()
+        chargebacks_mc = chargeback_transactions.loc[chargeback_transactions[CB_CARD_BRAND] == 'Master Card',
+                                                     [CB_DATE, CB_AMOUNT]]
 
         key_indicators.update({
             'MASTERCARD_n_chargebacks': len(chargebacks_mc),
@@ -569,8 +572,8 @@ class ChargebacksAnalysis(Plugin):
             .reset_index(drop=False)
         txs_visa.columns = [TRANSACTION_DATE, 'amt_txs', 'n_txs']
 
-        chargebacks_visa = chargeback_transactions[chargeback_transactions[CB_CARD_BRAND] == 'Visa'][
-            [CB_REASON, CB_DATE, CB_AMOUNT]].copy()
+        chargebacks_visa = chargeback_transactions.loc[chargeback_transactions[CB_CARD_BRAND] == 'Visa',
+                                                       [CB_REASON, CB_DATE, CB_AMOUNT]]
 
         # Remove the missing reasons
         chargebacks_visa = chargebacks_visa[chargebacks_visa[CB_REASON] != 'nan'].reset_index(drop=True)
@@ -590,9 +593,9 @@ class ChargebacksAnalysis(Plugin):
         for idx, reason in enumerate(['all'] + visa_reasons):
             key_indicators['VISA_series'][idx] = {'reason': reason}
             if reason != 'all':
-                txs = chargebacks_visa[chargebacks_visa[CB_REASON] == reason][[CB_DATE, CB_AMOUNT]].copy()
+                txs = chargebacks_visa.loc[chargebacks_visa[CB_REASON] == reason, [CB_DATE, CB_AMOUNT]]
             else:
-                txs = chargebacks_visa[[CB_DATE, CB_AMOUNT]].copy()
+                txs = chargebacks_visa[[CB_DATE, CB_AMOUNT]]
             txs = txs.resample('M', on=CB_DATE).agg([sum, 'size']).reset_index(drop=False)
             txs.columns = [CB_DATE, 'amt_chargebacks', 'n_chargebacks']
             txs = pd.merge(txs_visa, txs, left_on=TRANSACTION_DATE, right_on=CB_DATE, how='left')
@@ -617,8 +620,8 @@ class ChargebacksAnalysis(Plugin):
             .reset_index(drop=False)
         txs_mc.columns = [TRANSACTION_DATE, 'amt_txs', 'n_txs']
 
-        chargebacks_mc = chargeback_transactions[chargeback_transactions[CB_CARD_BRAND] == 'Master Card'][
-            [CB_REASON, CB_DATE, CB_AMOUNT]].copy()
+        chargebacks_mc = chargeback_transactions.loc[chargeback_transactions[CB_CARD_BRAND] == 'Master Card',
+                                                     [CB_REASON, CB_DATE, CB_AMOUNT]]
 
         # Remove the missing reasons
         chargebacks_mc = chargebacks_mc[chargebacks_mc[CB_REASON] != 'nan'].reset_index(drop=True)
@@ -638,9 +641,9 @@ class ChargebacksAnalysis(Plugin):
         for idx, reason in enumerate(['all'] + mc_reasons):
             key_indicators['MASTERCARD_series'][idx] = {'reason': reason}
             if reason != 'all':
-                txs = chargebacks_mc[chargebacks_mc[CB_REASON] == reason][[CB_DATE, CB_AMOUNT]].copy()
+                txs = chargebacks_mc.loc[chargebacks_mc[CB_REASON] == reason, [CB_DATE, CB_AMOUNT]]
             else:
-                txs = chargebacks_mc[[CB_DATE, CB_AMOUNT]].copy()
+                txs = chargebacks_mc[[CB_DATE, CB_AMOUNT]]
 
             if len(txs) > 0:
                 txs = txs.resample('M', on=CB_DATE).agg([sum, 'size']).reset_index(drop=False)
@@ -663,8 +666,8 @@ class ChargebacksAnalysis(Plugin):
         # Compute Pie Chart for VISA
         # --------------------------------------------------------------------
 
-        chargebacks_visa = chargeback_transactions[chargeback_transactions[CB_CARD_BRAND] == 'Visa'][
-            [CB_REASON, CB_AMOUNT]].copy()
+        chargebacks_visa = chargeback_transactions.loc[chargeback_transactions[CB_CARD_BRAND] == 'Visa',
+                                                       [CB_REASON, CB_AMOUNT]]
 
         # Remove the missing reasons
         chargebacks_visa = chargebacks_visa[chargebacks_visa[CB_REASON] != 'nan'].reset_index(drop=True)
@@ -685,8 +688,8 @@ class ChargebacksAnalysis(Plugin):
         # Compute Pie Chart for Master Card
         # --------------------------------------------------------------------
 
-        chargebacks_mc = chargeback_transactions[chargeback_transactions[CB_CARD_BRAND] == 'Master Card'][
-            [CB_REASON, CB_AMOUNT]].copy()
+        chargebacks_mc = chargeback_transactions.loc[chargeback_transactions[CB_CARD_BRAND] == 'Master Card',
+                                                     [CB_REASON, CB_AMOUNT]]
 
         # Remove the missing reasons
         chargebacks_mc = chargebacks_mc[chargebacks_mc[CB_REASON] != 'nan'].reset_index(drop=True)
@@ -703,28 +706,21 @@ class ChargebacksAnalysis(Plugin):
             'MASTERCARD_pie_reasons': chargebacks_mc[CB_REASON].tolist()
         })
 
-        process_output_file = join(self.process_output_folder, 'out.pickle')
-
-        with open(process_output_file, "wb") as pickle_out:
-            pickle.dump(key_indicators, pickle_out, protocol=pickle.HIGHEST_PROTOCOL)
+        ResultBus.publish(self.process_output_folder, key_indicators)
 
         return key_indicators
 #args are used because below list of self.plot...etc...can be extended easily
     def plot(self, *args, **kwargs):
-        input_data_file = join(self.process_output_folder, 'out.pickle')
-        with open(input_data_file, 'rb') as handle:
-            data = pickle.load(handle)
+        data = ResultBus.load(self.process_output_folder)
         self.plot_chargebacks_overview(data, kwargs['cmap'])
         self.plot_chargebacks_monthly_analysis_overview(data, kwargs['cmap'])
         self.plot_number_chargebacks_per_month(data, kwargs['cmap'])
         self.plot_amount_chargebacks_per_month(data, kwargs['cmap'])
         self.plot_ratio_chargebacks_per_month(data,kwargs['cmap'])
+        RenderService.flush()
 
     def report(self, report, styles, *args, **kwargs):
-        input_data_file = join(self.process_output_folder, 'out.pickle')
-
-        with open(input_data_file, 'rb') as handle:
-            data = pickle.load(handle)
+        data = ResultBus.load(self.process_output_folder)
 
         Report.draw_text_right(report, 'CHARGEBACK ANALYSIS', styles['Heading2-White'])
 
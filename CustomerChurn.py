@@ -2,25 +2,30 @@
 #importing libraries for the module 
 from wepair.plugins.plugin import Plugin
 from wepair.globals import COLNAMES_PE
-import pandas as pd
+import numpy as np
 import inspect
 from os.path import join
-import pickle
-from reportlab.platypus import Paragraph, Spacer, Image, Table, PageBreak
 from datetime import *
-from reportlab.lib import colors
-from ...utils.location import Location
+from .country_lookup import CountryLookup
 from ...utils.customer_tools import Feature, identify_customers, add_feature
-import plotly.io as pio
-import plotly.graph_objs as go
+from .render_service import RenderService
 from wepair.utils_common.log import Log
+from .profiling import Profiler
+from .customer_activity import churn_counts
+from .date_tools import granularity_option, period_codes, period_keys
+from .result_bus import ResultBus
+from .plugin_hooks import instrument_plugin
+from .lazy_import import lazy_module, lazy_names
+
+# rendering libraries, imported on first use in plot() / report() (see lazy_import)
+Paragraph, Spacer, Image, Table, PageBreak = lazy_names('reportlab.platypus', 'Paragraph', 'Spacer', 'Image', 'Table',
+                                                         'PageBreak')
+colors = lazy_module('reportlab.lib.colors')
+go = lazy_module('plotly.graph_objs')
 
 # log
 logger = Log(__name__).get_logger()
 
-# orca config
-pio.orca.config.use_xvfb = 'auto'
-
 
 #creating a variables from the data frame
 TRANSACTION_DATE = COLNAMES_PE['Transaction Creation Date and Time']
@@ -38,6 +43,10 @@ MERCHANT_NAME = COLNAMES_PE['Merchant Short Name']
 SHOP_COUNTRY = COLNAMES_PE['Merchant Country']
 SHOP_COUNTRY_NAME = 'SHOP_COUNTRY_NAME'
 
+# Periods of the churn rates: from the period of CHURN_PERIOD_START to the one before CHURN_PERIOD_END
+CHURN_PERIOD_START = datetime(2017, 6, 1)
+CHURN_PERIOD_END = datetime(2018, 7, 1)
+
 
 class ChurnRate(Plugin):
 
@@ -45,6 +54,7 @@ class ChurnRate(Plugin):
         self.plugin_name = "Churn Rate"
         super().__init__(plugin_folder, id, options)
         self.required_input_data = ['tx.pickle', 'customers.pickle']
+        instrument_plugin(self)
 
 
 #The special syntax *args in function definitions in python is used to pass a variable number of arguments to a function. 
@@ -74,9 +84,10 @@ class ChurnRate(Plugin):
                 group_filter = MERCHANT_NAME
             elif self.options['filter'] == 'shop country name':
                 group_filter = SHOP_COUNTRY_NAME
-                location = Location(self.options['assets'])
-                transactions['country_code'] = transactions[SHOP_COUNTRY].apply(location.get_country_iso3)
-                transactions[SHOP_COUNTRY_NAME] = transactions[SHOP_COUNTRY].apply(location.get_country_name)
+                countries = CountryLookup.from_options(self.options)
+                transactions = transactions.copy(deep=False)
+                transactions['country_code'] = countries.iso3(transactions[SHOP_COUNTRY])
+                transactions[SHOP_COUNTRY_NAME] = countries.names(transactions[SHOP_COUNTRY])
             else:
                 logger.warning('unknown filter option')
 
@@ -97,6 +108,8 @@ class ChurnRate(Plugin):
 #A dictionary is a collection which is unordered, changeable and indexed
             
         churn_data = {'has_data': True, 'filter_values': dict()}
+        granularity = granularity_option(self.options)
+        churn_data['granularity'] = granularity
 
         # Group by the filter
         # create variable and pass the no filter value
@@ -116,42 +129,42 @@ class ChurnRate(Plugin):
 
             if len(txs) == 0:
                 continue
+
+            Profiler.mark('Churn for the filter value: {value}'.format(value=filter_value), rows=len(txs))
             customers, txs = identify_customers(txs)
             customers = add_feature(customers, txs, Feature.ALL, end_period=txs[TRANSACTION_DATE].max())
 
             # Extract the data of interest
             txs = txs[necessary_keys]
 
-            cust = customers[[CUSTOMER_ID, FIRST_TRANSACTION_DATE, LAST_TRANSACTION_DATE]].copy()
-            start = datetime.date(datetime(2017, 6, 1))
-            end = datetime.date(datetime(2018, 7, 1))
-            months = pd.date_range(start, end, freq='M')
-
-            churn_rates = list()
-            prev = start
-            for i, _ in enumerate(months):
-                if set(txs[txs[TRANSACTION_DATE] < months[i]][CUSTOMER_ID].unique()) & set(cust[cust[LAST_TRANSACTION_DATE] > months[i]][CUSTOMER_ID]):
-                    churn_rates.append(len(set(cust[(cust[LAST_TRANSACTION_DATE] <= months[i]) & (cust[LAST_TRANSACTION_DATE] > prev)][CUSTOMER_ID]) & set(cust[cust[FIRST_TRANSACTION_DATE] < prev][CUSTOMER_ID])) / len(set(txs[txs[TRANSACTION_DATE] < months[i]][CUSTOMER_ID].unique()) & set(cust[cust[LAST_TRANSACTION_DATE] > months[i]][CUSTOMER_ID])))
-                else:
-                    churn_rates.append(0)
-                prev = months[i]
+            cust = customers[[CUSTOMER_ID, FIRST_TRANSACTION_DATE, LAST_TRANSACTION_DATE]]
+            first_period = int(period_codes(CHURN_PERIOD_START, granularity))
+            n_periods = int(period_codes(CHURN_PERIOD_END, granularity)) - first_period
+
+            # churn rate of a period: customers whose last purchase is in the period (and the first one before it),
+            # over the customers who purchased in the period or before and purchase again after it
+            first_active_dates = txs.groupby(CUSTOMER_ID)[TRANSACTION_DATE].min().reindex(cust[CUSTOMER_ID])
+            n_churned, n_at_risk = churn_counts(period_codes(cust[FIRST_TRANSACTION_DATE], granularity),
+                                                period_codes(cust[LAST_TRANSACTION_DATE], granularity),
+                                                period_codes(first_active_dates, granularity),
+                                                first_period, n_periods)
+            churn_rates = np.where(n_at_risk > 0, n_churned / np.maximum(n_at_risk, 1), 0)
+
             churn_data['filter_values'][filter_idx] = dict()
             churn_data['filter_values'][filter_idx]["filter_value"] = filter_value
-            churn_data['filter_values'][filter_idx]['months'] = [str(m.month) + '-' + str(m.year) for m in months]
-            churn_data['filter_values'][filter_idx]['churn_rates'] = churn_rates
+            churn_data['filter_values'][filter_idx]['months'] = period_keys(
+                np.arange(first_period, first_period + n_periods), granularity)
+            churn_data['filter_values'][filter_idx]['churn_rates'] = churn_rates.tolist()
 
-        process_output_file = join(self.process_output_folder, 'out.pickle')
-        with open(process_output_file, "wb") as pickle_out:
-            pickle.dump(churn_data, pickle_out, protocol=pickle.HIGHEST_PROTOCOL)
+        Profiler.mark('Save the results')
+        ResultBus.publish(self.process_output_folder, churn_data)
 
         return churn_data
     
 #plotting the data to the output file
     def plot(self, *args, **kwargs):
 
-        input_data_file = join(self.process_output_folder, 'out.pickle')
-        with open(input_data_file, 'rb') as handle:
-            data = pickle.load(handle)
+        data = ResultBus.load(self.process_output_folder)
 
         mycolors = ['#000000', '#00FF00', '#0000FF', '#FF0000', '#01FFFE', '#FFA6FE', '#FFDB66', '#006401', '#010067',
                     '#95003A', '#007DB5', '#FF00F6', '#FFEEE8', '#774D00', '#90FB92', '#0076FF', '#D5FF00', '#FF937E',
@@ -196,16 +209,14 @@ class ChurnRate(Plugin):
         fig = dict(data=plot_data, layout=layout)
 
         output_png_filename = join(self.plot_output_folder, 'churn_rates.png')
-        pio.write_image(fig, output_png_filename, format='png', scale=4)
+        RenderService.write_image(fig, output_png_filename, format='png', scale=4)
+        RenderService.flush()
 
 
 #creating a report
     def report(self, report, styles, *args, **kwargs):
 
-        input_data_file = join(self.process_output_folder, 'out.pickle')
-
-        with open(input_data_file, 'rb') as handle:
-            data = pickle.load(handle)
+        data = ResultBus.load(self.process_output_folder)
 
         report.append(Paragraph('RETENTION COHORTS (Gross Sales)', style=styles['Heading2']))
         report.append(Paragraph('Retention rate of new customers', style=styles['Heading3-NightBlue']))
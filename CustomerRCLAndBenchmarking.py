@@ -8,20 +8,23 @@ Created on Mon Jul 22 15:06:32 2019
 from wepair.plugins.plugin import Plugin
 import pandas as pd
 import numpy as np
-from os.path import join
-import pickle
 from datetime import *
 from ...globals import COLNAMES_PE
-from lifetimes import BetaGeoFitter, GammaGammaFitter
-from sklearn import preprocessing
-from sklearn_pandas import DataFrameMapper
-from ...utils.location import Location
+from .clv_fitters import BetaGeoFitter, GammaGammaFitter
+from .country_lookup import CountryLookup
+from .customer_features import CustomerFeatureMatrix, feature_importances
 from ...utils.time_window import TimeWindow
-from ...utils.customer_tools import Feature, identify_customers, add_feature, flatten_column_values
-from reportlab.platypus import Paragraph, Spacer, Table
-from reportlab.lib import colors
+from ...utils.customer_tools import Feature, identify_customers, add_feature
 from wepair.utils_common.log import Log
-from ...utils.report import Report
+from .profiling import Profiler
+from .result_bus import ResultBus
+from .plugin_hooks import instrument_plugin
+from .lazy_import import lazy_module, lazy_names
+
+# rendering libraries, imported on first use in plot() / report() (see lazy_import)
+Paragraph, Spacer, Table = lazy_names('reportlab.platypus', 'Paragraph', 'Spacer', 'Table')
+colors = lazy_module('reportlab.lib.colors')
+Report = lazy_names('...utils.report', 'Report', package=__package__)
 
 # log
 logger = Log(__name__).get_logger()
@@ -60,45 +63,11 @@ class CustomerRCLandBenchmarking(Plugin):
 
     @staticmethod
     def get_customer_features(transactions):
-        # Normalize the set of features to be used in the analysis
-        mapping_list = [(['n_transactions'], preprocessing.StandardScaler()),
-                        (['monetary_value'], preprocessing.StandardScaler()),
-                        (['avg_n_days_between_purchases'], preprocessing.StandardScaler()),
-                        (['n_days_since_last_purchase'], preprocessing.StandardScaler()),
-                        ('is_periodic_buyer', None)]
-        if CARD_CATEGORY in transactions.columns:
-            for category in transactions[CARD_CATEGORY].unique():
-                if str(category).lower() != 'nan':
-                    mapping_list.append(([str(category).lower().replace(' ', '_')], preprocessing.StandardScaler()))
-        if CARD_BRAND in transactions.columns:
-            for brand in transactions[CARD_BRAND].unique():
-                if str(brand).lower() != 'nan':
-                    mapping_list.append(([str(brand).lower().replace(' ', '_')], preprocessing.StandardScaler()))
-        if PAYMENT_METHOD in transactions.columns:
-            for method in transactions[PAYMENT_METHOD].unique():
-                if str(method).lower() != 'nan':
-                    mapping_list.append(([str(method).lower().replace(' ', '_')], preprocessing.StandardScaler()))
-        weekdays = ['monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday']
-        for day in weekdays:
-            mapping_list.append((['weekday_' + day], preprocessing.StandardScaler()))
-        months = ['jan', 'feb', 'mar', 'apr', 'may', 'jun', 'jul', 'aug', 'sep', 'oct', 'nov', 'dec']
-        for month in months:
-            mapping_list.append((['transaction_date_month_' + month], preprocessing.StandardScaler()))
-        day_period = ['morning', 'noon', 'afternoon', 'evening', 'night']
-        for period in day_period:
-            mapping_list.append((['dayperiod_' + period], preprocessing.StandardScaler()))
-        # month_period = ['jun_jul', 'dec_jan', 'other']
-        # for period in month_period:
-        #    mapping_list.append((['month_period_' + period], preprocessing.StandardScaler()))
-        mapper = DataFrameMapper(mapping_list)
-        mapper_y = DataFrameMapper([('retention_status', preprocessing.LabelEncoder())])
-        list_features = []
-        for name in mapping_list:
-            if isinstance(name[0], list):
-                list_features.append(name[0][0])
-            else:
-                list_features.append(name[0])
-        return mapper, mapper_y, list_features
+        # Features of the customers: their numeric features and their number of purchases per card category, card
+        # brand, payment method, weekday, month and period of the day, as a sparse matrix (see customer_features)
+        feature_matrix = CustomerFeatureMatrix.from_transactions(
+            transactions, [CARD_CATEGORY, CARD_BRAND, PAYMENT_METHOD], CUSTOMER_ID, TRANSACTION_DATE)
+        return feature_matrix, feature_matrix.feature_names
 
     @staticmethod
     def get_elegant_feature_names(features):
@@ -171,43 +140,7 @@ class CustomerRCLandBenchmarking(Plugin):
         self.plugin_name = "Customer RCL and benchmarking"
         super().__init__(plugin_folder, id, options)
         self.required_input_data = ['tx.pickle']
-
-    @staticmethod
-    def get_weekdays(days):
-        if len(days) > 0:
-            return [d.weekday() for d in days]
-        else:
-            return []
-
-    @staticmethod
-    def get_list(items):
-        return list(items)
-
-    @staticmethod
-    def get_period_of_day(hour):
-        if 6 <= hour < 10:
-            return 0
-        elif 10 <= hour < 14:
-            return 1
-        elif 14 <= hour < 18:
-            return 2
-        elif 18 <= hour < 22:
-            return 3
-        else:
-            return 4
-
-    def get_period_of_days(self, days):
-        if len(days) > 0:
-            return [self.get_period_of_day(d.hour) for d in days]
-        else:
-            return []
-
-    @staticmethod
-    def get_month_of_year(dates):
-        if len(dates) > 0:
-            return [_date.month - 1 for _date in dates]
-        else:
-            return []
+        instrument_plugin(self)
 
     def process(self, *args, **kwargs):
 
@@ -250,7 +183,7 @@ class CustomerRCLandBenchmarking(Plugin):
                         'Fatal Error: Plugin Customer RCL: missing datetime property for absolte time window')
                     return results
 
-        location = Location(self.options['assets'])
+        countries = CountryLookup.from_options(self.options)
 
         if len(args) != 1:
             logger.warning('Fatal Error: Plugin Customer RCL: Transaction data Missing')
@@ -296,7 +229,7 @@ class CustomerRCLandBenchmarking(Plugin):
                 dtypes[col] = np.str
 
         # Extract and transform the required transactions for the computations
-        transactions = transactions[transactions[TRANSACTION_IS_CAPTURE]][list_columns].copy()
+        transactions = transactions.loc[transactions[TRANSACTION_IS_CAPTURE], list_columns]
 
         if group_filter == SHOP_COUNTRY:
             if SHOP_NAME in transactions.columns:
@@ -314,11 +247,10 @@ class CustomerRCLandBenchmarking(Plugin):
 
         if group_filter == SHOP_COUNTRY:
             # Sort the country code by alphabetical order of their name
-            _temp_filter_values = pd.Series(transactions[SHOP_COUNTRY].unique())\
-                .apply(location.get_country_name).tolist()
+            _temp_filter_values = countries.names(transactions[SHOP_COUNTRY].unique()).tolist()
             list_of_filter_values = [x
                                      for _, x in sorted(zip(_temp_filter_values, transactions[SHOP_COUNTRY].unique()))]
-            list_of_filter_labels = [location.get_country_name(country_code) for country_code in list_of_filter_values]
+            list_of_filter_labels = countries.names(list_of_filter_values).tolist()
             list_of_filter_values.append('ALL')
             list_of_filter_labels.append('All countries')
         else:
@@ -329,7 +261,7 @@ class CustomerRCLandBenchmarking(Plugin):
             list_of_filter_values.append('ALL')
             list_of_filter_labels.append('All ' + self.options['filter'] + 's')
 
-        mapper, mapper_y, list_features = self.get_customer_features(transactions)
+        feature_matrix, list_features = self.get_customer_features(transactions)
 
         # time_window_1_begin = pd.to_datetime(last_transaction_date - relativedelta(months=int(args[1])))
         # time_window_1_end = pd.to_datetime(last_transaction_date - relativedelta(months=int(args[2])))
@@ -422,6 +354,8 @@ class CustomerRCLandBenchmarking(Plugin):
                     txs = time_filtered_transactions[time_filtered_transactions[group_filter] == filter_value]
                 else:
                     txs = time_filtered_transactions
+                Profiler.mark('Time window {idx}, filter value: {value}'.format(idx=time_window_idx, value=filter_value),
+                              rows=len(txs))
                 n_transactions_in_the_country_this_month = len(txs[txs[TRANSACTION_DATE] >= time_window[0]])
                 per_filter_analysis['n_transactions'].append(n_transactions_in_the_country_this_month)
                 revenue_in_the_country_this_month = txs[txs[TRANSACTION_DATE] >= time_window[0]][AMOUNT_IN_EUR].sum()
@@ -535,64 +469,6 @@ class CustomerRCLandBenchmarking(Plugin):
 
                 per_filter_analysis['n_customers'].append(n_customers)
 
-                # -----------------------------------------------------------------------------------------------------
-                # Identify card categories and brand
-                # -----------------------------------------------------------------------------------------------------
-
-                temp = txs.groupby(CUSTOMER_ID).agg({
-                    CARD_CATEGORY: self.get_list,
-                    CARD_BRAND: self.get_list,
-                    PAYMENT_METHOD: self.get_list
-                })
-                temp.reset_index(inplace=True)
-                customers = pd.merge(customers, temp, on=CUSTOMER_ID, how='left')
-                del temp
-                customers = flatten_column_values(customers,
-                                                  CARD_CATEGORY,
-                                                  list_values=transactions[CARD_CATEGORY].unique())
-                customers = flatten_column_values(customers,
-                                                  CARD_BRAND,
-                                                  list_values=transactions[CARD_BRAND].unique())
-                customers = flatten_column_values(customers,
-                                                  PAYMENT_METHOD,
-                                                  list_values=transactions[PAYMENT_METHOD].unique())
-
-                # Flatten the transaction weekdays
-                temp = txs.groupby(CUSTOMER_ID).agg({TRANSACTION_DATE: self.get_weekdays})
-                temp.rename(columns={TRANSACTION_DATE: 'weekdays'}, inplace=True)
-                temp.reset_index(inplace=True)
-                customers = pd.merge(customers, temp, on=CUSTOMER_ID, how='left')
-                del temp
-                #count for each weekday
-                for i, day in enumerate(['monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday']):
-                    customers['weekday_' + day] = customers['weekdays'].apply(lambda days: days.count(i))
-                customers.drop('weekdays', axis=1, inplace=True)
-
-                # Flatten the transaction months
-                temp = txs.groupby(CUSTOMER_ID).agg({TRANSACTION_DATE: self.get_month_of_year})
-                temp.rename(columns={TRANSACTION_DATE: 'transaction_date_month'}, inplace=True)
-                temp.reset_index(inplace=True)
-                customers = pd.merge(customers, temp, on=CUSTOMER_ID, how='left')
-                del temp
-                for i, month in enumerate(['jan', 'feb', 'mar', 'apr', 'may', 'jun', 'jul',
-                                           'aug', 'sep', 'oct', 'nov', 'dec']):
-                    customers['transaction_date_month_' + month] = customers['transaction_date_month'].apply(
-                        lambda months: months.count(i))
-                customers.drop('transaction_date_month', axis=1, inplace=True)
-
-                # Flatten the transaction period of days
-
-                temp = txs.groupby(CUSTOMER_ID).agg({TRANSACTION_DATE: self.get_period_of_days})
-                temp.rename(columns={TRANSACTION_DATE: 'dayperiod'}, inplace=True)
-                temp.reset_index(inplace=True)
-                customers = pd.merge(customers, temp, on=CUSTOMER_ID, how='left')
-                del temp
-
-                for i, period in enumerate(['morning', 'noon', 'afternoon', 'evening', 'night']):
-                    customers['dayperiod_' + period] = customers['dayperiod'].apply(lambda days: days.count(i))
-                customers.drop('dayperiod', axis=1, inplace=True)
-
-
                 customers['is_periodic_buyer'] = None
                 if n_customers > 0:
                     customers['is_periodic_buyer'] = customers.apply(self.is_periodic_buyer, axis=1)
@@ -781,13 +657,26 @@ class CustomerRCLandBenchmarking(Plugin):
                 per_filter_analysis['total_spending_retained_customers'].append(
                     customers.loc[retained_cust, 'total_spending'].sum())
 
+                # -----------------------------------------------------------------------------------------------------
+                # Importance of the features for the retention status
+                # -----------------------------------------------------------------------------------------------------
+
+                features = feature_matrix.scale(feature_matrix.build(customers, txs))
+                importances, stds, accuracy = feature_importances(features, customers['retention_status'].values)
+                for feature, importance, std in sorted(zip(self.get_elegant_feature_names(list_features),
+                                                           importances, stds)):
+                    per_filter_analysis['feature_importances'][idx_filter_value]['name'].append(feature)
+                    per_filter_analysis['feature_importances'][idx_filter_value]['importance'].append(importance)
+                    per_filter_analysis['feature_importances'][idx_filter_value]['std'].append(std)
+                per_filter_analysis['decision_tree_filename'].append('')
+                per_filter_analysis['decision_tree_accuracy'].append(accuracy)
+
                 logger.debug("Finished RCL Process for"+str(filter_value))
 
             results['per_filter_analysis']['time_window_' + str(time_window_idx)] = per_filter_analysis
-        process_output_file = join(self.process_output_folder, 'out.pickle')
+        Profiler.mark('Save the results')
         logger.debug("Writing pickle")
-        with open(process_output_file, "wb") as pickle_out:
-            pickle.dump(results, pickle_out, protocol=pickle.HIGHEST_PROTOCOL)
+        ResultBus.publish(self.process_output_folder, results)
 
         return results
 
@@ -796,9 +685,7 @@ class CustomerRCLandBenchmarking(Plugin):
 
     def report(self, report, styles, *args, **kwargs):
 
-        input_data_file = join(self.process_output_folder, 'out.pickle')
-        with open(input_data_file, 'rb') as handle:
-            data = pickle.load(handle)
+        data = ResultBus.load(self.process_output_folder)
 
         data_list = list()
         for i in range(data['n_filter_values'] + 1):
@@ -10,26 +10,32 @@ import pandas as pd
 import numpy as np
 from dateutil.relativedelta import *
 from ...globals import COLNAMES_PE
-from ...utils.location import Location
+from .country_lookup import CountryLookup
 from ...utils.customer_tools import Feature, remove_all_features, add_feature
-from sklearn.cluster import MiniBatchKMeans
-from lifetimes import BetaGeoFitter, GammaGammaFitter
+from .clv_fitters import BetaGeoFitter, GammaGammaFitter
 from itertools import product
 from os.path import join, isfile
-import pickle
-from reportlab.platypus import Image, Table
-from ...utils.report import Report
-from reportlab.lib import colors
-import plotly.io as pio
-import plotly.graph_objs as go
+from .render_service import RenderService
 from wepair.utils_common.log import Log
+from .profiling import Profiler
+from .city_names import CityNames
+from .rfm_clustering import RFMClustering
+from .clv_bootstrap import CLVBootstrap
+from .date_tools import day_deltas, month_buckets, month_labels
+from .email_sidecar import EmailSidecar
+from .result_bus import ResultBus
+from .plugin_hooks import instrument_plugin
+from .lazy_import import lazy_module, lazy_names
+
+# rendering libraries, imported on first use in plot() / report() (see lazy_import)
+Image, Table = lazy_names('reportlab.platypus', 'Image', 'Table')
+Report = lazy_names('...utils.report', 'Report', package=__package__)
+colors = lazy_module('reportlab.lib.colors')
+go = lazy_module('plotly.graph_objs')
 
 # log
 logger = Log(__name__).get_logger()
 
-# orca config
-pio.orca.config.use_xvfb = 'auto'
-
 TRANSACTION_DATE = COLNAMES_PE['Transaction Creation Date and Time']
 AMOUNT_IN_EUR = COLNAMES_PE['Amount in EUR']
 CUSTOMER_NAME = COLNAMES_PE['Card Holder Name']
@@ -112,7 +118,7 @@ class CustomerRFM(Plugin):
 
             }
         }
-        pio.write_image(fig, filename, format='png')
+        RenderService.write_image(fig, filename, format='png')
 
     @staticmethod
     def _plot_clusters_evolution(data, clusters_evolution_filename, cmap):
@@ -178,7 +184,7 @@ class CustomerRFM(Plugin):
 
         )
         fig = go.Figure(data=traces, layout=layout)
-        pio.write_image(fig, clusters_evolution_filename, format='png')
+        RenderService.write_image(fig, clusters_evolution_filename, format='png')
 
     @staticmethod
     def _plot_clusters_per_country(data, clusters_per_country_filename, cmap):
@@ -239,7 +245,7 @@ class CustomerRFM(Plugin):
 
         )
         fig = go.Figure(data=traces, layout=layout)
-        pio.write_image(fig, clusters_per_country_filename, format='png', scale=2)
+        RenderService.write_image(fig, clusters_per_country_filename, format='png', scale=2)
         '''
         sns.set()
         sns.set_style("white")
@@ -263,13 +269,14 @@ class CustomerRFM(Plugin):
         self.plugin_name = "Customer rfm"
         super().__init__(plugin_folder, id, options)
         self.required_input_data = ['tx.pickle', 'customers.pickle']
+        instrument_plugin(self)
 
     def process(self, *args, **kwargs):
 
         customer_rfm = {'has_data': False}
         logger.debug(kwargs)
 
-        location = Location(self.options['assets'])
+        countries = CountryLookup.from_options(self.options)
 
         if len(args) != 2:
             logger.warning('Fatal Error: Data Input Source Missing')
@@ -288,6 +295,7 @@ class CustomerRFM(Plugin):
         # ------------------------------------------------------------------------------------------------------------------
         # Initialization
         # ------------------------------------------------------------------------------------------------------------------
+        Profiler.mark('Initialization', rows=len(transactions))
 
         list_columns = [TRANSACTION_DATE, AMOUNT_IN_EUR, CUSTOMER_ID, CUSTOMER_NAME, TRANSACTION_IS_RETURN,
                         TRANSACTION_IS_CAPTURE]
@@ -295,8 +303,8 @@ class CustomerRFM(Plugin):
             if col in transactions.columns:
                 list_columns.append(col)
 
-        txs = transactions[transactions[TRANSACTION_IS_CAPTURE]][list_columns].copy()
-        cust = customers.copy()
+        txs = transactions.loc[transactions[TRANSACTION_IS_CAPTURE], list_columns]
+        cust = customers.copy(deep=False)
 
         last_transaction_date = txs[TRANSACTION_DATE].max()
         one_year_ago = last_transaction_date - relativedelta(months=12)
@@ -308,6 +316,7 @@ class CustomerRFM(Plugin):
         # ------------------------------------------------------------------------------------------------------------------
         # Frequency, Monetary, and churn probability prediction
         # ------------------------------------------------------------------------------------------------------------------
+        Profiler.mark('Frequency, Monetary, and churn probability prediction', rows=len(cust))
 
         bgf = BetaGeoFitter(penalizer_coef=0.0)
 
@@ -336,6 +345,7 @@ class CustomerRFM(Plugin):
         # ------------------------------------------------------------------------------------------------------------------
         # Segmentation of last year cust
         # ------------------------------------------------------------------------------------------------------------------
+        Profiler.mark('Segmentation of last year cust', rows=len(txs))
 
         if txs[TRANSACTION_DATE].min() < one_year_ago:
             logger.info('Re-compute the features for the cust from last year')
@@ -352,24 +362,17 @@ class CustomerRFM(Plugin):
             transactions_last_year = txs
             customers_last_year = cust
 
-        customers_last_year['R'] = (customers_last_year['last_transaction_date'] - one_year_ago).apply(
-            lambda x: int(x.total_seconds() / (24.0 * 60 * 60)))
+        customers_last_year['R'] = day_deltas(customers_last_year['last_transaction_date'], one_year_ago)
         customers_last_year['F'] = customers_last_year['n_transactions']
         customers_last_year['M_sum'] = customers_last_year['total_spending']
         customers_last_year['M_avg'] = customers_last_year['avg_spending']
 
-        customers_last_year['norm_R'] = (customers_last_year['R']
-                                         - customers_last_year['R'].mean()) / customers_last_year['R'].std()
-        customers_last_year['norm_F'] = (customers_last_year['F']
-                                         - customers_last_year['F'].mean()) / customers_last_year['F'].std()
-        customers_last_year['norm_M_sum'] = (customers_last_year['M_sum']
-                                             - customers_last_year['M_sum'].mean()) / customers_last_year['M_sum'].std()
-
-        kmeans = MiniBatchKMeans(n_clusters=N_CLUSTERS, init='k-means++', max_iter=1000, tol=1e-6, n_init=10,
-                                 random_state=KMEANS_RANDOM_INITIAL_STATE, batch_size=1000, verbose=(not logger.root.level))
-        kmeans.fit(customers_last_year[['norm_R', 'norm_F', 'norm_M_sum']])
-        customers_last_year[CUSTOMER_RFM_SEGMENT] = kmeans.labels_
-        customers_last_year.drop(['norm_R', 'norm_F', 'norm_M_sum'], axis=1, inplace=True)
+        # full k-means on the re-clustering schedule only, partial_fit on the changed customers in between
+        clustering = RFMClustering.from_options(N_CLUSTERS, KMEANS_RANDOM_INITIAL_STATE, self.options,
+                                                verbose=(not logger.root.level))
+        customers_last_year[CUSTOMER_RFM_SEGMENT] = clustering.segments(
+            customers_last_year, last_transaction_date, CUSTOMER_ID,
+            ['last_transaction_date', 'n_transactions', 'total_spending'])
 
         # Saving the information about each segment
         customer_rfm['R_avg'] = customers_last_year.groupby(CUSTOMER_RFM_SEGMENT, sort=False).agg({'R': 'mean'})['R']
@@ -416,6 +419,18 @@ class CustomerRFM(Plugin):
         customer_rfm['predicted_pFM'] = customer_rfm['predicted_p_alive'] * customer_rfm['predicted_F'] * \
             customer_rfm['predicted_M_avg'] * customer_rfm['customer_count']
 
+        # uncertainty bands of the segment predictions: bootstrap refits of both models, within the time budget
+        bootstrap = CLVBootstrap.from_options(self.options, seed=KMEANS_RANDOM_INITIAL_STATE)
+        if bootstrap.enabled:
+            Profiler.mark('Bootstrap intervals of the predictions', rows=len(cust))
+            customer_segments = cust[CUSTOMER_ID].map(
+                customers_last_year.drop_duplicates(CUSTOMER_ID).set_index(CUSTOMER_ID)[CUSTOMER_RFM_SEGMENT])
+            intervals = bootstrap.intervals(cust, customer_segments.fillna(-1).astype(int).values, N_CLUSTERS,
+                                            CHURN_T_HORIZON, bgf, ggf)
+            customer_rfm = customer_rfm.join(intervals)
+            logger.info('{n} of {total} bootstrap replicates in {seconds:.1f}s'.format(
+                n=bootstrap.n_completed, total=bootstrap.n_replicates, seconds=bootstrap.elapsed))
+
         # predicting future txs, p_alive and future monetary value for customer_rfm persona
         customer_rfm['predicted_F_persona'] = customer_rfm.apply(
             lambda r: bgf.conditional_expected_number_of_purchases_up_to_time(CHURN_T_HORIZON,
@@ -445,12 +460,13 @@ class CustomerRFM(Plugin):
         # ------------------------------------------------------------------------------------------------------------------
         # Analyze the evolution of the customer_rfm
         # ------------------------------------------------------------------------------------------------------------------
+        Profiler.mark('Analyze the evolution of the customer_rfm')
 
         transactions_last_year = pd.merge(transactions_last_year,
                                           customers_last_year[[CUSTOMER_ID, CUSTOMER_RFM_SEGMENT]],
                                           on=CUSTOMER_ID, how='left')
 
-        transactions_last_year['month_year'] = transactions_last_year[TRANSACTION_DATE].values.astype('datetime64[M]')
+        transactions_last_year['month_year'] = month_buckets(transactions_last_year[TRANSACTION_DATE])
         transactions_last_year.drop([CUSTOMER_ID, TRANSACTION_DATE], axis=1, inplace=True)
 
         # calculating revenue for different customer_rfm for each month
@@ -475,6 +491,7 @@ class CustomerRFM(Plugin):
         # ------------------------------------------------------------------------------------------------------------------
         # Best and worst cust
         # ------------------------------------------------------------------------------------------------------------------
+        Profiler.mark('Best and worst cust')
 
         returning_customers_last_year = customers_last_year[customers_last_year['n_transactions'] > 1]
         best_customers_lastyear = returning_customers_last_year.sort_values('CLV', ascending=False) \
@@ -490,6 +507,7 @@ class CustomerRFM(Plugin):
         # ------------------------------------------------------------------------------------------------------------------
         # Parameters for future cust
         # ------------------------------------------------------------------------------------------------------------------
+        Profiler.mark('Parameters for future cust')
 
         pred_new_customer_frequency = float(
             "{0:.2f}".format(bgf.expected_number_of_purchases_up_to_time(CHURN_T_HORIZON)))
@@ -499,40 +517,52 @@ class CustomerRFM(Plugin):
         # ------------------------------------------------------------------------------------------------------------------
         # Save customer emails for each segment
         # ------------------------------------------------------------------------------------------------------------------
+        Profiler.mark('Save customer emails for each segment', rows=len(txs))
+
+        # First seen email, shop country and city of every customer, built in a single pass over the transactions and
+        # looked up by customer ID (no merge of the transactions into the customers for each attribute)
+        customer_attributes = txs.groupby(CUSTOMER_ID, sort=False)[
+            [col for col in [CUSTOMER_EMAIL, SHOP_COUNTRY, CUSTOMER_CITY] if col in txs.columns]].first()
 
-        customer_rfm['customers_emails'] = ''
+        # The mailing lists are streamed to compressed files next to out.pickle (see EmailSidecar); the result only
+        # keeps the number of emails and the file of every list
+        segment_emails = {}
         if CUSTOMER_EMAIL in txs.columns:
-            customers_last_year = pd.merge(customers_last_year, txs[[CUSTOMER_ID, CUSTOMER_EMAIL]], on=CUSTOMER_ID,
-                                           how='left')
-            customers_last_year.drop_duplicates(subset=CUSTOMER_ID, keep='first', inplace=True)
-            for seg_idx in range(N_CLUSTERS):
-                mailing_list = list(customers_last_year[
-                                        customers_last_year[CUSTOMER_RFM_SEGMENT] == seg_idx][CUSTOMER_EMAIL])
-                mailing_list = [str(email) for email in mailing_list if str(email) != '' and str(email) != 'nan']
-                customer_rfm.loc[seg_idx, 'customers_emails'] = '; '.join(mailing_list)
+            customers_last_year[CUSTOMER_EMAIL] = customers_last_year[CUSTOMER_ID].map(
+                customer_attributes[CUSTOMER_EMAIL])
+            email_sidecar = EmailSidecar(self.process_output_folder)
+            segment_emails = email_sidecar.export(customers_last_year[CUSTOMER_EMAIL],
+                                                  [customers_last_year[CUSTOMER_RFM_SEGMENT]], 'segment_{0}')
+        customer_rfm['n_customers_emails'] = [segment_emails.get(seg_idx, (0, None))[0]
+                                              for seg_idx in customer_rfm.index]
+        customer_rfm['customers_emails_file'] = [segment_emails.get(seg_idx, (0, None))[1]
+                                                 for seg_idx in customer_rfm.index]
 
         # ------------------------------------------------------------------------------------------------------------------
         # Save cust countries for each segment
         # ------------------------------------------------------------------------------------------------------------------
+        Profiler.mark('Save cust countries for each segment', rows=len(txs))
 
         country_distribution = {'has_data': False}
         city_distribution = {'has_data': False}
 
         if SHOP_COUNTRY in txs.columns:
             country_distribution['has_data'] = True
-            customers_last_year = pd.merge(customers_last_year, txs[[CUSTOMER_ID, SHOP_COUNTRY]],
-                                           on=CUSTOMER_ID, how='left')
-            customers_last_year.drop_duplicates(subset=CUSTOMER_ID, keep='first', inplace=True)
-            customers_last_year[SHOP_COUNTRY].fillna('', inplace=True)
-            customers_last_year['country_code'] = customers_last_year[SHOP_COUNTRY].apply(location.get_country_iso3)
-            customers_last_year['country_name'] = customers_last_year[SHOP_COUNTRY].apply(location.get_country_name)
+            customers_last_year[SHOP_COUNTRY] = customers_last_year[CUSTOMER_ID].map(
+                customer_attributes[SHOP_COUNTRY]).fillna('')
+            customers_last_year['country_code'] = countries.iso3(customers_last_year[SHOP_COUNTRY])
+            customers_last_year['country_name'] = countries.names(customers_last_year[SHOP_COUNTRY])
 
             country_names = customers_last_year['country_name'].unique().tolist()
             country_codes = customers_last_year['country_code'].unique().tolist()
 
             sum_n_cust = [0] * len(country_codes)
             sum_n_cust_pct = [0.0] * len(country_codes)
-            include_emails = True if CUSTOMER_EMAIL in txs.columns else False
+            country_emails = {}
+            if CUSTOMER_EMAIL in txs.columns:
+                country_emails = email_sidecar.export(
+                    customers_last_year[CUSTOMER_EMAIL],
+                    [customers_last_year[CUSTOMER_RFM_SEGMENT], customers_last_year['country_code']], 'segment_{0}_{1}')
 
             for seg_idx in range(N_CLUSTERS):
                 temp = customers_last_year[customers_last_year[CUSTOMER_RFM_SEGMENT] == seg_idx][['country_code']] \
@@ -543,26 +573,19 @@ class CustomerRFM(Plugin):
                     .set_index(keys='country_code', drop=True)
                 list_n_cust = list()
                 list_n_cust_pct = list()
-                list_emails = list()
+                list_email_files = list()
                 list_n_emails = list()
                 total_cust_in_seg = sum(temp['n_customers'].tolist())
                 for idx, country in enumerate(country_codes):
                     n_cust = 0
                     n_cust_pct = 0.0
-                    emails = ''
-                    n_emails = 0
+                    n_emails, email_file = country_emails.get((seg_idx, country), (0, None))
                     if country in temp.index:
                         n_cust = int(temp.loc[country, 'n_customers'])
                         n_cust_pct = 100.0 * (n_cust / total_cust_in_seg)
-                        if include_emails:
-                            emails = list(customers_last_year[(customers_last_year[CUSTOMER_RFM_SEGMENT] == seg_idx) & (
-                                    customers_last_year['country_code'] == country)][CUSTOMER_EMAIL].dropna())
-                            emails = [email for email in emails if email != 'nan']
-                            n_emails = len(emails)
-                            emails = '; '.join(emails)
                     list_n_cust.append(n_cust)
                     list_n_cust_pct.append(n_cust_pct)
-                    list_emails.append(emails)
+                    list_email_files.append(email_file)
                     list_n_emails.append(n_emails)
                     sum_n_cust[idx] += n_cust
                     sum_n_cust_pct[idx] += n_cust_pct
@@ -572,7 +595,7 @@ class CustomerRFM(Plugin):
                     'n_customers_pct': list_n_cust_pct,
                     'country_code': country_codes,
                     'country_name': country_names,
-                    'emails': list_emails,
+                    'email_files': list_email_files,
                     'n_emails': list_n_emails
                 }
 
@@ -589,8 +612,8 @@ class CustomerRFM(Plugin):
                                                key=lambda l: sorted_idx.index(l[0]))],
                     'country_code': country_codes,
                     'country_name': country_names,
-                    'emails': [x for _, x in sorted(enumerate(country_distribution[seg_idx]['emails']),
-                                                    key=lambda l: sorted_idx.index(l[0]))],
+                    'email_files': [x for _, x in sorted(enumerate(country_distribution[seg_idx]['email_files']),
+                                                         key=lambda l: sorted_idx.index(l[0]))],
                     'n_emails': [x for _, x in sorted(enumerate(country_distribution[seg_idx]['n_emails']),
                                                       key=lambda l: sorted_idx.index(l[0]))]
                 }
@@ -601,23 +624,19 @@ class CustomerRFM(Plugin):
 
             if CUSTOMER_CITY in txs.columns:
                 city_distribution['has_data'] = True
-                customers_last_year = pd.merge(customers_last_year, txs[[CUSTOMER_ID, CUSTOMER_CITY]],
-                                               on=CUSTOMER_ID, how='left')
-                customers_last_year.drop_duplicates(subset=CUSTOMER_ID, keep='first', inplace=True)
-                customers_last_year[CUSTOMER_CITY] = customers_last_year[CUSTOMER_CITY].fillna('')
-                customers_last_year[CUSTOMER_CITY] = customers_last_year[CUSTOMER_CITY].apply(
-                    lambda x: str(x).lower().replace('city of ', ''))
-                customers_last_year[CUSTOMER_CITY] = customers_last_year[CUSTOMER_CITY].apply(lambda x: x.title())
-                customers_last_year[CUSTOMER_CITY].replace(to_replace='Nan', value='Unknown', inplace=True)
-                customers_last_year['key'] = customers_last_year[CUSTOMER_CITY] + ' (' + \
-                    customers_last_year['country_name'] + ')'
+                # Customers are grouped on the code of their canonical city (see CityNames) and country
+                customers_last_year['city_code'] = CityNames.codes(
+                    customers_last_year[CUSTOMER_ID].map(customer_attributes[CUSTOMER_CITY]),
+                    self.options.get('cityDictionary'))
                 for seg_idx in range(N_CLUSTERS):
-                    temp = customers_last_year[customers_last_year[CUSTOMER_RFM_SEGMENT] == seg_idx][['key']] \
-                        .groupby(by='key') \
+                    temp = customers_last_year[customers_last_year[CUSTOMER_RFM_SEGMENT] == seg_idx] \
+                        .groupby(by=['city_code', 'country_name']) \
                         .size() \
                         .reset_index() \
-                        .rename(columns={0: 'n_customers'}) \
-                        .sort_values(by='n_customers', ascending=False)
+                        .rename(columns={0: 'n_customers'})
+                    temp['key'] = pd.Series(CityNames.names(temp['city_code'], self.options.get('cityDictionary')),
+                                            index=temp.index) + ' (' + temp['country_name'] + ')'
+                    temp = temp.sort_values(by=['n_customers', 'key'], ascending=[False, True])
                     city_distribution[seg_idx] = {
                         'n_customers': temp['n_customers'].tolist(),
                         'city': temp['key'].tolist()
@@ -626,6 +645,7 @@ class CustomerRFM(Plugin):
         # ------------------------------------------------------------------------------------------------------------------
         # Save the data to be returned
         # ------------------------------------------------------------------------------------------------------------------
+        Profiler.mark('Save the data to be returned')
 
         list_of_segment_index = customer_rfm.index.values.tolist()
         list_of_segment_index = [str(x + 1) for x in list_of_segment_index]
@@ -637,6 +657,13 @@ class CustomerRFM(Plugin):
             'N_CLUSTERS': N_CLUSTERS,
             'N_BEST_PREDICTED_CUSTOMERS': N_BEST_PREDICTED_CUSTOMERS
         }
+        if bootstrap.enabled:
+            customer_rfm['bootstrap'] = {
+                'replicates': bootstrap.n_completed,
+                'requested_replicates': bootstrap.n_replicates,
+                'confidence': bootstrap.confidence,
+                'seconds': bootstrap.elapsed
+            }
 
         customer_rfm['period_start'] = one_year_ago.strftime('%B %d, %Y')
         customer_rfm['period_end'] = last_transaction_date.strftime('%B %d, %Y')
@@ -652,16 +679,13 @@ class CustomerRFM(Plugin):
         customer_rfm['evolution'] = dict()
         for i in range(N_CLUSTERS):
             customer_rfm['evolution'][i] = {
-                'x': segments_evolution.loc[segments_evolution[CUSTOMER_RFM_SEGMENT] == i, 'month_year'].apply(
-                    lambda x: x.strftime('%b-%y')).tolist(),
+                'x': month_labels(segments_evolution.loc[segments_evolution[CUSTOMER_RFM_SEGMENT] == i, 'month_year']),
                 'y': segments_evolution.loc[segments_evolution[CUSTOMER_RFM_SEGMENT] == i, AMOUNT_IN_EUR].tolist()
             }
         customer_rfm['country_distribution'] = country_distribution
         customer_rfm['city_distribution'] = city_distribution
 
-        process_output_file = join(self.process_output_folder, 'out.pickle')
-        with open(process_output_file, "wb") as pickle_out:
-            pickle.dump(customer_rfm, pickle_out, protocol=pickle.HIGHEST_PROTOCOL)
+        ResultBus.publish(self.process_output_folder, customer_rfm)
 
         return customer_rfm
 
@@ -671,19 +695,16 @@ class CustomerRFM(Plugin):
         clusters_evolution_filename = join(self.plot_output_folder, 'clusters_evolution_chart.png')
         clusters_per_country_filename = join(self.plot_output_folder, 'clusters_per_country_chart.png')
         # Load the data
-        input_data_file = join(self.process_output_folder, 'out.pickle')
-        with open(input_data_file, 'rb') as handle:
-            data = pickle.load(handle)
+        data = ResultBus.load(self.process_output_folder)
         cmap = kwargs['cmap']
 
         self._plot_bubble_chart(data, rfm_bubble_chart_filename, cmap)
         self._plot_clusters_evolution(data, clusters_evolution_filename, cmap)
         self._plot_clusters_per_country(data, clusters_per_country_filename, cmap)
+        RenderService.flush()
 
     def report(self, report, styles, *args, **kwargs):
-        input_data_file = join(self.process_output_folder, 'out.pickle')
-        with open(input_data_file, 'rb') as handle:
-            data = pickle.load(handle)
+        data = ResultBus.load(self.process_output_folder)
 
         data_list = list()
         for i in range(N_CLUSTERS):
@@ -3,27 +3,31 @@ import pandas as pd
 import numpy as np
 from dateutil.relativedelta import *
 from ...globals import COLNAMES_PE
-from ...utils.location import Location
+from .country_lookup import CountryLookup
 from ...utils.customer_tools import Feature, remove_all_features, add_feature
-from sklearn.cluster import MiniBatchKMeans
 #for calculating customers' recency and frequency 
-from lifetimes import BetaGeoFitter, GammaGammaFitter
+from .clv_fitters import BetaGeoFitter, GammaGammaFitter
 from itertools import product
 from os.path import join, isfile
-import pickle
-import matplotlib.pyplot as plt
-from reportlab.platypus import Paragraph, Spacer, Image, Table, PageBreak
-from reportlab.lib import colors
-import plotly.io as pio
-import plotly.graph_objs as go
+from .render_service import RenderService
 from wepair.utils_common.log import Log
+from .profiling import Profiler
+from .rfm_clustering import RFMClustering
+from .date_tools import day_deltas, month_buckets, month_labels
+from .customer_timeline import CustomerTimeline
+from .result_bus import ResultBus
+from .plugin_hooks import instrument_plugin
+from .lazy_import import lazy_module, lazy_names
+
+# rendering libraries, imported on first use in plot() / report() (see lazy_import)
+Paragraph, Spacer, Image, Table, PageBreak = lazy_names('reportlab.platypus', 'Paragraph', 'Spacer', 'Image', 'Table',
+                                                         'PageBreak')
+colors = lazy_module('reportlab.lib.colors')
+go = lazy_module('plotly.graph_objs')
 
 # log
 logger = Log(__name__).get_logger()
 
-# orca config
-pio.orca.config.use_xvfb = 'auto'
-
 TRANSACTION_DATE = COLNAMES_PE['Transaction Creation Date and Time']
 AMOUNT_IN_EUR = COLNAMES_PE['Amount in EUR']
 CUSTOMER_NAME = COLNAMES_PE['Card Holder Name']
@@ -105,7 +109,7 @@ class CustomerSgement(Plugin):
 
             }
         }
-        pio.write_image(fig, filename, format='png')
+        RenderService.write_image(fig, filename, format='png')
 
     @staticmethod
     def _plot_clusters_evolution(data, clusters_evolution_filename, cmap):
@@ -171,7 +175,7 @@ class CustomerSgement(Plugin):
 
         )
         fig = go.Figure(data=traces, layout=layout)
-        pio.write_image(fig, clusters_evolution_filename, format='png')
+        RenderService.write_image(fig, clusters_evolution_filename, format='png')
 
     @staticmethod
     def _plot_clusters_per_country(data, clusters_per_country_filename, cmap):
@@ -232,7 +236,7 @@ class CustomerSgement(Plugin):
 
         )
         fig = go.Figure(data=traces, layout=layout)
-        pio.write_image(fig, clusters_per_country_filename, format='png', scale=2)
+        RenderService.write_image(fig, clusters_per_country_filename, format='png', scale=2)
         '''
         sns.set()
         sns.set_style("white")
@@ -256,13 +260,14 @@ class CustomerSgement(Plugin):
         self.plugin_name = "Customer rfm"
         super().__init__(plugin_folder, id, options)
         self.required_input_data = ['tx.pickle', 'customers.pickle']
+        instrument_plugin(self)
 
     def process(self, *args, **kwargs):
 
         customer_rfm = {'has_data': False}
         logger.debug(kwargs)
 
-        location = Location(self.options['assets'])
+        countries = CountryLookup.from_options(self.options)
 
         if len(args) != 2:
             logger.warning('Fatal Error: Data Input Source Missing')
@@ -281,6 +286,7 @@ class CustomerSgement(Plugin):
         # ------------------------------------------------------------------------------------------------------------------
         # Initialization
         # ------------------------------------------------------------------------------------------------------------------
+        Profiler.mark('Initialization', rows=len(transactions))
 
         list_columns = [TRANSACTION_DATE, AMOUNT_IN_EUR, CUSTOMER_ID, CUSTOMER_NAME, TRANSACTION_IS_RETURN,
                         TRANSACTION_IS_CAPTURE]
@@ -288,15 +294,15 @@ class CustomerSgement(Plugin):
             if col in transactions.columns:
                 list_columns.append(col)
 
-        txs = transactions[transactions[TRANSACTION_IS_CAPTURE]][list_columns].copy()
-        cust = customers.copy()
-        temp = transactions[transactions[TRANSACTION_IS_CAPTURE]][[CUSTOMER_ID, TRANSACTION_DATE]].groupby(CUSTOMER_ID)[TRANSACTION_DATE].nsmallest(2).groupby(level=CUSTOMER_ID).last()
-       
-        #merging the two data frames
-        pd.merge(cust, temp.to_frame('second_transaction_date'), on=CUSTOMER_ID)
+        txs = transactions.loc[transactions[TRANSACTION_IS_CAPTURE], list_columns]
+        cust = customers.copy(deep=False)
+        timeline = CustomerTimeline(txs, CUSTOMER_ID, TRANSACTION_DATE)
+
+        #adding the date of the second purchase of every customer (NaT for one-time customers)
+        cust['second_transaction_date'] = cust[CUSTOMER_ID].map(timeline.nth_dates(2))
         #creating new variable which will have exact number of days between 2 purchases that customer made
-        cust['time_between_first_second_purchase'] = cust['second_transaction_date'] - cust['first_transaction_date']
-        cust['time_between_first_second_purchase'] = cust['time_between_first_second_purchase'].apply(lambda x: x.days)
+        cust['time_between_first_second_purchase'] = day_deltas(cust['second_transaction_date'],
+                                                                cust['first_transaction_date'])
         last_transaction_date = txs[TRANSACTION_DATE].max()
         first_transaction_date = txs[TRANSACTION_DATE].min()
         
@@ -326,14 +332,14 @@ class CustomerSgement(Plugin):
             qc_ids = set(test_cust_df[((test_cust_df['second_transaction_date'] > today) | (
                 pd.isna(test_cust_df['second_transaction_date']))) & (
                                               test_cust_df['first_transaction_date'] <= today) & (
-                                              (today - test_cust_df['first_transaction_date']).apply(
-                                                  lambda x: x.days) > 41)][CUSTOMER_ID].tolist())
+                                              day_deltas(today, test_cust_df['first_transaction_date']) > 41)][
+                                                  CUSTOMER_ID].tolist())
             #is this a new customer? 
             new_ids = set(test_cust_df[((test_cust_df['second_transaction_date'] > today) | (
                 pd.isna(test_cust_df['second_transaction_date']))) & (
                                                test_cust_df['first_transaction_date'] <= today) & (
-                                               (today - test_cust_df['first_transaction_date']).apply(
-                                                   lambda x: x.days) <= 41)][CUSTOMER_ID].tolist())
+                                               day_deltas(today, test_cust_df['first_transaction_date']) <= 41)][
+                                                   CUSTOMER_ID].tolist())
             #this is only one-time customer?
             one_time_ids = set(test_cust_df[((test_cust_df['second_transaction_date'] > today) | (
                 pd.isna(test_cust_df['second_transaction_date']))) & (test_cust_df['first_transaction_date'] <= today)][
@@ -345,10 +351,6 @@ class CustomerSgement(Plugin):
             today += relativedelta(days=1)
             print(today)
 
-        plt.bar(range(len(n_new_list)), n_returning_list)
-        list_sum = [n_new_list[i] + n_returning_list[i] for i in range(len(n_new_list))]
-        plt.bar(range(len(n_new_list)), n_new_list, bottom=n_returning_list)
-        plt.bar(range(len(n_new_list)), n_qc_list, bottom=list_sum)
         logger.debug('Time period for the segmentation: '
                       '{from_date} to {to_date}'.format(from_date=one_year_ago,
                                                         to_date=last_transaction_date))
@@ -356,6 +358,7 @@ class CustomerSgement(Plugin):
         # ------------------------------------------------------------------------------------------------------------------
         # Frequency, Monetary, and churn probability prediction
         # ------------------------------------------------------------------------------------------------------------------
+        Profiler.mark('Frequency, Monetary, and churn probability prediction', rows=len(cust))
  
     #read about BetaGeoFitter: https://towardsdatascience.com/whats-a-customer-worth-8daf183f8a4f
     #read 2: 
@@ -396,6 +399,7 @@ class CustomerSgement(Plugin):
         # ------------------------------------------------------------------------------------------------------------------
         # Segmentation of last year cust
         # ------------------------------------------------------------------------------------------------------------------
+        Profiler.mark('Segmentation of last year cust', rows=len(txs))
 
         if txs[TRANSACTION_DATE].min() < one_year_ago:
             print('Re-compute the features for the cust from last year')
@@ -413,24 +417,17 @@ class CustomerSgement(Plugin):
             #appending cust values to the customers_last_year variable 
             customers_last_year = cust
             #creating new variables in the dataframe:
-        customers_last_year['R'] = (customers_last_year['last_transaction_date'] - one_year_ago).apply(
-            lambda x: int(x.total_seconds() / (24.0 * 60 * 60)))
+        customers_last_year['R'] = day_deltas(customers_last_year['last_transaction_date'], one_year_ago)
         customers_last_year['F'] = customers_last_year['n_transactions']
         customers_last_year['M_sum'] = customers_last_year['total_spending']
         customers_last_year['M_avg'] = customers_last_year['avg_spending']
 
-        customers_last_year['norm_R'] = (customers_last_year['R']
-                                         - customers_last_year['R'].mean()) / customers_last_year['R'].std()
-        customers_last_year['norm_F'] = (customers_last_year['F']
-                                         - customers_last_year['F'].mean()) / customers_last_year['F'].std()
-        customers_last_year['norm_M_sum'] = (customers_last_year['M_sum']
-                                             - customers_last_year['M_sum'].mean()) / customers_last_year['M_sum'].std()
-
-        kmeans = MiniBatchKMeans(n_clusters=N_CLUSTERS, init='k-means++', max_iter=1000, tol=1e-6, n_init=10,
-                                 random_state=KMEANS_RANDOM_INITIAL_STATE, batch_size=1000, verbose=True)
-        kmeans.fit(customers_last_year[['norm_R', 'norm_F', 'norm_M_sum']])
-        customers_last_year[CUSTOMER_RFM_SEGMENT] = kmeans.labels_
-        customers_last_year.drop(['norm_R', 'norm_F', 'norm_M_sum'], axis=1, inplace=True)
+        # full k-means on the re-clustering schedule only, partial_fit on the changed customers in between
+        clustering = RFMClustering.from_options(N_CLUSTERS, KMEANS_RANDOM_INITIAL_STATE, self.options,
+                                                verbose=True)
+        customers_last_year[CUSTOMER_RFM_SEGMENT] = clustering.segments(
+            customers_last_year, last_transaction_date, CUSTOMER_ID,
+            ['last_transaction_date', 'n_transactions', 'total_spending'])
 
         # Saving the information about each segment
         customer_rfm['R_avg'] = customers_last_year.groupby(CUSTOMER_RFM_SEGMENT, sort=False).agg({'R': 'mean'})['R']
@@ -506,12 +503,13 @@ class CustomerSgement(Plugin):
         # ------------------------------------------------------------------------------------------------------------------
         # Analyze the evolution of the customer_rfm
         # ------------------------------------------------------------------------------------------------------------------
+        Profiler.mark('Analyze the evolution of the customer_rfm')
 
         transactions_last_year = pd.merge(transactions_last_year,
                                           customers_last_year[[CUSTOMER_ID, CUSTOMER_RFM_SEGMENT]],
                                           on=CUSTOMER_ID, how='left')
 
-        transactions_last_year['month_year'] = transactions_last_year[TRANSACTION_DATE].values.astype('datetime64[M]')
+        transactions_last_year['month_year'] = month_buckets(transactions_last_year[TRANSACTION_DATE])
         transactions_last_year.drop([CUSTOMER_ID, TRANSACTION_DATE], axis=1, inplace=True)
 
         # calculating revenue for different customer_rfm for each month
@@ -536,6 +534,7 @@ class CustomerSgement(Plugin):
         # ------------------------------------------------------------------------------------------------------------------
         # Best and worst cust
         # ------------------------------------------------------------------------------------------------------------------
+        Profiler.mark('Best and worst cust')
 
         returning_customers_last_year = customers_last_year[customers_last_year['n_transactions'] > 1]
         best_customers_lastyear = returning_customers_last_year.sort_values('CLV', ascending=False) \
@@ -551,6 +550,7 @@ class CustomerSgement(Plugin):
         # ------------------------------------------------------------------------------------------------------------------
         # Parameters for future cust
         # ------------------------------------------------------------------------------------------------------------------
+        Profiler.mark('Parameters for future cust')
 
         pred_new_customer_frequency = float(
             "{0:.2f}".format(bgf.expected_number_of_purchases_up_to_time(CHURN_T_HORIZON)))
@@ -560,6 +560,7 @@ class CustomerSgement(Plugin):
         # ------------------------------------------------------------------------------------------------------------------
         # Save customer emails for each segment
         # ------------------------------------------------------------------------------------------------------------------
+        Profiler.mark('Save customer emails for each segment', rows=len(txs))
 
         customer_rfm['customers_emails'] = ''
         if CUSTOMER_EMAIL in txs.columns:
@@ -575,6 +576,7 @@ class CustomerSgement(Plugin):
         # ------------------------------------------------------------------------------------------------------------------
         # Save cust countries for each segment
         # ------------------------------------------------------------------------------------------------------------------
+        Profiler.mark('Save cust countries for each segment', rows=len(txs))
 
         country_distribution = {'has_data': False}
         city_distribution = {'has_data': False}
@@ -585,8 +587,8 @@ class CustomerSgement(Plugin):
                                            on=CUSTOMER_ID, how='left')
             customers_last_year.drop_duplicates(subset=CUSTOMER_ID, keep='first', inplace=True)
             customers_last_year[SHOP_COUNTRY].fillna('', inplace=True)
-            customers_last_year['country_code'] = customers_last_year[SHOP_COUNTRY].apply(location.get_country_iso3)
-            customers_last_year['country_name'] = customers_last_year[SHOP_COUNTRY].apply(location.get_country_name)
+            customers_last_year['country_code'] = countries.iso3(customers_last_year[SHOP_COUNTRY])
+            customers_last_year['country_name'] = countries.names(customers_last_year[SHOP_COUNTRY])
 
             country_names = customers_last_year['country_name'].unique().tolist()
             country_codes = customers_last_year['country_code'].unique().tolist()
@@ -685,6 +687,7 @@ class CustomerSgement(Plugin):
         # ------------------------------------------------------------------------------------------------------------------
         # Save the data to be returned
         # ------------------------------------------------------------------------------------------------------------------
+        Profiler.mark('Save the data to be returned')
 
         list_of_segment_index = customer_rfm.index.values.tolist()
         list_of_segment_index = [str(x + 1) for x in list_of_segment_index]
@@ -711,16 +714,13 @@ class CustomerSgement(Plugin):
         customer_rfm['evolution'] = dict()
         for i in range(N_CLUSTERS):
             customer_rfm['evolution'][i] = {
-                'x': segments_evolution.loc[segments_evolution[CUSTOMER_RFM_SEGMENT] == i, 'month_year'].apply(
-                    lambda x: x.strftime('%b-%y')).tolist(),
+                'x': month_labels(segments_evolution.loc[segments_evolution[CUSTOMER_RFM_SEGMENT] == i, 'month_year']),
                 'y': segments_evolution.loc[segments_evolution[CUSTOMER_RFM_SEGMENT] == i, AMOUNT_IN_EUR].tolist()
             }
         customer_rfm['country_distribution'] = country_distribution
         customer_rfm['city_distribution'] = city_distribution
 
-        process_output_file = join(self.process_output_folder, 'out.pickle')
-        with open(process_output_file, "wb") as pickle_out:
-            pickle.dump(customer_rfm, pickle_out, protocol=pickle.HIGHEST_PROTOCOL)
+        ResultBus.publish(self.process_output_folder, customer_rfm)
 
         return customer_rfm
 
@@ -730,19 +730,16 @@ class CustomerSgement(Plugin):
         clusters_evolution_filename = join(self.plot_output_folder, 'clusters_evolution_chart.png')
         clusters_per_country_filename = join(self.plot_output_folder, 'clusters_per_country_chart.png')
         # Load the data
-        input_data_file = join(self.process_output_folder, 'out.pickle')
-        with open(input_data_file, 'rb') as handle:
-            data = pickle.load(handle)
+        data = ResultBus.load(self.process_output_folder)
         cmap = kwargs['cmap']
 
         self._plot_bubble_chart(data, rfm_bubble_chart_filename, cmap)
         self._plot_clusters_evolution(data, clusters_evolution_filename, cmap)
         self._plot_clusters_per_country(data, clusters_per_country_filename, cmap)
+        RenderService.flush()
 
     def report(self, report, styles, *args, **kwargs):
-        input_data_file = join(self.process_output_folder, 'out.pickle')
-        with open(input_data_file, 'rb') as handle:
-            data = pickle.load(handle)
+        data = ResultBus.load(self.process_output_folder)
 
         data_list = list()
         for i in range(N_CLUSTERS):
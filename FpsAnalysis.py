@@ -9,23 +9,25 @@ from wepair.plugins.plugin import Plugin
 from ...globals import COLNAMES_RISK_MANAGEMENT
 import pandas as pd
 import inspect
-import pickle
 from os.path import join
-from ...utils.location import Location
+from .country_lookup import CountryLookup
 from ...utils.time_window import TimeWindow
-from reportlab.platypus import Image
-import plotly.io as pio
-import plotly.graph_objs as go
+from .render_service import RenderService
+from .plot_scheduler import PlotScheduler, ChartJob
+from .result_bus import ResultBus
+from .plugin_hooks import instrument_plugin
 from datetime import *
 from wepair.utils_common.log import Log
-from ...utils.report import Report
+from .lazy_import import lazy_module, lazy_names
+
+# rendering libraries, imported on first use in plot() / report() (see lazy_import)
+Image = lazy_names('reportlab.platypus', 'Image')
+go = lazy_module('plotly.graph_objs')
+Report = lazy_names('...utils.report', 'Report', package=__package__)
 
 # log
 logger = Log(__name__).get_logger()
 
-# orca config
-pio.orca.config.use_xvfb = 'auto'
-
 FPS_SHOP_ACCOUNT_SHORT_NAME = COLNAMES_RISK_MANAGEMENT['Merchant Account Short Name']
 FPS_TRANSACTION_RESULT = COLNAMES_RISK_MANAGEMENT['Transaction Result']
 FPS_REASON_CODE = COLNAMES_RISK_MANAGEMENT['FPS Reason Code List']
@@ -113,7 +115,7 @@ class FpsAnalysis(Plugin):
                 }
             )
             fig = go.Figure(data=traces, layout=layout)
-            pio.write_image(fig, filename)
+            RenderService.write_image(fig, filename)
 
         elif target == 'n_transactions':
 
@@ -181,7 +183,7 @@ class FpsAnalysis(Plugin):
                 }
             )
             fig = go.Figure(data=traces, layout=layout)
-            pio.write_image(fig, filename)
+            RenderService.write_image(fig, filename)
 
     @staticmethod
     def _plot_country_analysis(data, target, time_window_idx, cmap, filename):
@@ -261,13 +263,14 @@ class FpsAnalysis(Plugin):
             fig['layout']['yaxis']['range'] = [0.4, 1]
             fig['layout']['yaxis']['title'] = "Decline rate"
 
-        pio.write_image(fig, filename, scale=3.0)
+        RenderService.write_image(fig, filename, scale=3.0)
 
     def __init__(self, plugin_folder, id, options=None):
 
         self.plugin_name = "FPS Kpis"
         super().__init__(plugin_folder, id, options)
         self.required_input_data = ['tx_fps.pickle']
+        instrument_plugin(self)
 
     def process(self, *args, **kwargs):
 
@@ -294,9 +297,7 @@ class FpsAnalysis(Plugin):
 
             declined_per_country = txs[(txs[FPS_DATE] >= start_period) &
                                        (txs[FPS_DATE] <= end_period) &
-                                       (txs[FPS_TRANSACTION_RESULT] == 'NOK')] \
-                .copy() \
-                .reset_index(drop=True)
+                                       (txs[FPS_TRANSACTION_RESULT] == 'NOK')]
 
             declined_per_country = declined_per_country.groupby('SHOP_COUNTRY') \
                 .agg({FPS_AMOUNT_IN_EUR: [sum, 'size']}) \
@@ -308,9 +309,7 @@ class FpsAnalysis(Plugin):
 
             accepted_per_country = txs[(txs[FPS_DATE] >= start_period) &
                                        (txs[FPS_DATE] <= end_period) &
-                                       (txs[FPS_TRANSACTION_RESULT] == 'OK')] \
-                .copy() \
-                .reset_index(drop=True)
+                                       (txs[FPS_TRANSACTION_RESULT] == 'OK')]
             accepted_per_country = accepted_per_country.groupby('SHOP_COUNTRY') \
                 .agg({FPS_AMOUNT_IN_EUR: [sum, 'size']}) \
                 .reset_index(drop=False)
@@ -320,9 +319,7 @@ class FpsAnalysis(Plugin):
                 .reset_index(drop=True)
 
             txs_per_country = txs[(txs[FPS_DATE] >= start_period) &
-                                  (txs[FPS_DATE] <= end_period)] \
-                .copy() \
-                .reset_index(drop=True)
+                                  (txs[FPS_DATE] <= end_period)]
             txs_per_country = txs_per_country.groupby('SHOP_COUNTRY') \
                 .agg({FPS_AMOUNT_IN_EUR: [sum, 'size']}) \
                 .reset_index(drop=False)
@@ -362,21 +359,23 @@ class FpsAnalysis(Plugin):
         # Filter and pre-process
         # --------------------------------------------------------------------
 
-        fps_transactions = fps_transactions[fps_transactions[FPS_OVERALL_SCORE] > -1]
+        # Scored, non-invoice transactions with a positive amount, selected (and projected) once: the input is shared
+        keep = fps_transactions[FPS_OVERALL_SCORE] > -1
 
-        if len(fps_transactions) == 0:
+        if not keep.any():
             return key_indicators
 
         key_indicators = {'has_data': True}
-        location = Location(self.options['assets'])
+        countries = CountryLookup.from_options(self.options)
 
-        fps_transactions = fps_transactions[
-            fps_transactions[FPS_SHOP_ACCOUNT_SHORT_NAME].apply(lambda x: x.split(' ')[3] != 'INV')]
+        keep &= fps_transactions[FPS_AMOUNT_IN_EUR] > 0
+        keep[keep] = fps_transactions.loc[keep, FPS_SHOP_ACCOUNT_SHORT_NAME] \
+            .apply(lambda x: x.split(' ')[3] != 'INV').values
+        fps_transactions = fps_transactions.loc[keep, [FPS_DATE, FPS_TRANSACTION_RESULT, FPS_AMOUNT_IN_EUR,
+                                                       FPS_SHOP_ACCOUNT_SHORT_NAME]]
 
-        fps_transactions = fps_transactions[fps_transactions[FPS_AMOUNT_IN_EUR] > 0]
-
-        fps_transactions['SHOP_COUNTRY'] = fps_transactions[FPS_SHOP_ACCOUNT_SHORT_NAME].apply(
-            lambda x: location.get_country_name(x.split(' ')[1]))
+        fps_transactions['SHOP_COUNTRY'] = countries.names(
+            fps_transactions[FPS_SHOP_ACCOUNT_SHORT_NAME].apply(lambda x: x.split(' ')[1])).tolist()
 
         n_transactions = len(fps_transactions)
         n_declines = len(fps_transactions[fps_transactions[FPS_TRANSACTION_RESULT] == 'NOK'])
@@ -385,7 +384,7 @@ class FpsAnalysis(Plugin):
         # Compute number of declines per month (Txs level)
         # --------------------------------------------------------------------
 
-        declined_per_month = fps_transactions[fps_transactions[FPS_TRANSACTION_RESULT] == 'NOK'].copy()
+        declined_per_month = fps_transactions[fps_transactions[FPS_TRANSACTION_RESULT] == 'NOK']
         declined_per_month = declined_per_month.resample('M', on=FPS_DATE) \
             .agg({FPS_AMOUNT_IN_EUR: [sum, 'size']}) \
             .reset_index(drop=False)
@@ -394,7 +393,7 @@ class FpsAnalysis(Plugin):
         declined_per_month = declined_per_month.sort_values(by=FPS_DATE, ascending=True) \
             .reset_index(drop=True)
 
-        accepted_per_month = fps_transactions[fps_transactions[FPS_TRANSACTION_RESULT] == 'OK'].copy()
+        accepted_per_month = fps_transactions[fps_transactions[FPS_TRANSACTION_RESULT] == 'OK']
         accepted_per_month = accepted_per_month.resample('M', on=FPS_DATE) \
             .agg({FPS_AMOUNT_IN_EUR: [sum, 'size']}) \
             .reset_index(drop=False)
@@ -403,8 +402,7 @@ class FpsAnalysis(Plugin):
         accepted_per_month = accepted_per_month.sort_values(by=FPS_DATE, ascending=True) \
             .reset_index(drop=True)
 
-        txs_per_month = fps_transactions.copy()
-        txs_per_month = txs_per_month.resample('M', on=FPS_DATE) \
+        txs_per_month = fps_transactions.resample('M', on=FPS_DATE) \
             .agg({FPS_AMOUNT_IN_EUR: [sum, 'size']}) \
             .reset_index(drop=False)
         txs_per_month.columns = txs_per_month.columns.droplevel(1)
@@ -452,28 +450,28 @@ class FpsAnalysis(Plugin):
             start_window, end_window = TimeWindow.get_time_window(time_window)
             key_indicators['country_analysis']['time_window_' + str(time_window_idx)] \
                 = _per_country_analysis(start_window, end_window, fps_transactions)
-        process_output_file = join(self.process_output_folder, 'out.pickle')
-
-        with open(process_output_file, "wb") as pickle_out:
-            pickle.dump(key_indicators, pickle_out, protocol=pickle.HIGHEST_PROTOCOL)
+        ResultBus.publish(self.process_output_folder, key_indicators)
 
         return key_indicators
 
-    def plot(self, *args, **kwargs):
+    def plot_jobs(self, *args, **kwargs):
 
-        input_data_file = join(self.process_output_folder, 'out.pickle')
-        with open(input_data_file, 'rb') as handle:
-            data = pickle.load(handle)
+        input_data_file = ResultBus.result_file(self.process_output_folder)
 
+        jobs = []
         for target in self.options['target']:
-            self._plot_monthly_analysis(data, target, kwargs['cmap'],
-                                        join(self.plot_output_folder,
-                                             'monthly_' + target + '.png'))
+            jobs.append(ChartJob(self.plugin_name, 'monthly_' + target, self._plot_monthly_analysis, input_data_file,
+                                 (target, kwargs['cmap'], join(self.plot_output_folder, 'monthly_' + target + '.png'))))
         for time_window_idx, _ in enumerate(self.options['time_windows']):
             for target in self.options['target']:
-                self._plot_country_analysis(data, target, time_window_idx, kwargs['cmap'],
-                                            join(self.plot_output_folder,
-                                                 'country_' + target + '_time_window_' + str(time_window_idx) + '.png'))
+                chart_name = 'country_' + target + '_time_window_' + str(time_window_idx)
+                jobs.append(ChartJob(self.plugin_name, chart_name, self._plot_country_analysis, input_data_file,
+                                     (target, time_window_idx, kwargs['cmap'],
+                                      join(self.plot_output_folder, chart_name + '.png'))))
+        return jobs
+
+    def plot(self, *args, **kwargs):
+        PlotScheduler.run_jobs(self.plot_jobs(*args, **kwargs))
 
     def report(self, report, styles, *args, **kwargs):
 
@@ -9,22 +9,23 @@ from os.path import join, isfile, dirname
 import pandas as pd
 import numpy as np
 import inspect
-import pickle
 from ..plugin import Plugin
 from ...globals import COLNAMES_PE, COLNAMES_FRAUD
-from reportlab.platypus import Paragraph, Image, Table
-from reportlab.lib import colors
-import plotly.io as pio
+from .render_service import RenderService
+from .result_bus import ResultBus
+from .plugin_hooks import instrument_plugin
 from datetime import datetime
-from ...utils.report import Report
 from wepair.utils_common.log import Log
+from .lazy_import import lazy_module, lazy_names
+
+# rendering libraries, imported on first use in plot() / report() (see lazy_import)
+Paragraph, Image, Table = lazy_names('reportlab.platypus', 'Paragraph', 'Image', 'Table')
+colors = lazy_module('reportlab.lib.colors')
+Report = lazy_names('...utils.report', 'Report', package=__package__)
 
 # log
 logger = Log(__name__).get_logger()
 
-# orca config
-pio.orca.config.use_xvfb = 'auto'
-
 # Constants: define the column names
 TRANSACTION_DATE = COLNAMES_PE['Transaction Creation Date and Time']
 AMOUNT_IN_EUR = COLNAMES_PE['Amount in EUR']
@@ -122,7 +123,7 @@ class FraudAnalysis(Plugin):
             }
         }
 
-        pio.write_image(fig, output_png_filename, format='png', scale=4)
+        RenderService.write_image(fig, output_png_filename, format='png', scale=4)
 
     def plot_amount_fraud_per_month(self, data, cmap):
 
@@ -202,7 +203,7 @@ class FraudAnalysis(Plugin):
             }
         }
 
-        pio.write_image(fig, output_png_filename, format='png', scale=4)
+        RenderService.write_image(fig, output_png_filename, format='png', scale=4)
 
     def plot_fraud_ratio_per_month(self, data, cmap):
 
@@ -282,7 +283,7 @@ class FraudAnalysis(Plugin):
             }
         }
 
-        pio.write_image(fig, output_png_filename, format='png', scale=4)
+        RenderService.write_image(fig, output_png_filename, format='png', scale=4)
 
     def __init__(self, plugin_folder, id, options=None):
 
@@ -290,6 +291,7 @@ class FraudAnalysis(Plugin):
         self.plugin_name = "Fraud monthly analysis"
 
         self.required_input_data = ['tx.pickle', 'tx_fraud.pickle']
+        instrument_plugin(self)
 
     def process(self, *args, **kwargs):
         fraud_dict = {'has_data': False}
@@ -323,8 +325,8 @@ class FraudAnalysis(Plugin):
         
 #this is only a KPI for counting the VISA frauds - literaly a fraud analysis
         # For VISA (TC40)
-        frauds_visa = fraud_transactions[fraud_transactions[FRAUD_DATA_SOURCE] == 'TC40'][
-            [FRAUD_TRANSACTION_DATE, FRAUD_AMOUNT]].copy()
+        frauds_visa = fraud_transactions.loc[fraud_transactions[FRAUD_DATA_SOURCE] == 'TC40',
+                                             [FRAUD_TRANSACTION_DATE, FRAUD_AMOUNT]]
         frauds_visa = frauds_visa.resample('M', on=FRAUD_TRANSACTION_DATE) \
             .agg([sum, 'size']) \
             .reset_index(drop=False)
@@ -351,8 +353,8 @@ class FraudAnalysis(Plugin):
         #print(results_visa)
 
         # For MasterCard (SAFE)
-        frauds_mc = fraud_transactions[fraud_transactions[FRAUD_DATA_SOURCE] == 'SAFE'][
-            [FRAUD_TRANSACTION_DATE, FRAUD_AMOUNT]].copy()
+        frauds_mc = fraud_transactions.loc[fraud_transactions[FRAUD_DATA_SOURCE] == 'SAFE',
+                                           [FRAUD_TRANSACTION_DATE, FRAUD_AMOUNT]]
         frauds_mc = frauds_mc.resample('M', on=FRAUD_TRANSACTION_DATE) \
             .agg([sum, 'size']) \
             .reset_index(drop=False)
@@ -408,8 +410,7 @@ class FraudAnalysis(Plugin):
             'MASTERCARD_fraud_ratio': mc_fraud_ratio
         })
 
-        with open(self.process_output_file, "wb") as pickle_out:
-            pickle.dump(fraud_dict, pickle_out, protocol=pickle.HIGHEST_PROTOCOL)
+        ResultBus.publish(self.process_output_folder, fraud_dict)
 
         return fraud_dict
 
@@ -420,23 +421,18 @@ class FraudAnalysis(Plugin):
             'Fatal Error: The file {filename} is missing.Function {plugin_name}cannot run.'\
             .format(filename=self.process_output_file, plugin_name=self.plugin_name)
 
-        input_data_file = join(self.process_output_folder, 'out.pickle')
-
-        with open(input_data_file, 'rb') as handle:
-            data = pickle.load(handle)
+        data = ResultBus.load(self.process_output_folder)
 
         self.plot_number_frauds_per_month(data, kwargs['cmap'])
 
         self.plot_amount_fraud_per_month(data, kwargs['cmap'])
 
         self.plot_fraud_ratio_per_month(data, kwargs['cmap'])
+        RenderService.flush()
 
     def report(self, report, styles, *args, **kwargs):
 
-        input_data_file = join(self.process_output_folder, 'out.pickle')
-
-        with open(input_data_file, 'rb') as handle:
-            data = pickle.load(handle)
+        data = ResultBus.load(self.process_output_folder)
 
         Report.draw_text_right(doc=report, text='FRAUD ANALYSIS', style=styles['Heading2-White'])
 
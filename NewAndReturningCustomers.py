@@ -8,21 +8,23 @@ Created on Mon Jul 22 16:02:04 2019
 from wepair.plugins.plugin import Plugin
 from ...globals import COLNAMES_PE
 import pandas as pd
-import pickle
 from os.path import join
-import numpy as np
 import inspect
-from reportlab.platypus import Image
-import plotly.io as pio
-from ...utils.report import Report
+from .render_service import RenderService
+from .customer_activity import activity_per_period
+from .date_tools import granularity_option, period_labels
+from .result_bus import ResultBus
+from .plugin_hooks import instrument_plugin
 from wepair.utils_common.log import Log
+from .lazy_import import lazy_names
+
+# rendering libraries, imported on first use in plot() / report() (see lazy_import)
+Image = lazy_names('reportlab.platypus', 'Image')
+Report = lazy_names('...utils.report', 'Report', package=__package__)
 
 # log
 logger = Log(__name__).get_logger()
 
-# orca config
-pio.orca.config.use_xvfb = 'auto'
-
 TRANSACTION_DATE = COLNAMES_PE['Transaction Creation Date and Time']
 CUSTOMER_ID = COLNAMES_PE['Customer Unique ID']
 TRANSACTION_IS_CAPTURE = COLNAMES_PE['Is capture']
@@ -35,6 +37,7 @@ class NewAndReturningCustomers(Plugin):
         self.plugin_name = "New and Returning Customers"
         super().__init__(plugin_folder, id, options)
         self.required_input_data = ['tx.pickle']
+        instrument_plugin(self)
 
     def process(self, *args, **kwargs):
 
@@ -57,87 +60,38 @@ class NewAndReturningCustomers(Plugin):
             return new_and_returning_customers_over_time
 
         # Extract the data of interest
-        transactions = transactions[[TRANSACTION_DATE, CUSTOMER_ID, TRANSACTION_IS_CAPTURE, TRANSACTION_IS_RETURN]]
-        # Split the transaction set into gross sales and sales returns
-        gross_sales_txs = transactions[transactions[TRANSACTION_IS_CAPTURE]].copy()
-
-        gross_sales_txs = gross_sales_txs[[TRANSACTION_DATE, CUSTOMER_ID]].copy()
-        gross_sales_txs = gross_sales_txs.astype({TRANSACTION_DATE: np.str, CUSTOMER_ID: np.str})
-        gross_sales_txs[TRANSACTION_DATE] = pd.to_datetime(gross_sales_txs[TRANSACTION_DATE],
-                                                           format="%Y-%m-%d %H:%M:%S").apply(lambda x: x.date())
-        gross_sales_txs['month_year'] = gross_sales_txs[TRANSACTION_DATE].values.astype('datetime64[M]')
-        gross_sales_txs.drop(TRANSACTION_DATE, axis=1, inplace=True)
-
-        # sorting txs by date and name
-        gross_sales_txs.sort_values(by=[CUSTOMER_ID, 'month_year'], ascending=[True, True], inplace=True)
-        gross_sales_txs = gross_sales_txs.sort_values(by=[CUSTOMER_ID, 'month_year'], ascending=[True, True]) \
-            .drop_duplicates(subset=[CUSTOMER_ID, 'month_year'], keep='first')
-
-        # new vs returning customers
-        customers = gross_sales_txs.groupby([CUSTOMER_ID, 'month_year'], sort=False).head()
-        customers['cumcount'] = pd.DataFrame(customers.groupby(CUSTOMER_ID).cumcount())
-
-        # calculating new vs returning customer count per month
-        new_cust = customers[customers['cumcount'] == 0]
-        ret_cust = customers[customers['cumcount'] > 0]
-
-        new_cust_cpm = new_cust.groupby(['month_year'], sort=False)[CUSTOMER_ID].agg(['count']) \
-            .reset_index() \
-            .sort_values(by=['month_year'], ascending=True)
-        ret_cust_cpm = ret_cust.groupby(['month_year'], sort=False)[CUSTOMER_ID].agg(['count']) \
-            .reset_index() \
-            .sort_values(by=['month_year'], ascending=True)
-        cust_cpm = customers.groupby(['month_year'], sort=False)[CUSTOMER_ID].agg(['count']) \
-            .reset_index() \
-            .sort_values(by=['month_year'], ascending=True)
+        gross_sales_txs = transactions.loc[transactions[TRANSACTION_IS_CAPTURE], [TRANSACTION_DATE, CUSTOMER_ID]]
+
+        # new vs returning customer count per period (month by default): a customer is new in their first active period
+        granularity = granularity_option(self.options)
+        activity = activity_per_period(gross_sales_txs[CUSTOMER_ID], gross_sales_txs[TRANSACTION_DATE], granularity)
+        del gross_sales_txs
+        month_year = period_labels(activity.index, granularity)
 
         new_and_returning_customers_over_time = {
             'has_data': True,
+            'granularity': granularity,
             'new_customers': {
-                'month_year': new_cust_cpm['month_year'].apply(lambda x: x.strftime('%b-%y')).tolist(),
-                'n_customers': new_cust_cpm['count'].astype(int).tolist()
+                'month_year': month_year,
+                'n_customers': activity['new_customers'].astype(int).tolist()
             },
             'returning_customers': {
-                'month_year': ret_cust_cpm['month_year'].apply(lambda x: x.strftime('%b-%y')).tolist(),
-                'n_customers': ret_cust_cpm['count'].astype(int).tolist()
+                'month_year': month_year,
+                'n_customers': activity['returning_customers'].astype(int).tolist()
             },
             'total_customers': {
-                'month_year': cust_cpm['month_year'].apply(lambda x: x.strftime('%b-%y')).tolist(),
-                'n_customers': cust_cpm['count'].astype(int).tolist()
+                'month_year': month_year,
+                'n_customers': activity['total_customers'].astype(int).tolist()
             }
         }
 
-        # Pad the list of returning customers with 0's for the first dates
-        if len(new_and_returning_customers_over_time['returning_customers']['month_year']) == 0:
-            new_and_returning_customers_over_time['returning_customers']['month_year'] = \
-                new_and_returning_customers_over_time['new_customers']['month_year']
-            new_and_returning_customers_over_time['returning_customers']['n_customers'] = \
-                ([0] * len(new_and_returning_customers_over_time['new_customers']['n_customers']))
-        else:
-            idx = 0
-            for idx, date in enumerate(new_and_returning_customers_over_time['new_customers']['month_year']):
-                if new_and_returning_customers_over_time['returning_customers']['month_year'][0] == date:
-                    break
-            if idx > 0:
-                new_and_returning_customers_over_time['returning_customers']['month_year'] = \
-                    new_and_returning_customers_over_time['new_customers']['month_year'][0:idx] \
-                    + new_and_returning_customers_over_time['returning_customers']['month_year']
-                new_and_returning_customers_over_time['returning_customers']['n_customers'] = \
-                    ([0] * idx) + new_and_returning_customers_over_time['returning_customers']['n_customers']
-
-        process_output_file = join(self.process_output_folder, 'out.pickle')
-
-        with open(process_output_file, "wb") as pickle_out:
-            pickle.dump(new_and_returning_customers_over_time, pickle_out, protocol=pickle.HIGHEST_PROTOCOL)
+        ResultBus.publish(self.process_output_folder, new_and_returning_customers_over_time)
 
         return new_and_returning_customers_over_time
 
     def plot(self, *args, **kwargs):
 
-        input_data_file = join(self.process_output_folder, 'out.pickle')
-
-        with open(input_data_file, 'rb') as handle:
-            data = pickle.load(handle)
+        data = ResultBus.load(self.process_output_folder)
 
         output_png_filename = join(self.plot_output_folder, 'new_returning_customers.png')
 
@@ -231,7 +185,8 @@ class NewAndReturningCustomers(Plugin):
             }
         }
 
-        pio.write_image(fig, output_png_filename, format='png', scale=2)
+        RenderService.write_image(fig, output_png_filename, format='png', scale=2)
+        RenderService.flush()
 
 
         """
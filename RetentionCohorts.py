@@ -4,16 +4,26 @@ from wepair.globals import COLNAMES_PE
 import pandas as pd
 import numpy as np
 import inspect
+from functools import lru_cache
 from os.path import join
-import matplotlib.pyplot as plt
-import seaborn as sns
-import pickle
-from reportlab.platypus import Image, Table
-from datetime import *
-from reportlab.lib import colors
-from ...utils.location import Location
-from ...utils.report import Report
+from .country_lookup import CountryLookup
 from wepair.utils_common.log import Log
+from .profiling import Profiler
+from .plot_scheduler import PlotScheduler, ChartJob
+from .figure_context import managed_figure
+from .customer_activity import cohort_counts
+from .date_tools import granularity_option, period_codes, period_starts, period_keys, period_labels
+from .result_bus import ResultBus
+from .plugin_hooks import instrument_plugin
+from .lazy_import import lazy_module, lazy_names
+
+# rendering libraries, imported on first use in plot() / report() (see lazy_import)
+sns = lazy_module('seaborn')
+plt = lazy_module('matplotlib.pyplot')
+mcolors = lazy_module('matplotlib.colors')
+Image, Table = lazy_names('reportlab.platypus', 'Image', 'Table')
+colors = lazy_module('reportlab.lib.colors')
+Report = lazy_names('...utils.report', 'Report', package=__package__)
 
 # log
 logger = Log(__name__).get_logger()
@@ -31,6 +41,11 @@ MERCHANT_NAME = COLNAMES_PE['Merchant Short Name']
 SHOP_COUNTRY = COLNAMES_PE['Merchant Country']
 SHOP_COUNTRY_NAME = 'SHOP_COUNTRY_NAME'
 
+# Number of cohorts (and of periods per cohort) displayed in the heatmaps
+COHORT_WINDOW = 13
+# Prefix of the period offsets on top of the heatmaps, per granularity
+OFFSET_PREFIXES = {'day': 'D+', 'week': 'W+', 'month': 'M+', 'quarter': 'Q+'}
+
 
 class RetentionCohorts(Plugin):
 
@@ -38,6 +53,7 @@ class RetentionCohorts(Plugin):
         self.plugin_name = "Retention cohorts"
         super().__init__(plugin_folder, id, options)
         self.required_input_data = ['tx.pickle', 'customers.pickle']
+        instrument_plugin(self)
 
     def process(self, *args, **kwargs):
 
@@ -56,9 +72,10 @@ class RetentionCohorts(Plugin):
                 group_filter = MERCHANT_NAME
             elif self.options['filter'] == 'shop country name':
                 group_filter = SHOP_COUNTRY_NAME
-                location = Location(self.options['assets'])
-                transactions['country_code'] = transactions[SHOP_COUNTRY].apply(location.get_country_iso3)
-                transactions[SHOP_COUNTRY_NAME] = transactions[SHOP_COUNTRY].apply(location.get_country_name)
+                countries = CountryLookup.from_options(self.options)
+                transactions = transactions.copy(deep=False)
+                transactions['country_code'] = countries.iso3(transactions[SHOP_COUNTRY])
+                transactions[SHOP_COUNTRY_NAME] = countries.names(transactions[SHOP_COUNTRY])
             else:
                 logger.warning('unknown filter option')
 
@@ -76,9 +93,6 @@ class RetentionCohorts(Plugin):
 
         cohort_data = {'has_data': True, 'cohorts': dict()}
 
-        # Extract the data of interest
-        transactions = transactions[necessary_keys]
-
         # Group by the filter
         list_of_filter = ['no filter']
         if group_filter:
@@ -86,207 +100,172 @@ class RetentionCohorts(Plugin):
 
         for filter_idx, filter_value in enumerate(list_of_filter):
 
-            # Split the transaction set into gross sales and sales returns
+            # Extract the gross sales of the filter value (a single selection of the columns of interest)
             if group_filter:
-                gross_sales_txs = transactions[transactions[TRANSACTION_IS_CAPTURE]
-                                               & (transactions[group_filter] == filter_value)]
+                is_gross_sale = transactions[TRANSACTION_IS_CAPTURE] & (transactions[group_filter] == filter_value)
             else:
-                gross_sales_txs = transactions[transactions[TRANSACTION_IS_CAPTURE]]
+                is_gross_sale = transactions[TRANSACTION_IS_CAPTURE]
+            gross_sales_txs = transactions.loc[is_gross_sale, [TRANSACTION_DATE, AMOUNT_IN_EUR, CUSTOMER_ID]]
 
             if len(gross_sales_txs) == 0:
                 continue
 
-            cohort_data['cohorts'][filter_idx] = dict()
-            cohort_data['cohorts'][filter_idx]["filter_value"] = filter_value
-
-            gross_sales_txs = gross_sales_txs[[TRANSACTION_DATE, AMOUNT_IN_EUR, CUSTOMER_ID]].copy()
-
-            cust = customers[[CUSTOMER_ID, FIRST_TRANSACTION_DATE]].copy()
-
-            months = pd.date_range(gross_sales_txs[TRANSACTION_DATE].min().date(),
-                                   gross_sales_txs[TRANSACTION_DATE].max().date(),
-                                   freq='M')
-            gross_sales_txs[TRANSACTION_DATE] = gross_sales_txs[TRANSACTION_DATE].apply(
-                lambda x: str(x.month) + '-' + str(x.year))
-            cust[FIRST_TRANSACTION_DATE] = cust[FIRST_TRANSACTION_DATE].apply(
-                lambda x: str(x.month) + '-' + str(x.year))
-
-            months = [m.to_pydatetime() for m in months]
-            months = [str(m.month) + '-' + str(m.year) for m in months]
-
-            for i, month in enumerate(months):
-                logger.info('{fct_name}: Computing cohort for the month: {month}'
-                             .format(fct_name=inspect.stack()[0][3],
-                                     month=month))
-                cohort_name = 'M' + str(len(months) - 1 - i)
-                first_time_customers = set(cust[cust[FIRST_TRANSACTION_DATE] == month][CUSTOMER_ID].unique()) & \
-                                       set(gross_sales_txs[gross_sales_txs[TRANSACTION_DATE] == month][CUSTOMER_ID]
-                                           .unique())
-                cohort_data['cohorts'][filter_idx][cohort_name] = {
-                    'months': [month],
-                    'customers': [first_time_customers],
-                    'n_customers': len(first_time_customers),
-                    'percents': [1.0],
-                    'percents_cum': [1.0],
-                    'n_customers_per_month': [len(first_time_customers)]
+            Profiler.mark('Cohorts for the filter value: {value}'.format(value=filter_value), rows=len(gross_sales_txs))
+
+            # Periods (months by default) whose last day is covered by the gross sales
+            granularity = granularity_option(self.options)
+            first_period = int(period_codes(gross_sales_txs[TRANSACTION_DATE].min(), granularity))
+            last_day = gross_sales_txs[TRANSACTION_DATE].max().normalize()
+            last_period = int(period_codes(last_day, granularity))
+            if period_starts(last_period + 1, granularity) > last_day + pd.Timedelta(days=1):
+                last_period -= 1
+            n_months = max(last_period - first_period + 1, 0)
+            period_range = np.arange(first_period, first_period + n_months)
+            months = period_keys(period_range, granularity)
+
+            # Row i is the cohort of the customers who made their first purchase in months[i], column j the offset
+            # (in periods) from that first purchase
+            first_periods = pd.Series(period_codes(customers[FIRST_TRANSACTION_DATE], granularity),
+                                      index=customers[CUSTOMER_ID].values)
+            n_customers_per_month, n_repeat_cust = cohort_counts(gross_sales_txs[CUSTOMER_ID],
+                                                                 gross_sales_txs[TRANSACTION_DATE], first_periods,
+                                                                 first_period, n_months, granularity)
+            n_customers = n_customers_per_month[:, 0].astype(int) if n_months else np.zeros(0, dtype=int)
+
+            cohort_sizes = np.maximum(n_customers, 1)[:, np.newaxis]
+            percents = np.where(n_customers[:, np.newaxis] > 0, n_customers_per_month / cohort_sizes,
+                                np.where(np.isnan(n_customers_per_month), np.nan, 0))
+            percents_cum = np.where(n_customers[:, np.newaxis] > 0, n_repeat_cust / cohort_sizes,
+                                    np.where(np.isnan(n_repeat_cust), np.nan, 0))
+            percents[:, :1] = 1.0
+            percents_cum[:, :1] = 1.0
+
+            # Only the last cohorts over their first months are displayed: keep that window as the result
+            cohort_data['cohorts'][filter_idx] = {
+                'filter_value': filter_value,
+                'granularity': granularity,
+                'months': months[-COHORT_WINDOW:],
+                'labels': period_labels(period_range[-COHORT_WINDOW:], granularity,
+                                        date_format='%b, %y' if granularity == 'month' else None),
+                'n_customers': n_customers[-COHORT_WINDOW:],
+                'percents': percents[-COHORT_WINDOW:, :COHORT_WINDOW],
+                'percents_cum': percents_cum[-COHORT_WINDOW:, :COHORT_WINDOW],
+                'n_customers_per_month': n_customers_per_month[-COHORT_WINDOW:, :COHORT_WINDOW]
+            }
+            if self.options.get('fullCohortMatrix', False):
+                cohort_data['cohorts'][filter_idx]['full'] = {
+                    'months': months,
+                    'n_customers': n_customers,
+                    'percents': percents,
+                    'percents_cum': percents_cum,
+                    'n_customers_per_month': n_customers_per_month
                 }
-                for next_month in months[i + 1:]:
-                    repeat_cust = set(
-                        gross_sales_txs[gross_sales_txs[TRANSACTION_DATE] == next_month][CUSTOMER_ID].unique()) & \
-                                  first_time_customers
-                    cohort_data['cohorts'][filter_idx][cohort_name]['customers'].append(repeat_cust)
-                    if len(first_time_customers) == 0:
-                        cohort_data['cohorts'][filter_idx][cohort_name]['percents'].append(0)
-                    else:
-                        cohort_data['cohorts'][filter_idx][cohort_name]['percents'].append(
-                            len(repeat_cust) / len(first_time_customers))
-                    cohort_data['cohorts'][filter_idx][cohort_name]['n_customers_per_month'].append(len(repeat_cust))
-                for j in range(i + 1, len(months)):
-                    repeat_cust = set()
-                    for k in range(j, len(months)):
-                        repeat_cust = repeat_cust | cohort_data['cohorts'][filter_idx][cohort_name]['customers'][k - i]
-                    if len(first_time_customers) == 0:
-                        cohort_data['cohorts'][filter_idx][cohort_name]['percents_cum'].append(0)
-                    else:
-                        cohort_data['cohorts'][filter_idx][cohort_name]['percents_cum'].append(
-                            len(repeat_cust) / len(first_time_customers))
-                del cohort_data['cohorts'][filter_idx][cohort_name]['customers']
-
-        process_output_file = join(self.process_output_folder, 'out.pickle')
-        with open(process_output_file, "wb") as pickle_out:
-            pickle.dump(cohort_data, pickle_out, protocol=pickle.HIGHEST_PROTOCOL)
 
-        return cohort_data
+        Profiler.mark('Save the results')
+        ResultBus.publish(self.process_output_folder, cohort_data)
 
-    def plot(self, *args, **kwargs):
-
-        sns.set()
-        sns.set_style("white")
-
-        # Load the data
-        input_data_file = join(self.process_output_folder, 'out.pickle')
-        with open(input_data_file, 'rb') as handle:
-            data = pickle.load(handle)
-
-        n_plots = len(data['cohorts'])
-
-        # Plot the normal cohort
-        for plot_idx in range(n_plots):
-
-            output_png_filename = join(self.plot_output_folder, 'out_monthly_{idx}.png'.format(idx=plot_idx))
-
-            n_months = len(data['cohorts'][plot_idx].keys()) - 1
-
-            cohort = np.empty((n_months, n_months))
-            months = list()
-            cohort[:] = np.nan
-            for idx, month in enumerate([elem for elem in data['cohorts'][plot_idx].keys() if elem != "filter_value"]):
-                months.append(data['cohorts'][plot_idx][month]['months'][0])
-                for idx2, percents in enumerate(data['cohorts'][plot_idx][month]['percents']):
-                    cohort[idx, idx2] = percents * 100
-            cohort = cohort[-13:, :13]
+        return cohort_data
 
-            plt.rcParams['xtick.labeltop'] = True
-            plt.rcParams['xtick.labelbottom'] = False
-            _, _ = plt.subplots(figsize=(10, 10))
+    # Cohort views: output file prefix, cohort key, scale factor, palette, suffix of the annotations, x labels size
+    COHORT_VIEWS = {
+        'monthly': ('out_monthly', 'percents', 100, 'blues-cohort-monthly', '%', 12),
+        'cumul': ('out_cumul', 'percents_cum', 100, 'blues-cohort-cumulative', '%', 12),
+        'ncust': ('out_ncust', 'n_customers_per_month', 1, 'blues-heatmap', '', 35),
+    }
+
+    @staticmethod
+    @lru_cache(maxsize=1)
+    def _cohort_rc():
+        """Layout shared by the three views: seaborn "white" theme with the month offsets on top."""
+        cohort_rc = dict(sns.plotting_context('notebook'), **sns.axes_style('white'))
+        cohort_rc.update({'xtick.labeltop': True, 'xtick.labelbottom': False})
+        return cohort_rc
+
+    @staticmethod
+    def _draw_cohort_heatmap(ax, cohort, palette, suffix, fontsize, offset_prefix='M+'):
+        """Annotated heatmap of a cohort window, drawn directly with pcolormesh (same look as sns.heatmap)."""
+        if isinstance(palette, str):
+            palette = plt.get_cmap(palette)
+        elif not isinstance(palette, mcolors.Colormap):
+            palette = mcolors.ListedColormap(palette)
+
+        n_rows, n_cols = cohort.shape
+        norm = mcolors.Normalize(vmin=np.nanmin(cohort), vmax=np.nanmax(cohort))
+        mesh = ax.pcolormesh(np.ma.masked_invalid(cohort), cmap=palette, norm=norm, edgecolors='white',
+                             linewidth=1.2)
+
+        # Annotations: values, labels and text colors (dark text on light cells) are computed for all cells at once
+        rows, cols = np.nonzero(~np.isnan(cohort))
+        values = cohort[rows, cols]
+        rgb = mesh.cmap(norm(values))[:, :3]
+        rgb = np.where(rgb <= .03928, rgb / 12.92, ((rgb + .055) / 1.055) ** 2.4)
+        text_colors = np.where(rgb.dot([.2126, .7152, .0722]) > .408, '.15', 'w')
+        labels = ['{:0,.0f}'.format(value) + suffix for value in values]
+        for x, y, label, color in zip(cols + .5, rows + .5, labels, text_colors):
+            ax.text(x, y, label, ha='center', va='center', color=color)
+
+        ax.set(xlim=(0, n_cols), ylim=(0, n_rows))
+        ax.invert_yaxis()
+        for spine in ax.spines.values():
+            spine.set_visible(False)
+        ax.set_xticks(np.arange(n_cols) + .5)
+        ax.set_xticklabels([offset_prefix + str(x) for x in range(n_cols)], rotation='horizontal', fontsize=fontsize)
+        ax.set_yticks([])
+        ax.xaxis.tick_top()
+        ax.xaxis.set_label_position('top')
+
+    @staticmethod
+    def _plot_cohort(data, plot_idx, view, cmap, output_png_filename):
+
+        _, key, factor, palette, suffix, fontsize = RetentionCohorts.COHORT_VIEWS[view]
+
+        cohort = data['cohorts'][plot_idx][key] * factor
+        offset_prefix = OFFSET_PREFIXES[data['cohorts'][plot_idx].get('granularity', 'month')]
+
+        with managed_figure(figsize=(10, 10), rc=RetentionCohorts._cohort_rc()) as fig:
+            ax = fig.subplots()
+            if cohort.size:
+                RetentionCohorts._draw_cohort_heatmap(ax, cohort, cmap['palettes'][palette], suffix, fontsize,
+                                                      offset_prefix)
 
-            ax = sns.heatmap(cohort, annot=True, linewidths=1.2, fmt='0,.0f', cbar=False, cmap=kwargs['cmap']['palettes']['blues-cohort-monthly'])
-            for t in ax.texts:
-                t.set_text(t.get_text() + "%")
+            # Save the results
+            fig.savefig(output_png_filename, bbox_inches='tight', dpi=300)
 
-            # labels = [datetime.strptime(x, "%m-%Y") for x in months]
-            # labels = [datetime.strftime(x, "%b, %Y") for x in labels]
-            ax.set_xticklabels(["M+" + str(x) for x in range(13)], rotation='horizontal', fontsize=12)
-            ax.set_yticklabels([])
-            ax.xaxis.tick_top()
-            ax.xaxis.set_label_position('top')
+    def plot_jobs(self, *args, **kwargs):
 
-            # Save the results
-            plt.savefig(output_png_filename, bbox_inches='tight', dpi=300)
-            # plt.show()
-
-        # Plot the cumulative cohort
-        for plot_idx in range(n_plots):
-
-            output_png_filename = join(self.plot_output_folder, 'out_cumul_{idx}.png'.format(idx=plot_idx))
-
-            n_months = len(data['cohorts'][plot_idx].keys()) - 1
-
-            cohort = np.empty((n_months, n_months))
-            months = list()
-            cohort[:] = np.nan
-            for idx, month in enumerate([elem for elem in data['cohorts'][plot_idx].keys() if elem != "filter_value"]):
-                months.append(data['cohorts'][plot_idx][month]['months'][0])
-                for idx2, percents_cum in enumerate(data['cohorts'][plot_idx][month]['percents_cum']):
-                    cohort[idx, idx2] = percents_cum * 100
-            cohort = cohort[-13:, :13]
-            plt.rcParams['xtick.labeltop'] = True
-            plt.rcParams['xtick.labelbottom'] = False
-            _, _ = plt.subplots(figsize=(10, 10))
-
-            ax = sns.heatmap(cohort, annot=True, linewidths=1.2, fmt='0,.0f', cbar=False, cmap=kwargs['cmap']['palettes']['blues-cohort-cumulative'])
-            for t in ax.texts:
-                t.set_text(t.get_text() + "%")
-
-            # labels = [datetime.strptime(x, "%m-%Y") for x in months]
-            # labels = [datetime.strftime(x, "%b, %Y") for x in labels]
-            ax.set_xticklabels(["M+" + str(x) for x in range(13)], rotation='horizontal', fontsize=12)
-            ax.set_yticklabels([])
-            ax.xaxis.tick_top()
-            ax.xaxis.set_label_position('top')
+        # Load the data
+        input_data_file = ResultBus.result_file(self.process_output_folder)
+        data = ResultBus.load_file(input_data_file)
+
+        # One chart per view (normal, cumulative, number of customers) and per filter value
+        jobs = []
+        for view, (prefix, _, _, _, _, _) in self.COHORT_VIEWS.items():
+            for plot_idx in data['cohorts']:
+                chart_name = '{prefix}_{idx}'.format(prefix=prefix, idx=plot_idx)
+                jobs.append(ChartJob(self.plugin_name, chart_name, self._plot_cohort, input_data_file,
+                                     (plot_idx, view, kwargs['cmap'],
+                                      join(self.plot_output_folder, chart_name + '.png'))))
+        return jobs
 
-            # Save the results
-            plt.savefig(output_png_filename, bbox_inches='tight', dpi=300)
-            # plt.show()
-
-        # Plot the number of customer for each month of the cohort
-        for plot_idx in range(n_plots):
-
-            output_png_filename = join(self.plot_output_folder, 'out_ncust_{idx}.png'.format(idx=plot_idx))
-
-            n_months = len(data['cohorts'][plot_idx].keys()) - 1
-
-            cohort = np.empty((n_months, n_months))
-            months = list()
-            cohort[:] = np.nan
-            for idx, month in enumerate(
-                    [elem for elem in data['cohorts'][plot_idx].keys() if elem != "filter_value"]):
-                months.append(data['cohorts'][plot_idx][month]['months'][0])
-                for idx2, n_customers_per_month in enumerate(data['cohorts'][plot_idx][month]['n_customers_per_month']):
-                    cohort[idx, idx2] = n_customers_per_month
-            cohort = cohort[-13:, :13]
-            _, _ = plt.subplots(figsize=(10, 10))
-
-            ax = sns.heatmap(cohort, annot=True, linewidths=1.2, fmt='0,.0f', cbar=False, cmap=kwargs['cmap']['palettes']['blues-heatmap'])
-            for t in ax.texts:
-                t.set_text(t.get_text())
-
-            # labels = [datetime.strptime(x, "%m-%Y") for x in months]
-            # labels = [datetime.strftime(x, "%b, %Y") for x in labels]
-            ax.set_xticklabels(["M+" + str(x) for x in range(13)], rotation='horizontal', fontsize=35)
-            ax.set_yticklabels([])
-            ax.xaxis.tick_top()
-            ax.xaxis.set_label_position('top')
+    def plot(self, *args, **kwargs):
+        PlotScheduler.run_jobs(self.plot_jobs(*args, **kwargs))
 
-            # Save the results
-            plt.savefig(output_png_filename, bbox_inches='tight', dpi=300)
-            # plt.show()
+    @staticmethod
+    def _cohort_table_rows(cohort):
+        """Rows (month of the cohort, number of new customers) printed next to the heatmap."""
+        return [[label, "{:,}".format(n_customers), '']
+                for label, n_customers in zip(cohort['labels'], cohort['n_customers'])]
 
     def report(self, report, styles, *args, **kwargs):
 
-        input_data_file = join(self.process_output_folder, 'out.pickle')
-
-        with open(input_data_file, 'rb') as handle:
-            data = pickle.load(handle)
+        data = ResultBus.load(self.process_output_folder)
 
         if 'printMonthlyCohort' in kwargs['options'] and kwargs['options']['printMonthlyCohort']:
             #Report.add_new_page(config=kwargs['config'], doc=report)
             Report.draw_text_right(report, 'RETENTION COHORTS ', styles['Heading2-White'])
 
-            n_plots = len(data['cohorts'])
-
             # For the monthly cohort
-            for plot_idx in range(n_plots):
+            for plot_idx in data['cohorts']:
 
                 if data['cohorts'][plot_idx]["filter_value"] != "no filter":
                     Report.draw_text_right(report, 'Monthly cohorts for {filter}: Percentage of customers '
@@ -301,15 +280,7 @@ class RetentionCohorts(Plugin):
                             width=410,
                             height=414)
 
-                data_list = list()
-
-                for index, month in enumerate([elem for elem in data['cohorts'][plot_idx].keys()
-                                               if elem != "filter_value"]):
-                    if month in data['cohorts'][plot_idx]:
-                        data_list.append([datetime.strftime(datetime.strptime(
-                            data['cohorts'][plot_idx][month]['months'][0], "%m-%Y"), "%b, %y"),
-                            "{:,}".format(data['cohorts'][plot_idx][month]['n_customers']), ''])
-                data_list = data_list[-13:]
+                data_list = self._cohort_table_rows(data['cohorts'][plot_idx])
                 data_table = [['', '# New cust.', img]] + data_list
                 table = Table(data_table, hAlign='CENTER', vAlign='MIDDLE', rowHeights=30)
                 table.setStyle(
@@ -344,7 +315,7 @@ class RetentionCohorts(Plugin):
             Report.add_new_page(config=kwargs['config'], doc=report)
             Report.draw_text_right(report, 'RETENTION COHORTS', styles['Heading2-White'])
 
-            for plot_idx in range(n_plots):
+            for plot_idx in data['cohorts']:
 
                 if data['cohorts'][plot_idx]["filter_value"] != "no filter":
                     Report.draw_text_right(report, 'Cumulative cohorts for {filter}: Percentage of customers '
@@ -360,15 +331,7 @@ class RetentionCohorts(Plugin):
                             width=410,
                             height=414)
 
-                data_list = list()
-
-                for index, month in enumerate(
-                        [elem for elem in data['cohorts'][plot_idx].keys() if elem != "filter_value"]):
-                    if month in data['cohorts'][plot_idx]:
-                        data_list.append([datetime.strftime(datetime.strptime(
-                            data['cohorts'][plot_idx][month]['months'][0], "%m-%Y"), "%b, %y"),
-                            "{:,}".format(data['cohorts'][plot_idx][month]['n_customers']), ''])
-                data_list = data_list[-13:]
+                data_list = self._cohort_table_rows(data['cohorts'][plot_idx])
                 data_table = [['', '# New cust.', img]] + data_list
                 table = Table(data_table, hAlign='CENTER', vAlign='MIDDLE', rowHeights=30)
                 table.setStyle(
@@ -403,10 +366,8 @@ class RetentionCohorts(Plugin):
             Report.add_new_page(config=kwargs['config'], doc=report)
             Report.draw_text_right(report, 'RETENTION COHORTS', styles['Heading2-White'])
 
-            n_plots = len(data['cohorts'])
-
             # For the ncust cohort
-            for plot_idx in range(n_plots):
+            for plot_idx in data['cohorts']:
                 if data['cohorts'][plot_idx]["filter_value"] != "no filter":
                     Report.draw_text_right(report, 'Cohort with number of customers for {filter}'.format(
                         filter=data['cohorts'][plot_idx]["filter_value"]), styles['Heading3-White'], bias=10)
@@ -418,15 +379,7 @@ class RetentionCohorts(Plugin):
                             width=410,
                             height=414)
 
-                data_list = list()
-
-                for index, month in enumerate(
-                        [elem for elem in data['cohorts'][plot_idx].keys() if elem != "filter_value"]):
-                    if month in data['cohorts'][plot_idx]:
-                        data_list.append([datetime.strftime(datetime.strptime(
-                            data['cohorts'][plot_idx][month]['months'][0], "%m-%y"), "%b, %y"),
-                            "{:,}".format(data['cohorts'][plot_idx][month]['n_customers']), ''])
-                data_list = data_list[-13:]
+                data_list = self._cohort_table_rows(data['cohorts'][plot_idx])
                 data_table = [['', '# New cust.', img]] + data_list
                 table = Table(data_table, hAlign='CENTER', vAlign='MIDDLE', rowHeights=30)
                 table.setStyle(
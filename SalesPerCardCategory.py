@@ -6,21 +6,23 @@ Created on Fri Jul 19 12:41:37 2019
 """
 
 from wepair.plugins.plugin import Plugin
-import pandas as pd
 from ...globals import COLNAMES_PE
 from os.path import join
-import pickle
-import plotly.io as pio
-from reportlab.platypus import Paragraph, Image, Table, TableStyle
-from ...utils.report import Report
+from itertools import chain
+from .render_service import RenderService
+from .sales_tools import SalesAggregator, transaction_chunks
+from .result_bus import ResultBus
+from .plugin_hooks import instrument_plugin
 from wepair.utils_common.log import Log
+from .lazy_import import lazy_names
+
+# rendering libraries, imported on first use in plot() / report() (see lazy_import)
+Paragraph, Image, Table, TableStyle = lazy_names('reportlab.platypus', 'Paragraph', 'Image', 'Table', 'TableStyle')
+Report = lazy_names('...utils.report', 'Report', package=__package__)
 
 # log
 logger = Log(__name__).get_logger()
 
-# orca config
-pio.orca.config.use_xvfb = 'auto'
-
 CARD_CATEGORY = COLNAMES_PE['Card Category']
 AMOUNT_IN_EUR = COLNAMES_PE['Amount in EUR']
 PAYMENT_METHOD = COLNAMES_PE['Payment Method']
@@ -37,6 +39,7 @@ class SalesPerCardCategory(Plugin):
         self.plugin_name = "Sales Per Card Category"
         super().__init__(plugin_folder, id, options)
         self.required_input_data = ['tx.pickle']
+        instrument_plugin(self)
 
     def process(self, *args, **kwargs):
         #initialize sales_per_card_category variable
@@ -51,20 +54,35 @@ class SalesPerCardCategory(Plugin):
             return sales_per_card_category
 
         args = list(args)
-        transactions = args[0]
+        # The transactions are consumed chunk by chunk (a single chunk unless the chunkSize option is set)
+        chunks = transaction_chunks(args[0], self.options.get('chunkSize'))
+        transactions = next(chunks, None)
 
         necessary_keys = [CARD_CATEGORY, AMOUNT_IN_EUR, PAYMENT_METHOD, TRANSACTION_REF_ID, TRANSACTION_IS_CAPTURE,
                           TRANSACTION_IS_RETURN]
 
-        if not all(key in transactions.columns for key in necessary_keys):
+        if transactions is None or not all(key in transactions.columns for key in necessary_keys):
             return sales_per_card_category
 
         sales_per_card_category = {'has_data': True}
 
+        # Fold the card transactions into the gross sales, sales returns and net sales per card category
+        aggregator = SalesAggregator.from_options(CARD_CATEGORY, self.options, self.process_output_folder)
+        period_starts, period_ends = [], []
+        for chunk in chain([transactions], chunks):
+            period_starts.append(chunk[TRANSACTION_DATE].min())
+            period_ends.append(chunk[TRANSACTION_DATE].max())
+            aggregator.add(chunk[chunk[PAYMENT_METHOD] == 'CARD'])
+        del transactions
+        sales = aggregator.frame(key_normalizer=lambda keys: keys.fillna('Not available')
+                                 .replace(to_replace='nan', value='Not available')
+                                 .replace(to_replace='UnspecifiedCard', value='Unspecified Card'))
+        aggregator.close()
+
         # Obtaining the first and last date of the transcational data to print the time window
 
-        period_start = transactions[TRANSACTION_DATE].min()
-        period_end = transactions[TRANSACTION_DATE].max()
+        period_start = min(period_starts)
+        period_end = max(period_ends)
 
         begin_year = int(period_start.strftime('%Y'))
         end_year = int(period_end.strftime('%Y'))
@@ -80,82 +98,38 @@ class SalesPerCardCategory(Plugin):
 
         sales_per_card_category['time_period'] = text
 
-        # Extract the data of interest
-        transactions = transactions[transactions[PAYMENT_METHOD] == 'CARD']
-        transactions = transactions[[CARD_CATEGORY, AMOUNT_IN_EUR, TRANSACTION_REF_ID, TRANSACTION_IS_CAPTURE,
-                                     TRANSACTION_IS_RETURN]]
-
-
-        # Split the transaction set into gross sales and sales returns
-        gross_sales_txs = transactions[transactions[TRANSACTION_IS_CAPTURE]].copy()
-        gross_sales_txs['new_amount'] = gross_sales_txs.groupby(TRANSACTION_REF_ID)[AMOUNT_IN_EUR].transform('sum')
-        gross_sales_txs = gross_sales_txs.drop_duplicates(subset=[TRANSACTION_REF_ID], keep='first') \
-            .drop(AMOUNT_IN_EUR, axis=1) \
-            .rename(columns={'new_amount': AMOUNT_IN_EUR})
-
-        sales_returns_txs = transactions[transactions[TRANSACTION_IS_RETURN]].copy()
-        sales_returns_txs['new_amount'] = sales_returns_txs.groupby(TRANSACTION_REF_ID)[AMOUNT_IN_EUR].transform('sum')
-        sales_returns_txs = sales_returns_txs.drop_duplicates(subset=[TRANSACTION_REF_ID], keep='first') \
-            .drop(AMOUNT_IN_EUR, axis=1) \
-            .rename(columns={'new_amount': AMOUNT_IN_EUR})
-
-        net_sales_txs = pd.DataFrame()
-        if len(gross_sales_txs) > 0 and len(sales_returns_txs) > 0:
-            net_sales_txs = pd.merge(gross_sales_txs, sales_returns_txs[[TRANSACTION_REF_ID, AMOUNT_IN_EUR]],
-                                     on=TRANSACTION_REF_ID, how='left')
-            net_sales_txs.fillna(0, inplace=True)
-            net_sales_txs[AMOUNT_IN_EUR] = net_sales_txs[AMOUNT_IN_EUR + '_x'] - net_sales_txs[AMOUNT_IN_EUR + '_y']
-            net_sales_txs.drop([AMOUNT_IN_EUR + '_x', AMOUNT_IN_EUR + '_y'], axis=1, inplace=True)
-
         # Compute the gross sales per card category
         # ------------------------------------------------
-        if len(gross_sales_txs) > 0:
-            gross_sales = gross_sales_txs[[CARD_CATEGORY, AMOUNT_IN_EUR]].copy()
-            gross_sales[CARD_CATEGORY].fillna('Not available', inplace=True)
-            gross_sales[CARD_CATEGORY].replace(to_replace='nan', value='Not available', inplace=True)
-            gross_sales[CARD_CATEGORY].replace(to_replace='UnspecifiedCard', value='Unspecified Card', inplace=True)
-            gross_sales = gross_sales.groupby([CARD_CATEGORY]).sum()
-            gross_sales.reset_index(inplace=True)
+        if aggregator.has_captures:
+            gross_sales = sales['gross_sales'].dropna()
             sales_per_card_category.update({
-                'gross_sales': gross_sales[AMOUNT_IN_EUR].tolist(),
-                'gross_sales_card_category': gross_sales[CARD_CATEGORY].tolist()
+                'gross_sales': gross_sales.tolist(),
+                'gross_sales_card_category': gross_sales.index.tolist()
             })
             del gross_sales
 
         # Compute the sales returns per card category
         # ------------------------------------------------
-        if len(sales_returns_txs) > 0:
-            sales_returns = sales_returns_txs[[CARD_CATEGORY, AMOUNT_IN_EUR]].copy()
-            sales_returns[CARD_CATEGORY].fillna('Not available', inplace=True)
-            sales_returns[CARD_CATEGORY].replace(to_replace='nan', value='Not available', inplace=True)
-            sales_returns[CARD_CATEGORY].replace(to_replace='UnspecifiedCard', value='Unspecified Card', inplace=True)
-            sales_returns = sales_returns.groupby([CARD_CATEGORY]).sum()
-            sales_returns.reset_index(inplace=True)
+        if aggregator.has_returns:
+            sales_returns = sales['sales_returns'].dropna()
             sales_per_card_category.update({
-                'sales_returns': sales_returns[AMOUNT_IN_EUR].tolist(),
-                'sales_returns_card_category': sales_returns[CARD_CATEGORY].tolist()
+                'sales_returns': sales_returns.tolist(),
+                'sales_returns_card_category': sales_returns.index.tolist()
             })
             del sales_returns
 
         # Compute the net sales per card category
         # ------------------------------------------------
-        if len(net_sales_txs) > 0:
-            net_sales = net_sales_txs[[CARD_CATEGORY, AMOUNT_IN_EUR]].copy()
-            net_sales[CARD_CATEGORY].fillna('Not available', inplace=True)
-            net_sales[CARD_CATEGORY].replace(to_replace='nan', value='Not available', inplace=True)
-            net_sales[CARD_CATEGORY].replace(to_replace='UnspecifiedCard', value='Unspecified Card', inplace=True)
-            net_sales = net_sales.groupby([CARD_CATEGORY]).sum()
-            net_sales.reset_index(inplace=True)
+        if aggregator.has_captures and aggregator.has_returns:
+            net_sales = sales['net_sales'].dropna()
             sales_per_card_category.update({
-                'net_sales': net_sales[AMOUNT_IN_EUR].tolist(),
-                'net_sales_card_category': net_sales[CARD_CATEGORY].tolist()
+                'net_sales': net_sales.tolist(),
+                'net_sales_card_category': net_sales.index.tolist()
             })
             del net_sales
+        del sales
 
-        process_output_file = join(self.process_output_folder, 'out.pickle')
-
-        with open(process_output_file, "wb") as pickle_out:
-            pickle.dump(sales_per_card_category, pickle_out, protocol=pickle.HIGHEST_PROTOCOL)
+        ResultBus.publish(self.process_output_folder, sales_per_card_category)
 
         return sales_per_card_category
 
@@ -163,10 +137,7 @@ class SalesPerCardCategory(Plugin):
 #part for plotting the output
     def plot(self, *args, **kwargs):
 
-        input_data_file = join(self.process_output_folder, 'out.pickle')
-
-        with open(input_data_file, 'rb') as handle:
-            data = pickle.load(handle)
+        data = ResultBus.load(self.process_output_folder)
 
         # same color per type of payment pls
         id_color_dict = {}
@@ -233,14 +204,12 @@ class SalesPerCardCategory(Plugin):
                     }
                 }
             }
-            pio.write_image(fig, join(self.plot_output_folder, data_source + '_per_card_category.png'))
+            RenderService.write_image(fig, join(self.plot_output_folder, data_source + '_per_card_category.png'))
+        RenderService.flush()
 
     def report(self, report, styles, *args, **kwargs):
 
-        input_data_file = join(self.process_output_folder, 'out.pickle')
-
-        with open(input_data_file, 'rb') as handle:
-            data = pickle.load(handle)
+        data = ResultBus.load(self.process_output_folder)
 
         img_height = 250
         img_width = 250
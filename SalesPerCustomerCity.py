@@ -7,20 +7,24 @@ Created on Mon Jul 22 08:17:11 2019
 from wepair.plugins.plugin import Plugin
 from ...globals import COLNAMES_PE
 from os.path import join
-import pandas as pd
-import pickle
 import inspect
-from reportlab.platypus import Image
-import plotly.io as pio
-from ...utils.report import Report
+import pandas as pd
+from itertools import chain
+from .render_service import RenderService
+from .sales_tools import SalesAggregator, ChunkReplay, top_sales_table, transaction_chunks, table_to_dict
+from .city_names import CityNames, UNKNOWN_CITY
+from .result_bus import ResultBus
+from .plugin_hooks import instrument_plugin
 from wepair.utils_common.log import Log
+from .lazy_import import lazy_names
+
+# rendering libraries, imported on first use in plot() / report() (see lazy_import)
+Image = lazy_names('reportlab.platypus', 'Image')
+Report = lazy_names('...utils.report', 'Report', package=__package__)
 
 # log
 logger = Log(__name__).get_logger()
 
-# orca config
-pio.orca.config.use_xvfb = 'auto'
-
 TRANSACTION_DATE = COLNAMES_PE['Transaction Creation Date and Time']
 CONSUMER_CITY = COLNAMES_PE['City (Consumer Address)']
 AMOUNT_IN_EUR = COLNAMES_PE['Amount in EUR']
@@ -28,6 +32,8 @@ TRANSACTION_IS_CAPTURE = COLNAMES_PE['Is capture']
 TRANSACTION_IS_RETURN = COLNAMES_PE['Is return']
 TRANSACTION_REF_ID = COLNAMES_PE['Transaction Reference ID']
 
+TOP_K_CHUNK_SIZE = 10 ** 6
+
 
 class SalesPerCustomerCity(Plugin):
 
@@ -35,6 +41,7 @@ class SalesPerCustomerCity(Plugin):
         self.plugin_name = "Sales Per Customer City"
         super().__init__(plugin_folder, id, options)
         self.required_input_data = ['tx.pickle']
+        instrument_plugin(self)
 
     def process(self, *args, **kwargs):
         sales_per_customer_city = {'has_data': False}
@@ -50,149 +57,86 @@ class SalesPerCustomerCity(Plugin):
 
         necessary_keys = [CONSUMER_CITY, AMOUNT_IN_EUR, TRANSACTION_REF_ID, TRANSACTION_IS_CAPTURE, TRANSACTION_IS_RETURN]
 
-        transactions = args[0]
+        # The transactions are consumed chunk by chunk (a single chunk unless the chunkSize option is set)
+        chunks = transaction_chunks(args[0], self.options.get('chunkSize'))
+        transactions = next(chunks, None)
 
-        if not all(key in transactions.columns for key in necessary_keys):
+        if transactions is None or not all(key in transactions.columns for key in necessary_keys):
             return sales_per_customer_city
 
         sales_per_customer_city = {'has_data': True}
 
-        # Extract the data of interest
-        columns_to_keep = [TRANSACTION_DATE, CONSUMER_CITY, AMOUNT_IN_EUR, TRANSACTION_REF_ID, TRANSACTION_IS_CAPTURE,
-                           TRANSACTION_IS_RETURN]
         if TRANSACTION_DATE not in transactions.columns:
             logger.warning('{fct_name}: There is no column TRANSACTION_DATE. '
                             'Plotting results for the net sales will not be possible.'
                             .format(fct_name=inspect.stack()[0][3]))
-            columns_to_keep.remove(TRANSACTION_DATE)
-        transactions = transactions[columns_to_keep]
-        
-        #this part of code can be done somewhere else maybe
-        # Split the transaction set into gross sales and sales returns
-        #copying the data where the transaction is capture
-        gross_sales_txs = transactions[transactions[TRANSACTION_IS_CAPTURE]].copy()
-        #grouping by transaction ref_id and summing amount_in_eur
-        gross_sales_txs['new_amount'] = gross_sales_txs.groupby(TRANSACTION_REF_ID)[AMOUNT_IN_EUR].transform('sum')
-        #leaving the unique records
-        gross_sales_txs = gross_sales_txs.drop_duplicates(subset=[TRANSACTION_REF_ID], keep='first') \
-            .drop(AMOUNT_IN_EUR, axis=1) \
-            .rename(columns={'new_amount': AMOUNT_IN_EUR})
-        #copying return transactions
-        sales_returns_txs = transactions[transactions[TRANSACTION_IS_RETURN]].copy()
-        #creating again new variable and calculating the sum of the amount in eur per transactionr ref_id
-        sales_returns_txs['new_amount'] = sales_returns_txs.groupby(TRANSACTION_REF_ID)[AMOUNT_IN_EUR].transform('sum')
-        sales_returns_txs = sales_returns_txs.drop_duplicates(subset=[TRANSACTION_REF_ID], keep='first') \
-            .drop(AMOUNT_IN_EUR, axis=1) \
-            .rename(columns={'new_amount': AMOUNT_IN_EUR})
-
-        net_sales_txs = pd.DataFrame()
-        #checking if there is a data within the datasets
-        if len(gross_sales_txs) > 0 and len(sales_returns_txs) > 0:
-        #then merge this two datasets
-            net_sales_txs = pd.merge(gross_sales_txs, sales_returns_txs[[TRANSACTION_REF_ID, AMOUNT_IN_EUR]],
-                                     on=TRANSACTION_REF_ID, how='left')
-            #if its empty, then fill with 0 
-            net_sales_txs.fillna(0, inplace=True)
-            #calculate the net sales by suptracting the left from right datasource
-            net_sales_txs[AMOUNT_IN_EUR] = net_sales_txs[AMOUNT_IN_EUR + '_x'] - net_sales_txs[AMOUNT_IN_EUR + '_y']
-            net_sales_txs.drop([AMOUNT_IN_EUR + '_x', AMOUNT_IN_EUR + '_y'], axis=1, inplace=True)
-
-        # Compute the gross sales per customer city
-        # ------------------------------------------------
-        logger.debug('{fct_name}: Computing the gross sales per customer city'.format(fct_name=inspect.stack()[0][3]))
-        if len(gross_sales_txs) > 0:
-            #first check if gross_sales_has_data variable has data
-            sales_per_customer_city['gross_sales_has_data'] = True
-            #create a new datasource with only two variables
-            gross_sales = gross_sales_txs[[CONSUMER_CITY, AMOUNT_IN_EUR]].copy()
-            #replace the Nan values with the Unknow
-            gross_sales[CONSUMER_CITY].replace(to_replace='Nan', value='Unknown', inplace=True)
-            #group all the sales by consumer city
-            gross_sales = gross_sales.groupby([CONSUMER_CITY]).sum()
-            #reset the index
-            gross_sales.reset_index(inplace=True)
-            #sort values
-            gross_sales.sort_values(by=[AMOUNT_IN_EUR], ascending=False, inplace=True)
-            #create a subset which will contain the records which do not have unknown consumer city
-            gross_sales_no_unknown = gross_sales[gross_sales[CONSUMER_CITY] != 'Unknown'].copy()
-            #sort this subset
-            gross_sales_no_unknown.sort_values(by=[AMOUNT_IN_EUR], ascending=False, inplace=True)
-            #update the names of the variables within the dataset
-            sales_per_customer_city.update({
-                'gross_sales': gross_sales[AMOUNT_IN_EUR].tolist(),
-                'gross_sales_city_name': gross_sales[CONSUMER_CITY].tolist(),
-                'gross_sales_no_unknown': gross_sales_no_unknown[AMOUNT_IN_EUR].tolist(),
-                'gross_sales_city_name_no_unknown': gross_sales_no_unknown[CONSUMER_CITY].tolist()
-            })
-            del gross_sales
-
-        # Compute the sales returns per customer city
-        # ------------------------------------------------
-        logger.debug('{fct_name}: Computing the sales returns per customer city'.format(fct_name=inspect.stack()[0][3]))
-        if len(sales_returns_txs) > 0:
-            sales_per_customer_city['sales_returns_has_data'] = True
-            sales_returns = sales_returns_txs[[CONSUMER_CITY, AMOUNT_IN_EUR]].copy()
-            sales_returns[CONSUMER_CITY].replace(to_replace='Nan', value='Unknown', inplace=True)
-            sales_returns = sales_returns.groupby([CONSUMER_CITY]).sum()
-            sales_returns.reset_index(inplace=True)
-            sales_returns.sort_values(by=[AMOUNT_IN_EUR], ascending=False, inplace=True)
-            sales_returns_no_unknown = sales_returns[sales_returns[CONSUMER_CITY] != 'Unknown'].copy()
-            sales_returns_no_unknown.sort_values(by=[AMOUNT_IN_EUR], ascending=False, inplace=True)
-            sales_per_customer_city.update({
-                'sales_returns': sales_returns[AMOUNT_IN_EUR].tolist(),
-                'sales_returns_city_name': sales_returns[CONSUMER_CITY].tolist(),
-                'sales_returns_no_unknown': sales_returns_no_unknown[AMOUNT_IN_EUR].tolist(),
-                'sales_returns_city_name_no_unknown': sales_returns_no_unknown[CONSUMER_CITY].tolist()
-            })
-            del sales_returns
-
-        # Compute the net sales per customer city
+
+        # Compute the gross sales, sales returns and net sales per customer city
         # ------------------------------------------------
-        logger.debug('{fct_name}: Computing the net sales per customer city'.format(fct_name=inspect.stack()[0][3]))
-        if len(net_sales_txs) > 0:
-            sales_per_customer_city['net_sales_has_data'] = True
-            #selecting only the variables which are important for the creation of the net sales subset
-            net_sales = net_sales_txs[[CONSUMER_CITY, AMOUNT_IN_EUR]].copy()
-            net_sales[CONSUMER_CITY].replace(to_replace='Nan', value='Unknown', inplace=True)
-            net_sales = net_sales.groupby([CONSUMER_CITY]).sum()
-            #the data is renamed in place (it returns nothing)
-            net_sales.reset_index(inplace=True)
-            net_sales.sort_values(by=[AMOUNT_IN_EUR], ascending=False, inplace=True)
-            net_sales_no_unknown = net_sales[net_sales[CONSUMER_CITY] != 'Unknown'].copy()
-            net_sales_no_unknown.sort_values(by=[AMOUNT_IN_EUR], ascending=False, inplace=True)
-            # Sort the list of net sales according to the sorted list of gross sales
-            gross_city_list = sales_per_customer_city['gross_sales_city_name_no_unknown']
-            net_city_list = net_sales_no_unknown[CONSUMER_CITY].tolist()
-            idx = list([gross_city_list.index(city) for city in net_city_list if city in gross_city_list])
-            net_list = list([x for _, x in sorted(zip(idx, net_sales_no_unknown[AMOUNT_IN_EUR].tolist()),
-                                                  key=lambda pair: pair[0])])
-            sales_per_customer_city.update({'net_sales_no_unknown': net_list})
-            del net_sales
-
-        process_output_file = join(self.process_output_folder, 'out.pickle')
-
-        with open(process_output_file, "wb") as pickle_out:
-            pickle.dump(sales_per_customer_city, pickle_out, protocol=pickle.HIGHEST_PROTOCOL)
+        logger.debug('{fct_name}: Computing the sales per customer city'.format(fct_name=inspect.stack()[0][3]))
+        # The cities are grouped on the code of their canonical name (see CityNames), translated back at the end
+        city_dictionary = self.options.get('cityDictionary')
+
+        def canonical_city_codes(cities):
+            return CityNames.codes(cities, city_dictionary)
+
+        # With the topK option, only the top K cities are ranked (Space-Saving sketch over chunks) and aggregated; one
+        # more city is kept since 'Unknown' is not plotted. The chunks of an input that is not a frame are spilled to
+        # disk on the first pass, to be read again (ChunkReplay)
+        if self.options.get('topK'):
+            source = args[0] if isinstance(args[0], pd.DataFrame) else chain([transactions], chunks)
+            replay = ChunkReplay(source, self.options.get('chunkSize') or TOP_K_CHUNK_SIZE,
+                                 join(self.process_output_folder, 'top_k_chunks'), necessary_keys)
+            sales, bounds = top_sales_table(replay, CONSUMER_CITY, int(self.options['topK']) + 1,
+                                            key_normalizer=canonical_city_codes)
+            bounds.index = CityNames.names(bounds.index, city_dictionary)
+            sales_per_customer_city['top_k_bounds'] = table_to_dict(bounds, 'city_name')
+            has_captures, has_returns = replay.has_captures, replay.has_returns
+            replay.close()
+        else:
+            aggregator = SalesAggregator.from_options(CONSUMER_CITY, self.options, self.process_output_folder)
+            for chunk in chain([transactions], chunks):
+                aggregator.add(chunk)
+            sales = aggregator.table(key_normalizer=canonical_city_codes)
+            has_captures, has_returns = aggregator.has_captures, aggregator.has_returns
+            aggregator.close()
+        del transactions
+        sales.index = CityNames.names(sales.index, city_dictionary)
+        sales_per_customer_city.update({
+            'gross_sales_has_data': has_captures,
+            'sales_returns_has_data': has_returns,
+            'net_sales_has_data': has_captures and has_returns,
+            'sales_table': table_to_dict(sales, 'city_name')
+        })
+        del sales
+
+        ResultBus.publish(self.process_output_folder, sales_per_customer_city)
 
         return sales_per_customer_city
 
     def plot(self, *args, **kwargs):
 
-        input_data_file = join(self.process_output_folder, 'out.pickle')
-
-        with open(input_data_file, 'rb') as handle:
-            data = pickle.load(handle)
+        data = ResultBus.load(self.process_output_folder)
 
         output_png_filename = join(self.plot_output_folder, 'sales_per_customer_city.png')
 
+        # Top 5 known cities by gross sales (the table is sorted by decreasing gross sales)
+        top_cities = [(city, gross, net) for city, gross, net in zip(data['sales_table']['city_name'],
+                                                                      data['sales_table']['gross_sales'],
+                                                                      data['sales_table']['net_sales'])
+                      if city != UNKNOWN_CITY][:5]
+        top_city_name = [city for city, _, _ in top_cities]
+        top_gross_sales = [gross for _, gross, _ in top_cities]
+        top_net_sales = [net for _, _, net in top_cities]
+
         fig = {
             "data": [
                 {
                     "type": "bar",
                     "orientation": "h",
-                    "x": data['gross_sales_no_unknown'][:5],
-                    "y": data['gross_sales_city_name_no_unknown'][:5],
-                    "text": list(map(lambda x: '{:0,.0f}€'.format(x), data['gross_sales_no_unknown'][:5])),
+                    "x": top_gross_sales,
+                    "y": top_city_name,
+                    "text": list(map(lambda x: '{:0,.0f}€'.format(x), top_gross_sales)),
                     "textposition": "outside",
                     "textfont": {
                         "color": kwargs['cmap']['colors']['night blue'],
@@ -207,9 +151,9 @@ class SalesPerCustomerCity(Plugin):
                 {
                     "type": "bar",
                     "orientation": "h",
-                    "x": data['net_sales_no_unknown'][:5],
-                    "y": data['gross_sales_city_name_no_unknown'][:5],
-                    "text": list(map(lambda x: '{:0,.0f}€'.format(x), data['net_sales_no_unknown'][:5])),
+                    "x": top_net_sales,
+                    "y": top_city_name,
+                    "text": list(map(lambda x: '{:0,.0f}€'.format(x), top_net_sales)),
                     "textposition": "outside",
                     "textfont": {
                         "color": kwargs['cmap']['colors']['night blue'],
@@ -272,7 +216,8 @@ class SalesPerCustomerCity(Plugin):
                 "width": 2000
             }
         }
-        pio.write_image(fig, output_png_filename, format='png')
+        RenderService.write_image(fig, output_png_filename, format='png')
+        RenderService.flush()
 
     def report(self, report, styles, *args, **kwargs):
 
@@ -2,22 +2,24 @@
 
 from wepair.plugins.plugin import Plugin
 from ...globals import COLNAMES_PE
-from ...utils.location import Location
+from .country_lookup import CountryLookup
 from os.path import join
-import pandas as pd
-import pickle
 import inspect
-from reportlab.platypus import Image
-import plotly.io as pio
-from ...utils.report import Report
+from itertools import chain
+from .render_service import RenderService
+from .sales_tools import SalesAggregator, transaction_chunks
+from .result_bus import ResultBus
+from .plugin_hooks import instrument_plugin
 from wepair.utils_common.log import Log
+from .lazy_import import lazy_names
+
+# rendering libraries, imported on first use in plot() / report() (see lazy_import)
+Image = lazy_names('reportlab.platypus', 'Image')
+Report = lazy_names('...utils.report', 'Report', package=__package__)
 
 # log
 logger = Log(__name__).get_logger()
 
-# orca config
-pio.orca.config.use_xvfb = 'auto'
-
 TRANSACTION_DATE = COLNAMES_PE['Transaction Creation Date and Time']
 CONSUMER_COUNTRY = COLNAMES_PE['Country (Consumer Address)']
 AMOUNT_IN_EUR = COLNAMES_PE['Amount in EUR']
@@ -32,6 +34,7 @@ class SalesPerCustomerCountry(Plugin):
         self.plugin_name = "Sales Per Customer Country"
         super().__init__(plugin_folder, id, options)
         self.required_input_data = ['tx.pickle']
+        instrument_plugin(self)
 
     def process(self, *args, **kwargs):
 
@@ -44,65 +47,37 @@ class SalesPerCustomerCountry(Plugin):
             logger.warning('Fatal Error: Plugin Sales Per Customer Country: Transaction data Missing')
             return sales_per_customer_country
 
-        location = Location(self.options['assets'])
+        location = CountryLookup.from_options(self.options).location
 
-        transactions = args[0]
+        # The transactions are consumed chunk by chunk (a single chunk unless the chunkSize option is set)
+        chunks = transaction_chunks(args[0], self.options.get('chunkSize'))
+        transactions = next(chunks, None)
 
         necessary_keys = [CONSUMER_COUNTRY, AMOUNT_IN_EUR, TRANSACTION_REF_ID,
                           TRANSACTION_IS_CAPTURE, TRANSACTION_IS_RETURN]
-        if not all(key in transactions.columns for key in necessary_keys):
+        if transactions is None or not all(key in transactions.columns for key in necessary_keys):
             return sales_per_customer_country
 
         sales_per_customer_country = {'has_data': True}
 
-        # Extract the data of interest
-        
-        columns_to_keep = [TRANSACTION_DATE, CONSUMER_COUNTRY, AMOUNT_IN_EUR, TRANSACTION_REF_ID,
-                           TRANSACTION_IS_CAPTURE, TRANSACTION_IS_RETURN]
         if TRANSACTION_DATE not in transactions.columns:
             logger.warning('{fct_name}: There is no column TRANSACTION_DATE. '
                             'Plotting results for the net sales will not be possible.'
                             .format(fct_name=inspect.stack()[0][3]))
-            #removing only one attribute from the dataset above
-            columns_to_keep.remove(TRANSACTION_DATE)
-            #transactions should be 
-        transactions = transactions[columns_to_keep]
-
-        # Split the transaction set into gross sales and sales returns
-        gross_sales_txs = transactions[transactions[TRANSACTION_IS_CAPTURE]].copy()
-        #sum amount in euros by transaction ref_id
-        gross_sales_txs['new_amount'] = gross_sales_txs.groupby(TRANSACTION_REF_ID)[AMOUNT_IN_EUR].transform('sum')
-        gross_sales_txs = gross_sales_txs.drop_duplicates(subset=[TRANSACTION_REF_ID], keep='first') \
-            .drop(AMOUNT_IN_EUR, axis=1) \
-            .rename(columns={'new_amount': AMOUNT_IN_EUR})
-            
-# creation of the variable salses_returns_txs
-        sales_returns_txs = transactions[transactions[TRANSACTION_IS_RETURN]].copy()
-        sales_returns_txs['new_amount'] = sales_returns_txs.groupby(TRANSACTION_REF_ID)[AMOUNT_IN_EUR].transform('sum')
-        sales_returns_txs = sales_returns_txs.drop_duplicates(subset=[TRANSACTION_REF_ID], keep='first') \
-            .drop(AMOUNT_IN_EUR, axis=1) \
-            .rename(columns={'new_amount': AMOUNT_IN_EUR})
-#net sales had to be translated to data frame
-        net_sales_txs = pd.DataFrame()
-#merging gross_sales_txs and sales_returns_txs to calculate the net_sales_txs
-        if len(gross_sales_txs) > 0 and len(sales_returns_txs) > 0:
-            net_sales_txs = pd.merge(gross_sales_txs, sales_returns_txs[[TRANSACTION_REF_ID, AMOUNT_IN_EUR]],
-                                     on=TRANSACTION_REF_ID, how='left')
-            net_sales_txs.fillna(0, inplace=True)
-            #subtract the amount_in_eur from left data source (x - this is a gross sale)
-            #right data source (y- this is a sales returns txs)
-            net_sales_txs[AMOUNT_IN_EUR] = net_sales_txs[AMOUNT_IN_EUR + '_x'] - net_sales_txs[AMOUNT_IN_EUR + '_y']
-            net_sales_txs.drop([AMOUNT_IN_EUR + '_x', AMOUNT_IN_EUR + '_y'], axis=1, inplace=True)
+
+        # Fold the transactions into the gross sales, sales returns and net sales per customer country
+        aggregator = SalesAggregator.from_options(CONSUMER_COUNTRY, self.options, self.process_output_folder)
+        for chunk in chain([transactions], chunks):
+            aggregator.add(chunk)
+        del transactions
+        sales = aggregator.frame()
+        aggregator.close()
 
         # Compute the gross sales per customer country
         # ------------------------------------------------
-        if len(gross_sales_txs) > 0:
+        if aggregator.has_captures:
             sales_per_customer_country['gross_sales_has_data'] = True
-            
-            gross_sales = gross_sales_txs[[CONSUMER_COUNTRY, AMOUNT_IN_EUR]].copy()
-            
-            gross_sales = gross_sales.groupby(CONSUMER_COUNTRY).sum()
-            gross_sales.reset_index(inplace=True)
+            gross_sales = sales['gross_sales'].dropna().rename(AMOUNT_IN_EUR).reset_index()
             gross_sales.sort_values(by=[AMOUNT_IN_EUR], ascending=False, inplace=True)
             gross_sales['gross_sales_country_code'] = location.get_country_iso3(gross_sales, CONSUMER_COUNTRY).tolist()
             gross_sales['gross_sales_country_name'] = location.get_country_name(gross_sales, CONSUMER_COUNTRY).tolist()
@@ -122,11 +97,9 @@ class SalesPerCustomerCountry(Plugin):
         # Compute the sales returns per customer country
         # ------------------------------------------------
         # sales returns txs 
-        if len(sales_returns_txs) > 0:
+        if aggregator.has_returns:
             sales_per_customer_country['sales_returns_has_data'] = True
-            sales_returns = sales_returns_txs[[CONSUMER_COUNTRY, AMOUNT_IN_EUR]].copy()
-            sales_returns = sales_returns.groupby(CONSUMER_COUNTRY).sum()
-            sales_returns.reset_index(inplace=True)
+            sales_returns = sales['sales_returns'].dropna().rename(AMOUNT_IN_EUR).reset_index()
             sales_returns.sort_values(by=[AMOUNT_IN_EUR], ascending=False, inplace=True)
             #why is this iso3 used here?
             sales_returns['sales_returns_country_code'] = location.get_country_iso3(sales_returns, CONSUMER_COUNTRY) \
@@ -150,11 +123,9 @@ class SalesPerCustomerCountry(Plugin):
 
         # Compute the net sales per customer country
         # ------------------------------------------------
-        if len(net_sales_txs) > 0:
+        if aggregator.has_captures and aggregator.has_returns:
             sales_per_customer_country['net_sales_has_data'] = True
-            net_sales = net_sales_txs[[CONSUMER_COUNTRY, AMOUNT_IN_EUR]].copy()
-            net_sales = net_sales.groupby(CONSUMER_COUNTRY).sum()
-            net_sales.reset_index(inplace=True)
+            net_sales = sales['net_sales'].dropna().rename(AMOUNT_IN_EUR).reset_index()
             #inplace = true?
             net_sales.sort_values(by=[AMOUNT_IN_EUR], ascending=False, inplace=True)
             net_sales['net_sales_country_code'] = location.get_country_iso3(net_sales, CONSUMER_COUNTRY).tolist()
@@ -172,11 +143,9 @@ class SalesPerCustomerCountry(Plugin):
                                              key=lambda pair: pair[0])]
             sales_per_customer_country.update({'net_sales_no_unknown': net_list})
             del net_sales
+        del sales
 
-        process_output_file = join(self.process_output_folder, 'out.pickle')
-
-        with open(process_output_file, "wb") as pickle_out:
-            pickle.dump(sales_per_customer_country, pickle_out, protocol=pickle.HIGHEST_PROTOCOL)
+        ResultBus.publish(self.process_output_folder, sales_per_customer_country)
 
         return sales_per_customer_country
 
@@ -184,10 +153,7 @@ class SalesPerCustomerCountry(Plugin):
 
     def plot(self, *args, **kwargs):
 
-        input_data_file = join(self.process_output_folder, 'out.pickle')
-
-        with open(input_data_file, 'rb') as handle:
-            data = pickle.load(handle)
+        data = ResultBus.load(self.process_output_folder)
 
         output_png_filename = join(self.plot_output_folder, 'sales_per_customer_country.png')
 
@@ -276,7 +242,8 @@ class SalesPerCustomerCountry(Plugin):
                 "width": 2000
             }
         }
-        pio.write_image(fig, output_png_filename, format='png')
+        RenderService.write_image(fig, output_png_filename, format='png')
+        RenderService.flush()
 
     def report(self, report, styles, *args, **kwargs):
 
@@ -6,22 +6,23 @@ Created on Mon Jul 22 10:22:46 2019
 """
 
 from wepair.plugins.plugin import Plugin
-import pandas as pd
 from ...globals import COLNAMES_PE
 from os.path import join
-import plotly.io as pio
-import pickle
-from reportlab.platypus import Paragraph, Image, Table, TableStyle
-from ...utils.report import Report
+from .render_service import RenderService
+from .sales_tools import SalesAggregator, transaction_chunks
+from .result_bus import ResultBus
+from .plugin_hooks import instrument_plugin
+from itertools import chain
 from wepair.utils_common.log import Log
-from wepair.utils_common.tools import Tools
+from .lazy_import import lazy_names
+
+# rendering libraries, imported on first use in plot() / report() (see lazy_import)
+Paragraph, Image, Table, TableStyle = lazy_names('reportlab.platypus', 'Paragraph', 'Image', 'Table', 'TableStyle')
+Report = lazy_names('...utils.report', 'Report', package=__package__)
 
 # log
 logger = Log(__name__).get_logger()
 
-# orca config
-pio.orca.config.use_xvfb = 'auto'
-
 PAYMENT_METHOD = COLNAMES_PE['Payment Method']
 AMOUNT_IN_EUR = COLNAMES_PE['Amount in EUR']
 TRANSACTION_IS_CAPTURE = COLNAMES_PE['Is capture']
@@ -36,6 +37,7 @@ class SalesPerPaymentMethod(Plugin):
         self.plugin_name = "Sales Per Payment Method"
         super().__init__(plugin_folder, id, options)
         self.required_input_data = ['tx.pickle']
+        instrument_plugin(self)
 
     def process(self, *args, **kwargs):
         sales_per_payment_method = {'has_data': False}
@@ -47,20 +49,33 @@ class SalesPerPaymentMethod(Plugin):
             return sales_per_payment_method
 
         args = list(args)
-        transactions = args[0]
+        # The transactions are consumed chunk by chunk (a single chunk unless the chunkSize option is set)
+        chunks = transaction_chunks(args[0], self.options.get('chunkSize'))
+        transactions = next(chunks, None)
 
         necessary_keys = [PAYMENT_METHOD, AMOUNT_IN_EUR, TRANSACTION_REF_ID, TRANSACTION_IS_CAPTURE,
                           TRANSACTION_IS_RETURN]
 
-        if not all(key in transactions.columns for key in necessary_keys):
+        if transactions is None or not all(key in transactions.columns for key in necessary_keys):
             return sales_per_payment_method
 
         sales_per_payment_method = {'has_data': True}
 
+        # Fold the transactions into the gross sales, sales returns and net sales per payment method
+        aggregator = SalesAggregator.from_options(PAYMENT_METHOD, self.options, self.process_output_folder)
+        period_starts, period_ends = [], []
+        for chunk in chain([transactions], chunks):
+            period_starts.append(chunk[TRANSACTION_DATE].min())
+            period_ends.append(chunk[TRANSACTION_DATE].max())
+            aggregator.add(chunk)
+        del transactions
+        sales = aggregator.frame(key_normalizer=lambda keys: keys.fillna('other'))
+        aggregator.close()
+
         # Obtaining the first and last date of the transcational data to print the time window
 
-        period_start = transactions[TRANSACTION_DATE].min()
-        period_end = transactions[TRANSACTION_DATE].max()
+        period_start = min(period_starts)
+        period_end = max(period_ends)
 
         begin_year = int(period_start.strftime('%Y'))
         end_year = int(period_end.strftime('%Y'))
@@ -75,91 +90,45 @@ class SalesPerPaymentMethod(Plugin):
             text = earliest_date + " to " + latest_date
 
         sales_per_payment_method['time_period'] = text
-        tt = Tools.get_time_period(transactions)
-        # Split the transaction set into gross sales and sales returns
-        gross_sales_txs = transactions[transactions[TRANSACTION_IS_CAPTURE]].copy()
-        gross_sales_txs['new_amount'] = gross_sales_txs.groupby(TRANSACTION_REF_ID)[AMOUNT_IN_EUR].transform('sum')
-        gross_sales_txs = gross_sales_txs.drop_duplicates(subset=[TRANSACTION_REF_ID], keep='first') \
-            .drop(AMOUNT_IN_EUR, axis=1) \
-            .rename(columns={'new_amount': AMOUNT_IN_EUR})
-
-        sales_returns_txs = transactions[transactions[TRANSACTION_IS_RETURN]].copy()
-        sales_returns_txs['new_amount'] = sales_returns_txs.groupby(TRANSACTION_REF_ID)[AMOUNT_IN_EUR].transform('sum')
-        sales_returns_txs = sales_returns_txs.drop_duplicates(subset=[TRANSACTION_REF_ID], keep='first') \
-            .drop(AMOUNT_IN_EUR, axis=1) \
-            .rename(columns={'new_amount': AMOUNT_IN_EUR})
-
-        net_sales_txs = pd.DataFrame()
-        if len(gross_sales_txs) > 0 and len(sales_returns_txs) > 0:
-            net_sales_txs = pd.merge(gross_sales_txs, sales_returns_txs[[TRANSACTION_REF_ID, AMOUNT_IN_EUR]],
-                                     on=TRANSACTION_REF_ID, how='left')
-            net_sales_txs.fillna(0, inplace=True)
-            net_sales_txs[AMOUNT_IN_EUR] = net_sales_txs[AMOUNT_IN_EUR + '_x'] - net_sales_txs[AMOUNT_IN_EUR + '_y']
-            net_sales_txs.drop([AMOUNT_IN_EUR + '_x', AMOUNT_IN_EUR + '_y'], axis=1, inplace=True)
-
-        gross_sales_txs = gross_sales_txs[[PAYMENT_METHOD, AMOUNT_IN_EUR]]
-        sales_returns_txs = sales_returns_txs[[PAYMENT_METHOD, AMOUNT_IN_EUR]]
-        net_sales_txs = net_sales_txs[[PAYMENT_METHOD, AMOUNT_IN_EUR]]
 
         # Compute the gross sales per payment method
         # ------------------------------------------------
-        if len(gross_sales_txs) > 0:
-            gross_sales = gross_sales_txs[[PAYMENT_METHOD, AMOUNT_IN_EUR]].copy()
-            gross_sales[PAYMENT_METHOD].fillna('other', inplace=True)
-            gross_sales = gross_sales.groupby([PAYMENT_METHOD]).sum()
-            gross_sales.reset_index(inplace=True)
-            # total = gross_sales[AMOUNT_IN_EUR].sum()
+        if aggregator.has_captures:
+            gross_sales = sales['gross_sales'].dropna()
             sales_per_payment_method.update({
-                'gross_sales': gross_sales[AMOUNT_IN_EUR].tolist(),
-                'gross_sales_payment_methods': gross_sales[PAYMENT_METHOD].tolist()
+                'gross_sales': gross_sales.tolist(),
+                'gross_sales_payment_methods': gross_sales.index.tolist()
             })
             del gross_sales
 
         # Compute the sales returns per payment method
         # ------------------------------------------------
-        if len(sales_returns_txs) > 0:
-            sales_returns = sales_returns_txs[[PAYMENT_METHOD, AMOUNT_IN_EUR]].copy()
-            sales_returns[PAYMENT_METHOD].fillna('other', inplace=True)
-            
-            sales_returns = sales_returns.groupby([PAYMENT_METHOD]).sum()
-            
-            sales_returns.reset_index(inplace=True)
-         #update to list?    
+        if aggregator.has_returns:
+            sales_returns = sales['sales_returns'].dropna()
             sales_per_payment_method.update({
-                'sales_returns': sales_returns[AMOUNT_IN_EUR].tolist(),
-                'sales_returns_payment_methods': sales_returns[PAYMENT_METHOD].tolist()
+                'sales_returns': sales_returns.tolist(),
+                'sales_returns_payment_methods': sales_returns.index.tolist()
             })
             del sales_returns
 
         # Compute the net sales per payment method
         # ------------------------------------------------
-        if len(net_sales_txs) > 0:
-            net_sales = net_sales_txs[[PAYMENT_METHOD, AMOUNT_IN_EUR]].copy()
-            net_sales[PAYMENT_METHOD].fillna('other', inplace=True)
-            #group by net sales payment methods
-            net_sales = net_sales.groupby([PAYMENT_METHOD]).sum()
-            #inplace=true?
-            net_sales.reset_index(inplace=True)
-            #updating names of the variables 
+        if aggregator.has_captures and aggregator.has_returns:
+            net_sales = sales['net_sales'].dropna()
             sales_per_payment_method.update({
-                'net_sales': net_sales[AMOUNT_IN_EUR].tolist(),
-                'net_sales_payment_methods': net_sales[PAYMENT_METHOD].tolist()
+                'net_sales': net_sales.tolist(),
+                'net_sales_payment_methods': net_sales.index.tolist()
             })
             del net_sales
+        del sales
 
-        process_output_file = join(self.process_output_folder, 'out.pickle')
-
-        with open(process_output_file, "wb") as pickle_out:
-            pickle.dump(sales_per_payment_method, pickle_out, protocol=pickle.HIGHEST_PROTOCOL)
+        ResultBus.publish(self.process_output_folder, sales_per_payment_method)
 
         return sales_per_payment_method
 
     def plot(self, *args, **kwargs):
 
-        input_data_file = join(self.process_output_folder, 'out.pickle')
-
-        with open(input_data_file, 'rb') as handle:
-            data = pickle.load(handle)
+        data = ResultBus.load(self.process_output_folder)
 
         # same color per type of payment pls
         id_color_dict = {}
@@ -222,14 +191,12 @@ class SalesPerPaymentMethod(Plugin):
                     }
                 }
             }
-            pio.write_image(fig, join(self.plot_output_folder, data_source + '_per_payment_method.png'))
+            RenderService.write_image(fig, join(self.plot_output_folder, data_source + '_per_payment_method.png'))
+        RenderService.flush()
 
     def report(self, report, styles, *args, **kwargs):
 
-        input_data_file = join(self.process_output_folder, 'out.pickle')
-
-        with open(input_data_file, 'rb') as handle:
-            data = pickle.load(handle)
+        data = ResultBus.load(self.process_output_folder)
 
         img_height = 250
         img_width = 250
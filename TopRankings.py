@@ -8,20 +8,23 @@ Created on Mon Jul 22 12:55:03 2019
 from wepair.plugins.plugin import Plugin
 from ...globals import COLNAMES_PE
 from os.path import join
-import pandas as pd
-import pickle
 import inspect
-from reportlab.platypus import Spacer, Image
-from ...utils.report import Report
-import plotly.io as pio
+import pandas as pd
+from itertools import chain
+from .render_service import RenderService
+from .sales_tools import SalesAggregator, ChunkReplay, top_sales_table, transaction_chunks, table_to_dict
+from .result_bus import ResultBus
+from .plugin_hooks import instrument_plugin
 from wepair.utils_common.log import Log
+from .lazy_import import lazy_names
+
+# rendering libraries, imported on first use in plot() / report() (see lazy_import)
+Spacer, Image = lazy_names('reportlab.platypus', 'Spacer', 'Image')
+Report = lazy_names('...utils.report', 'Report', package=__package__)
 
 # log
 logger = Log(__name__).get_logger()
 
-# orca config
-pio.orca.config.use_xvfb = 'auto'
-
 TRANSACTION_DATE = COLNAMES_PE['Transaction Creation Date and Time']
 SHOP_NAME = COLNAMES_PE['Merchant Account Short Name']
 AMOUNT_IN_EUR = COLNAMES_PE['Amount in EUR']
@@ -33,6 +36,8 @@ SHOP_COUNTRY_NAME = 'Country Name'
 ORG_UNIT = COLNAMES_PE['Organizational Unit']
 MERCHANT_NAME = COLNAMES_PE['Merchant Short Name']
 
+TOP_K_CHUNK_SIZE = 10 ** 6
+
 
 class SalesTopRank(Plugin):
 
@@ -47,6 +52,7 @@ class SalesTopRank(Plugin):
         self.plugin_name = "Sales Top Rank"
         super().__init__(plugin_folder, id, options)
         self.required_input_data = ['tx.pickle']
+        instrument_plugin(self)
 
     def process(self, *args, **kwargs):
 
@@ -62,7 +68,9 @@ class SalesTopRank(Plugin):
         necessary_keys = [SHOP_NAME, ORG_UNIT, MERCHANT_NAME, AMOUNT_IN_EUR, TRANSACTION_REF_ID, TRANSACTION_IS_CAPTURE,
                           TRANSACTION_IS_RETURN]
 
-        transactions = args[0]
+        # The transactions are consumed chunk by chunk (a single chunk unless the chunkSize option is set)
+        chunks = transaction_chunks(args[0], self.options.get('chunkSize'))
+        transactions = next(chunks, None)
         if self.options['filter'] == 'account name':
             group_filter = SHOP_NAME
         elif self.options['filter'] == 'org unit':
@@ -72,120 +80,68 @@ class SalesTopRank(Plugin):
         else:
             logger.warning('unknown filter option')
             return sales_per_shop
-        if not all(key in transactions.columns for key in necessary_keys):
+        if transactions is None or not all(key in transactions.columns for key in necessary_keys):
             return sales_per_shop
 
         sales_per_shop = {'has_data': True}
 
-        # Extract the data of interest
-        columns_to_keep = [TRANSACTION_DATE, SHOP_NAME, ORG_UNIT, MERCHANT_NAME, AMOUNT_IN_EUR, TRANSACTION_REF_ID,
-                           TRANSACTION_IS_CAPTURE, TRANSACTION_IS_RETURN]
         if TRANSACTION_DATE not in transactions.columns:
             logger.warning('{fct_name}: There is no column TRANSACTION_DATE. '
                             'Plotting results for the net sales will not be possible.'
                             .format(fct_name=inspect.stack()[0][3]))
-            columns_to_keep.remove(TRANSACTION_DATE)
-        transactions = transactions[columns_to_keep]
-
-        # Split the transaction set into gross sales and sales returns
-        gross_sales_txs = transactions[transactions[TRANSACTION_IS_CAPTURE]].copy()
-        gross_sales_txs['new_amount'] = gross_sales_txs.groupby(TRANSACTION_REF_ID)[AMOUNT_IN_EUR].transform('sum')
-        gross_sales_txs = gross_sales_txs.drop_duplicates(subset=[TRANSACTION_REF_ID], keep='first') \
-            .drop(AMOUNT_IN_EUR, axis=1) \
-            .rename(columns={'new_amount': AMOUNT_IN_EUR})
-
-        sales_returns_txs = transactions[transactions[TRANSACTION_IS_RETURN]].copy()
-        sales_returns_txs['new_amount'] = sales_returns_txs.groupby(TRANSACTION_REF_ID)[AMOUNT_IN_EUR].transform('sum')
-        sales_returns_txs = sales_returns_txs.drop_duplicates(subset=[TRANSACTION_REF_ID], keep='first') \
-            .drop(AMOUNT_IN_EUR, axis=1) \
-            .rename(columns={'new_amount': AMOUNT_IN_EUR})
-
-        net_sales_txs = pd.DataFrame()
-        if len(gross_sales_txs) > 0 and len(sales_returns_txs) > 0:
-            net_sales_txs = pd.merge(gross_sales_txs, sales_returns_txs[[TRANSACTION_REF_ID, AMOUNT_IN_EUR]],
-                                     on=TRANSACTION_REF_ID, how='left')
-            net_sales_txs.fillna(0, inplace=True)
-            net_sales_txs[AMOUNT_IN_EUR] = net_sales_txs[AMOUNT_IN_EUR + '_x'] - \
-                abs(net_sales_txs[AMOUNT_IN_EUR + '_y'])
-            # net_sales_txs[AMOUNT_IN_EUR] = net_sales_txs[AMOUNT_IN_EUR + '_y']
-            net_sales_txs.drop([AMOUNT_IN_EUR + '_x', AMOUNT_IN_EUR + '_y'], axis=1, inplace=True)
-
-        # Compute the gross sales per shop country
-        # ------------------------------------------------
-        if len(gross_sales_txs) > 0:
-            sales_per_shop['gross_sales_has_data'] = True
-            #creating the new data
-            gross_sales = gross_sales_txs[[group_filter, AMOUNT_IN_EUR]].copy()
-            gross_sales[group_filter].fillna('Unknown', inplace=True)
-            #summing gross sales by group filter
-            gross_sales = gross_sales.groupby([group_filter]).sum()
-            gross_sales.reset_index(inplace=True)
-            gross_sales.sort_values(by=[AMOUNT_IN_EUR], ascending=False, inplace=True)
-            sales_per_shop.update({
-                'gross_sales_filter': gross_sales[group_filter].tolist(),
-                'gross_sales': gross_sales[AMOUNT_IN_EUR].tolist()
-            })
-            del gross_sales
-
-        # Compute the sales returns per shop country
-        # ------------------------------------------------
-        if len(sales_returns_txs) > 0:
-            sales_per_shop['sales_returns_has_data'] = True
-            sales_returns = sales_returns_txs[[group_filter, AMOUNT_IN_EUR]].copy()
-            sales_returns[group_filter].fillna('Unknown', inplace=True)
-            sales_returns = sales_returns.groupby([group_filter]).sum()
-            sales_returns.reset_index(inplace=True)
-            sales_returns.sort_values(by=[AMOUNT_IN_EUR], ascending=False, inplace=True)
-            sales_per_shop.update({
-                'sales_returns_filter': sales_returns[group_filter].tolist(),
-                'sales_returns': sales_returns[AMOUNT_IN_EUR].tolist()
-            })
-            del sales_returns
 
-        # Compute the net sales per shop country
+        # Compute the gross sales, sales returns and net sales per filter value
         # ------------------------------------------------
-        if len(net_sales_txs) > 0:
-            sales_per_shop['net_sales_has_data'] = True
-            net_sales = net_sales_txs[[group_filter, AMOUNT_IN_EUR]].copy()
-            net_sales[group_filter].fillna('Unknown', inplace=True)
-            net_sales = net_sales.groupby([group_filter]).sum()
-            net_sales.reset_index(inplace=True)
-            net_sales.sort_values(by=[AMOUNT_IN_EUR], ascending=False, inplace=True)
-
-            # Sort the list of net sales according to the sorted list of gross sales
-            gross_filter_list = sales_per_shop['gross_sales_filter']
-            net_filter_list = net_sales[group_filter].tolist()
-            idx = [gross_filter_list.index(country) for country in net_filter_list if country in gross_filter_list]
-            net_list = [x for _, x in sorted(zip(idx, net_sales[AMOUNT_IN_EUR].tolist()), key=lambda pair: pair[0])]
-            sales_per_shop.update({
-                'net_sales': net_list
-            })
-            del net_sales
-
-        process_output_file = join(self.process_output_folder, 'out.pickle')
-
-        with open(process_output_file, "wb") as pickle_out:
-            pickle.dump(sales_per_shop, pickle_out, protocol=pickle.HIGHEST_PROTOCOL)
+        # With the topK option, only the top K values are ranked (Space-Saving sketch over chunks) and aggregated; the
+        # chunks of an input that is not a frame are spilled to disk on the first pass, to be read again (ChunkReplay)
+        if self.options.get('topK'):
+            source = args[0] if isinstance(args[0], pd.DataFrame) else chain([transactions], chunks)
+            replay = ChunkReplay(source, self.options.get('chunkSize') or TOP_K_CHUNK_SIZE,
+                                 join(self.process_output_folder, 'top_k_chunks'), necessary_keys)
+            sales, bounds = top_sales_table(replay, group_filter, int(self.options['topK']),
+                                            key_normalizer=lambda keys: keys.fillna('Unknown'), abs_returns=True)
+            sales_per_shop['top_k_bounds'] = table_to_dict(bounds, 'filter')
+            has_captures, has_returns = replay.has_captures, replay.has_returns
+            replay.close()
+        else:
+            aggregator = SalesAggregator.from_options(group_filter, self.options, self.process_output_folder)
+            for chunk in chain([transactions], chunks):
+                aggregator.add(chunk)
+            sales = aggregator.table(key_normalizer=lambda keys: keys.fillna('Unknown'), abs_returns=True)
+            has_captures, has_returns = aggregator.has_captures, aggregator.has_returns
+            aggregator.close()
+        del transactions
+        sales_per_shop.update({
+            'gross_sales_has_data': has_captures,
+            'sales_returns_has_data': has_returns,
+            'net_sales_has_data': has_captures and has_returns,
+            'sales_table': table_to_dict(sales, 'filter')
+        })
+        del sales
+
+        ResultBus.publish(self.process_output_folder, sales_per_shop)
 
         return sales_per_shop
 
     def plot(self, *args, **kwargs):
 
-        input_data_file = join(self.process_output_folder, 'out.pickle')
-
-        with open(input_data_file, 'rb') as handle:
-            data = pickle.load(handle)
+        data = ResultBus.load(self.process_output_folder)
 
         output_png_filename = join(self.plot_output_folder, 'sales_top_rank.png')
 
+        # Top 5 by gross sales (the table is sorted by decreasing gross sales)
+        top_filter = data['sales_table']['filter'][:5]
+        top_gross_sales = data['sales_table']['gross_sales'][:5]
+        top_net_sales = data['sales_table']['net_sales'][:5]
+
         fig = {
             "data": [
                 {
                     "type": "bar",
                     "orientation": "h",
-                    "x": data['gross_sales'][:5],
-                    "y": data['gross_sales_filter'][:5],
-                    "text": list(map(lambda x: '{:0,.0f}€'.format(x), data['gross_sales'][:5])),
+                    "x": top_gross_sales,
+                    "y": top_filter,
+                    "text": list(map(lambda x: '{:0,.0f}€'.format(x), top_gross_sales)),
                     "textposition": "outside",
                     "textfont": {
                         "color": kwargs['cmap']['colors']['night blue'],
@@ -200,9 +156,9 @@ class SalesTopRank(Plugin):
                 {
                     "type": "bar",
                     "orientation": "h",
-                    "x": data['net_sales'][:5],
-                    "y": data['gross_sales_filter'][:5],
-                    "text": list(map(lambda x: '{:0,.0f}€'.format(x), data['net_sales'][:5])),
+                    "x": top_net_sales,
+                    "y": top_filter,
+                    "text": list(map(lambda x: '{:0,.0f}€'.format(x), top_net_sales)),
                     "textposition": "outside",
                     "textfont": {
                         "color": kwargs['cmap']['colors']['night blue'],
@@ -263,7 +219,8 @@ class SalesTopRank(Plugin):
                 "width": 2000
             }
         }
-        pio.write_image(fig, output_png_filename, format='png')
+        RenderService.write_image(fig, output_png_filename, format='png')
+        RenderService.flush()
 
     def report(self, report, styles, *args, **kwargs):
 
@@ -0,0 +1,355 @@
+# -*- coding: utf-8 -*-
+"""
+Scale benchmark of the plugins on synthetic data.
+
+Benchmark.run generates (or reuses) the synthetic input data for every size, runs the process / plot / report phases
+of every plugin under the Profiler, and appends the run to a JSON history file. Benchmark.compare reports the stages
+that got slower between two runs of that history, so a regression shows up before it reaches production data.
+
+The input frames are loaded once per size and shared by all the plugins, as in a report run; a plugin that modifies
+its input (structure or values, see SharedInput) is reported. Benchmark.check_memory checks that the memory allocated
+by the process phase of every plugin stays within a budget relative to the size of its input, and raises a
+MemoryBudgetError otherwise. Benchmark.compare_clv_fitters times the in-project BG/NBD and Gamma-Gamma fitters
+(clv_fitters) against the lifetimes ones on the synthetic customers.
+Benchmark.startup measures the import time and memory of every plugin module, each in a fresh interpreter, and lists
+the rendering / modelling libraries the import pulled in (none are expected: see lazy_import).
+
+Example:
+    results = Benchmark.run([SalesTopRank, RetentionCohorts], sizes=[10**4, 10**6], work_folder='/tmp/bench',
+                            options={'RetentionCohorts': {'filter': 'org unit'}}, cmap=cmap)
+    Benchmark.compare(Benchmark.load_history('/tmp/bench/benchmark.json'))
+    Benchmark.check_memory([SalesTopRank, RetentionCohorts], size=10**5, work_folder='/tmp/bench', budget=2.0)
+    Benchmark.compare_clv_fitters(size=10**6, work_folder='/tmp/bench')
+    Benchmark.startup()
+"""
+
+import json
+import os
+import pickle
+import subprocess
+import sys
+import time
+import tracemalloc
+import numpy as np
+from os import makedirs
+from os.path import join, isfile, dirname
+from datetime import datetime
+from .profiling import Profiler
+from .shared_input import SharedInput
+from .synthetic_data import SyntheticData
+from .clv_fitters import BetaGeoFitter, GammaGammaFitter
+from wepair.utils_common.log import Log
+
+# log
+logger = Log(__name__).get_logger()
+
+# the data of a size is generated and loaded in memory (about 1 KB per transaction, see synthetic_data): the larger
+# sizes are opt-in, on a machine sized for them
+DEFAULT_SIZES = [10 ** 4, 10 ** 5, 10 ** 6]
+# peak memory allocated by the process phase of a plugin, relative to the size of its input
+DEFAULT_MEMORY_BUDGET = 2.0
+
+PLUGIN_MODULES = ['Chargebacks_analysis', 'CustomerChurn', 'CustomerRCLAndBenchmarking', 'CustomerRFM',
+                  'CustomerSegmentation', 'FpsAnalysis', 'FraudAnalysis', 'NewAndReturningCustomers',
+                  'RetentionCohorts', 'SalesPerCardCategory', 'SalesPerCustomerCity', 'SalesPerCustomerCountry',
+                  'SalesPerPaymentMethod', 'TopRankings']
+# libraries that must not be loaded by importing a plugin module
+HEAVY_LIBRARIES = ['plotly', 'reportlab', 'matplotlib', 'seaborn', 'sklearn', 'sklearn_pandas', 'lifetimes', 'scipy']
+
+# run in a fresh interpreter: import the module given as first argument, print the measures as JSON
+_STARTUP_SCRIPT = '''
+import importlib, json, resource, sys, time
+baseline_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+started = time.perf_counter()
+importlib.import_module(sys.argv[1])
+seconds = time.perf_counter() - started
+rss_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+print(json.dumps({'seconds': seconds, 'rss_mb': rss_kb / 1024, 'import_rss_mb': (rss_kb - baseline_kb) / 1024,
+                  'libraries': [name for name in sys.argv[2:] if name in sys.modules]}))
+'''
+
+
+class MemoryBudgetError(RuntimeError):
+
+    def __init__(self, message, results):
+        super().__init__(message)
+        self.results = results
+
+
+class Benchmark:
+
+    @staticmethod
+    def _input_data(size, work_folder, seed):
+        data_folder = join(work_folder, 'data_{size}'.format(size=size))
+        makedirs(data_folder, exist_ok=True)
+        if not isfile(join(data_folder, 'tx.pickle')):
+            SyntheticData.generate(size, data_folder, seed=seed)
+        return data_folder
+
+    @staticmethod
+    def _shared_inputs(data_folder, filenames, inputs, fingerprints, check_inputs):
+        """
+        The input frames of a plugin, loaded once per data folder into the inputs cache and shared; the fingerprint of
+        every frame loaded (with its content checksum if check_inputs) goes to fingerprints.
+        """
+        for filename in filenames:
+            if filename not in inputs:
+                with open(join(data_folder, filename), 'rb') as handle:
+                    inputs[filename] = pickle.load(handle)
+                fingerprints[filename] = SharedInput.fingerprint(inputs[filename], content=check_inputs)
+        return [inputs[filename] for filename in filenames]
+
+    @staticmethod
+    def _modified_inputs(filenames, inputs, fingerprints, check_inputs):
+        """
+        The input files among filenames whose frame changed since its fingerprint was taken. Their fingerprint is taken
+        again, so that a change is only reported for the plugin that made it.
+        """
+        modified = []
+        for filename in filenames:
+            fingerprint = SharedInput.fingerprint(inputs[filename], content=check_inputs)
+            if fingerprint != fingerprints[filename]:
+                fingerprints[filename] = fingerprint
+                modified.append(filename)
+        return modified
+
+    @staticmethod
+    def _revision():
+        try:
+            return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=dirname(__file__),
+                                           stderr=subprocess.DEVNULL).decode().strip()
+        except (OSError, subprocess.CalledProcessError):
+            return None
+
+    @staticmethod
+    def run(plugin_classes, sizes=None, work_folder='benchmark', options=None, cmap=None, report=None, styles=None,
+            seed=0, results_file='benchmark.json', check_inputs=True):
+        """
+        Benchmark every plugin class at every size (number of transactions). options maps a plugin class name to the
+        options of the plugin; plot is only run if cmap is given and report only if a report document and its styles
+        are given. check_inputs also reports the plugins writing values into their input (a checksum of every input
+        frame, outside the profiled stages). Returns the run, which is also appended to work_folder/results_file.
+        """
+        sizes = sizes or DEFAULT_SIZES
+        options = options or {}
+        run = {
+            'date': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+            'revision': Benchmark._revision(),
+            'results': []
+        }
+
+        for size in sizes:
+            data_folder = Benchmark._input_data(size, work_folder, seed)
+            shared_inputs, input_fingerprints = {}, {}
+
+            for plugin_class in plugin_classes:
+                plugin_folder = join(work_folder, 'plugins_{size}'.format(size=size), plugin_class.__name__)
+                makedirs(plugin_folder, exist_ok=True)
+                plugin = Profiler.instrument(plugin_class(plugin_folder, plugin_class.__name__,
+                                                          dict(options.get(plugin_class.__name__, {}))))
+
+                inputs = Benchmark._shared_inputs(data_folder, plugin.required_input_data, shared_inputs,
+                                                  input_fingerprints, check_inputs)
+
+                Profiler.reset()
+                logger.info('Benchmark: {plugin} on {size:,} transactions'.format(plugin=plugin_class.__name__,
+                                                                                  size=size))
+                try:
+                    plugin.process(*inputs)
+                    if cmap is not None:
+                        plugin.plot(cmap=cmap)
+                    if report is not None and styles is not None:
+                        plugin.report(report, styles, options=dict(options.get(plugin_class.__name__, {})))
+                    error = None
+                except Exception as e:
+                    logger.warning('Benchmark: {plugin} failed on {size:,} transactions: {error}'
+                                   .format(plugin=plugin_class.__name__, size=size, error=e))
+                    error = repr(e)
+
+                modified_inputs = Benchmark._modified_inputs(plugin.required_input_data, shared_inputs,
+                                                             input_fingerprints, check_inputs)
+                if modified_inputs:
+                    logger.warning('Benchmark: {plugin} modified its shared input {files}'
+                                   .format(plugin=plugin_class.__name__, files=modified_inputs))
+
+                run['results'].append({
+                    'plugin': plugin_class.__name__,
+                    'size': size,
+                    'error': error,
+                    'modified_inputs': modified_inputs,
+                    'stages': Profiler.records()
+                })
+                del inputs
+            del shared_inputs
+
+        history = Benchmark.load_history(join(work_folder, results_file))
+        history.append(run)
+        with open(join(work_folder, results_file), 'w') as results_out:
+            json.dump(history, results_out, indent=2)
+
+        return run
+
+    @staticmethod
+    def load_history(filename):
+        if not isfile(filename):
+            return []
+        with open(filename, 'r') as handle:
+            return json.load(handle)
+
+    @staticmethod
+    def compare(history, tolerance=.2, min_wall_time=.5):
+        """
+        Compare the last run of the history with the previous one. Returns the stages (plugin, size, stage) whose wall
+        time grew by more than tolerance (relative), ignoring the stages faster than min_wall_time seconds.
+        """
+        if len(history) < 2:
+            return []
+
+        def wall_times(run):
+            return {(result['plugin'], result['size'], stage['stage']): stage['wall_time']
+                    for result in run['results'] for stage in result['stages']}
+
+        previous = wall_times(history[-2])
+        regressions = []
+        for key, wall_time in wall_times(history[-1]).items():
+            if key in previous and wall_time >= min_wall_time and wall_time > previous[key] * (1 + tolerance):
+                regressions.append({'plugin': key[0], 'size': key[1], 'stage': key[2],
+                                    'previous_wall_time': previous[key], 'wall_time': wall_time})
+                logger.warning('Benchmark regression: {plugin} ({size:,} transactions) {stage}: '
+                               '{previous_wall_time:.2f}s -> {wall_time:.2f}s'.format(**regressions[-1]))
+        return regressions
+
+    @staticmethod
+    def check_memory(plugin_classes, size=10 ** 5, work_folder='benchmark', options=None, budget=DEFAULT_MEMORY_BUDGET,
+                     budgets=None, seed=0, strict=True):
+        """
+        Run the process phase of every plugin on the shared synthetic input of the given size and measure the peak
+        memory it allocates (tracemalloc, which also sees the numpy / pandas buffers). budget is the maximum ratio of
+        that peak to the size of the plugin input; budgets maps a plugin class name to its own budget. Returns one entry
+        per plugin; the plugins over budget, failing or modifying their input are logged and, if strict, make the check
+        raise a MemoryBudgetError (carrying the entries) once every plugin ran, so that a script running it exits with a
+        non-zero status.
+        """
+        options = options or {}
+        budgets = budgets or {}
+        data_folder = Benchmark._input_data(size, work_folder, seed)
+        shared_inputs, input_fingerprints = {}, {}
+        results = []
+
+        for plugin_class in plugin_classes:
+            plugin_folder = join(work_folder, 'memory_{size}'.format(size=size), plugin_class.__name__)
+            makedirs(plugin_folder, exist_ok=True)
+            plugin = plugin_class(plugin_folder, plugin_class.__name__, dict(options.get(plugin_class.__name__, {})))
+            inputs = Benchmark._shared_inputs(data_folder, plugin.required_input_data, shared_inputs,
+                                              input_fingerprints, True)
+            input_bytes = sum(SharedInput.nbytes(frame) for frame in inputs)
+
+            tracemalloc.start()
+            try:
+                plugin.process(*inputs)
+                error = None
+            except Exception as e:
+                error = repr(e)
+            finally:
+                _, peak_bytes = tracemalloc.get_traced_memory()
+                tracemalloc.stop()
+
+            result = {
+                'plugin': plugin_class.__name__,
+                'size': size,
+                'input_mb': input_bytes / 2 ** 20,
+                'peak_mb': peak_bytes / 2 ** 20,
+                'ratio': peak_bytes / float(max(input_bytes, 1)),
+                'budget': budgets.get(plugin_class.__name__, budget),
+                'error': error,
+                'modified_inputs': Benchmark._modified_inputs(plugin.required_input_data, shared_inputs,
+                                                              input_fingerprints, True)
+            }
+            result['within_budget'] = error is None and result['ratio'] <= result['budget']
+            results.append(result)
+            if error is not None:
+                logger.warning('Memory check: {plugin} failed: {error}'.format(**result))
+            elif not result['within_budget']:
+                logger.warning('Memory check: {plugin} allocated {peak_mb:.1f} MB for {input_mb:.1f} MB of input '
+                               '({ratio:.2f}x, budget {budget:.2f}x)'.format(**result))
+            if result['modified_inputs']:
+                logger.warning('Memory check: {plugin} modified its shared input {modified_inputs}'.format(**result))
+            del inputs
+
+        failed = [result['plugin'] for result in results if not result['within_budget'] or result['modified_inputs']]
+        if strict and failed:
+            raise MemoryBudgetError('Memory check failed on {size:,} transactions: {plugins}'
+                                    .format(size=size, plugins=', '.join(failed)), results)
+        return results
+
+    @staticmethod
+    def compare_clv_fitters(size=10 ** 5, work_folder='benchmark', seed=0, maxiter=10000, tol=1e-6):
+        """
+        Fit the BG/NBD and Gamma-Gamma models with lifetimes and with clv_fitters on the synthetic customers of the
+        given size, as the customer plugins do. Returns one entry per model with both fit times and the largest
+        relative difference between the fitted parameters.
+        """
+        import lifetimes
+
+        data_folder = Benchmark._input_data(size, work_folder, seed)
+        with open(join(data_folder, 'customers.pickle'), 'rb') as handle:
+            customers = pickle.load(handle)
+        repeat_customers = customers[customers['n_transactions'] > 1]
+
+        models = [
+            ('BG/NBD', lifetimes.BetaGeoFitter, BetaGeoFitter,
+             (customers['frequency'], customers['recency'], customers['T'])),
+            ('Gamma-Gamma', lifetimes.GammaGammaFitter, GammaGammaFitter,
+             (repeat_customers['frequency'], repeat_customers['monetary_value']))
+        ]
+        results = []
+        for model, reference_class, fitter_class, fit_args in models:
+            timings, params = [], []
+            for fitter in (reference_class(penalizer_coef=0.0), fitter_class(penalizer_coef=0.0)):
+                started = time.perf_counter()
+                fitter.fit(*fit_args, maxiter=maxiter, tol=tol)
+                timings.append(time.perf_counter() - started)
+                params.append(fitter.params_.sort_index())
+
+            result = {
+                'model': model,
+                'size': size,
+                'n_customers': len(fit_args[0]),
+                'lifetimes_seconds': timings[0],
+                'seconds': timings[1],
+                'speedup': timings[0] / max(timings[1], 1e-9),
+                'max_param_rel_diff': float((np.abs(params[1] - params[0]) / np.abs(params[0])).max())
+            }
+            results.append(result)
+            logger.info('CLV fitters: {model} on {n_customers:,} customers: lifetimes {lifetimes_seconds:.2f}s, '
+                        'clv_fitters {seconds:.2f}s ({speedup:.1f}x), parameters within {max_param_rel_diff:.1e}'
+                        .format(**result))
+        return results
+
+    @staticmethod
+    def startup(module_names=None, repeat=3):
+        """
+        Import every plugin module (default PLUGIN_MODULES; the package itself is measured first as the common base) in
+        a fresh interpreter, repeat times. Returns one entry per module with the best import time, the peak RSS of the
+        interpreter and the part of it due to the import (in MB), and the HEAVY_LIBRARIES loaded by the import.
+        """
+        package = __package__
+        module_names = [package] + ['{package}.{module}'.format(package=package, module=module)
+                                    for module in (module_names or PLUGIN_MODULES)]
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(path for path in sys.path if path))
+
+        results = []
+        for module_name in module_names:
+            runs = []
+            for _ in range(repeat):
+                output = subprocess.check_output([sys.executable, '-c', _STARTUP_SCRIPT, module_name] + HEAVY_LIBRARIES,
+                                                 env=env)
+                runs.append(json.loads(output.decode().strip().splitlines()[-1]))
+            result = min(runs, key=lambda run: run['seconds'])
+            result['module'] = module_name
+            results.append(result)
+            logger.info('Startup: {module} imported in {seconds:.2f}s, RSS {rss_mb:.0f} MB (+{import_rss_mb:.0f} MB), '
+                        'heavy libraries: {libraries}'.format(**result))
+            if result['libraries'] and module_name != package:
+                logger.warning('Startup: {module} loads {libraries} at import time'.format(**result))
+        return results
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+"""
+Canonical customer city names.
+
+The raw city strings of the transactions come in many spellings ('WARSZAWA', 'Warszawa', 'warszawa '). Every distinct raw
+value is normalized once, vectorized over the unique values rather than the rows: trimmed, lower-cased, 'city of '
+removed and title-cased; missing values, empty strings and 'nan' become UNKNOWN_CITY. Each canonical name gets a compact
+integer code, so the plugins group on the codes and only translate the codes of the result back to names.
+
+The dictionary (raw spelling -> canonical name -> code) is kept for the whole process and, when a filename is given, is
+persisted as JSON, so that the spellings already seen are not normalized again and the codes stay stable across runs.
+"""
+
+import json
+import os
+import threading
+import numpy as np
+import pandas as pd
+from os.path import isfile
+
+UNKNOWN_CITY = 'Unknown'
+
+
+class CityNames:
+
+    _lock = threading.Lock()
+    _dictionaries = {}
+
+    @staticmethod
+    def normalize(raw_cities):
+        """Canonical name of every raw city (any iterable of strings), vectorized."""
+        names = pd.Series(list(raw_cities), dtype=object).astype(str).str.strip().str.lower() \
+            .str.replace('city of ', '', regex=False).str.strip().str.title()
+        names[names.isin(['', 'Nan', 'None'])] = UNKNOWN_CITY
+        return names
+
+    @staticmethod
+    def _dictionary(filename):
+        if filename not in CityNames._dictionaries:
+            dictionary = {'codes': {UNKNOWN_CITY: 0}, 'variants': {}}
+            if filename is not None and isfile(filename):
+                with open(filename, 'r', encoding='utf-8') as handle:
+                    dictionary = json.load(handle)
+            dictionary['names'] = {code: name for name, code in dictionary['codes'].items()}
+            CityNames._dictionaries[filename] = dictionary
+        return CityNames._dictionaries[filename]
+
+    @staticmethod
+    def _save(filename, dictionary):
+        temp_filename = filename + '.tmp'
+        with open(temp_filename, 'w', encoding='utf-8') as dictionary_out:
+            json.dump({'codes': dictionary['codes'], 'variants': dictionary['variants']}, dictionary_out,
+                      ensure_ascii=False)
+        os.replace(temp_filename, filename)
+
+    @staticmethod
+    def codes(cities, filename=None):
+        """
+        Code of the canonical name of every city of the Series (a Series with the same index). The spellings not in the
+        dictionary yet are normalized and added to it (and to the file, if any).
+        """
+        raw_codes, uniques = pd.factorize(cities)
+        uniques = [str(city) for city in uniques]
+
+        with CityNames._lock:
+            dictionary = CityNames._dictionary(filename)
+            new_variants = [city for city in uniques if city not in dictionary['variants']]
+            if new_variants:
+                for variant, name in zip(new_variants, CityNames.normalize(new_variants)):
+                    if name not in dictionary['codes']:
+                        dictionary['codes'][name] = len(dictionary['codes'])
+                        dictionary['names'][dictionary['codes'][name]] = name
+                    dictionary['variants'][variant] = name
+                if filename is not None:
+                    CityNames._save(filename, dictionary)
+            unique_codes = np.array([dictionary['codes'][dictionary['variants'][city]] for city in uniques] +
+                                    [dictionary['codes'][UNKNOWN_CITY]], dtype=np.int32)
+
+        # factorize marks the missing values with -1, i.e. the last code: UNKNOWN_CITY
+        return pd.Series(unique_codes[raw_codes], index=cities.index)
+
+    @staticmethod
+    def names(codes, filename=None):
+        """Canonical names of the given codes."""
+        with CityNames._lock:
+            names = CityNames._dictionary(filename)['names']
+            names = np.array([names[code] for code in range(len(names))], dtype=object)
+        return names[np.asarray(codes, dtype=int)].tolist()
+
+    @staticmethod
+    def canonical(cities, filename=None):
+        """Canonical name of every city of the Series."""
+        codes = CityNames.codes(cities, filename)
+        return pd.Series(CityNames.names(codes, filename), index=cities.index)
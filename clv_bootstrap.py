@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+"""
+Bootstrap confidence intervals of the per-segment CLV predictions of CustomerRFM.
+
+A replicate resamples the customers with replacement, refits the BG/NBD and Gamma-Gamma models on the resample and
+predicts p_alive, the number of purchases and the average transaction value of the original customers with the refitted
+parameters; the per-segment aggregates of the replicates give the percentile intervals of the point estimates.
+
+Resampling the customers is drawing a multinomial count for every distinct (frequency, recency, T) row (and
+(frequency, monetary value) row of the repeat customers), so a replicate is a weighted fit on the few thousand distinct
+rows (see clv_fitters), warm-started from the point estimate. The customers are condensed once more into cells of
+identical (segment, BG/NBD row, Gamma-Gamma row), on which the per-segment aggregates are bincounts. The replicates
+run on a process pool that receives the condensed data once per worker, and stop when the time budget is spent: the
+intervals are computed on the replicates finished by then, and the workers still fitting a replicate are terminated,
+so that no CPU is spent on the bootstrap once the intervals are returned. The workers are spawned, not forked, as in
+plot_scheduler: a fork would copy the state of the plugin process (its threads, its open renderer) into every worker.
+"""
+
+import time
+import warnings
+import multiprocessing
+import numpy as np
+import pandas as pd
+from .clv_fitters import BetaGeoFitter, GammaGammaFitter, ConvergenceError
+
+# per-segment aggregates, named as the customer_rfm columns
+BOOTSTRAP_STATISTICS = ['predicted_p_alive', 'predicted_F', 'predicted_M_avg', 'CLV', 'predicted_pFM']
+DEFAULT_TIME_BUDGET = 60
+DEFAULT_CONFIDENCE = 0.9
+# start method of the workers (see the module docstring)
+MP_CONTEXT = 'spawn'
+
+# condensed data of the worker process, set by _init_worker
+_data = None
+
+
+def _init_worker(data):
+    global _data
+    _data = data
+
+
+def _condense(keys):
+    """Distinct rows of the key columns (a DataFrame), the row of every customer and the number of customers per row."""
+    codes = keys.groupby(list(keys.columns), sort=False).ngroup().values
+    first = pd.Series(np.arange(len(codes))).groupby(codes).first().values
+    return keys.iloc[first].reset_index(drop=True), codes, np.bincount(codes)
+
+
+def _segment_statistics(bgf, ggf, data):
+    """Per-segment aggregates (BOOTSTRAP_STATISTICS x segments) of the predictions of the fitted models."""
+    bg_rows, gg_rows = data['bg_rows'], data['gg_rows']
+    p_alive = bgf.conditional_probability_alive(bg_rows['frequency'].values, bg_rows['recency'].values,
+                                                bg_rows['T'].values)
+    purchases = bgf.conditional_expected_number_of_purchases_up_to_time(
+        data['horizon'], bg_rows['frequency'].values, bg_rows['recency'].values, bg_rows['T'].values)
+    p, q, v = ggf._unload_params('p', 'q', 'v')
+    average_values = np.append(ggf.conditional_expected_average_profit(gg_rows['frequency'].values,
+                                                                       gg_rows['monetary_value'].values),
+                               p * v / (q - 1))
+
+    cells = data['cells']
+    segments, weights = cells['segment'].values, cells['n_customers'].values
+    cell_p_alive = p_alive[cells['bg_row'].values]
+    cell_purchases = purchases[cells['bg_row'].values]
+    cell_values = average_values[cells['gg_row'].values]
+
+    # the missing predictions are skipped, as by the pandas mean and sum of the point estimates
+    n_segments = data['n_segments']
+
+    def total(values):
+        known = ~np.isnan(values)
+        return np.bincount(segments[known], weights=weights[known] * values[known], minlength=n_segments), \
+            np.bincount(segments[known], weights=weights[known], minlength=n_segments)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        means = [np.divide(*total(values)) for values in (cell_p_alive, cell_purchases, cell_values)]
+    clv = total(cell_purchases * cell_values)[0]
+    n_customers = np.bincount(segments, weights=weights, minlength=n_segments)
+    return np.vstack(means + [clv, means[0] * means[1] * means[2] * n_customers])
+
+
+def _replicate(seed):
+    """Per-segment aggregates of one bootstrap replicate, None if a refit fails."""
+    data = _data
+    generator = np.random.default_rng(seed)
+    bg_rows, gg_rows = data['bg_rows'], data['gg_rows']
+    bg_weights = generator.multinomial(data['bg_counts'].sum(), data['bg_counts'] / data['bg_counts'].sum())
+    gg_weights = generator.multinomial(data['gg_counts'].sum(), data['gg_counts'] / data['gg_counts'].sum())
+    try:
+        bgf = BetaGeoFitter(penalizer_coef=0.0).fit(
+            bg_rows['frequency'], bg_rows['recency'], bg_rows['T'], weights=bg_weights,
+            initial_params=data['bg_initial_params'], maxiter=data['maxiter'], tol=data['tol'])
+        repeat = gg_weights > 0
+        ggf = GammaGammaFitter(penalizer_coef=0.0).fit(
+            gg_rows.loc[repeat, 'frequency'], gg_rows.loc[repeat, 'monetary_value'], weights=gg_weights[repeat],
+            initial_params=data['gg_initial_params'], maxiter=data['maxiter'], tol=data['tol'])
+    except (ConvergenceError, ValueError):
+        return None
+    return _segment_statistics(bgf, ggf, data)
+
+
+class CLVBootstrap:
+
+    def __init__(self, n_replicates, time_budget=DEFAULT_TIME_BUDGET, confidence=DEFAULT_CONFIDENCE, seed=0,
+                 max_workers=None, mp_context=MP_CONTEXT):
+        self.n_replicates = n_replicates
+        self.time_budget = time_budget
+        self.confidence = confidence
+        self.seed = seed
+        self.max_workers = max_workers
+        self.mp_context = mp_context
+        self.n_completed = 0
+        self.elapsed = 0.0
+
+    @staticmethod
+    def from_options(options, seed=0):
+        """
+        Bootstrap of bootstrapReplicates replicates (default 0: disabled), bounded by bootstrapTimeBudget seconds
+        (default DEFAULT_TIME_BUDGET), with intervals at the bootstrapConfidence level (default DEFAULT_CONFIDENCE).
+        """
+        return CLVBootstrap(int(options.get('bootstrapReplicates', 0)),
+                            float(options.get('bootstrapTimeBudget', DEFAULT_TIME_BUDGET)),
+                            float(options.get('bootstrapConfidence', DEFAULT_CONFIDENCE)), seed)
+
+    @property
+    def enabled(self):
+        return self.n_replicates > 0
+
+    def intervals(self, customers, segments, n_segments, horizon, bgf, ggf, maxiter=10000, tol=1e-6):
+        """
+        Percentile intervals of BOOTSTRAP_STATISTICS per segment: a DataFrame indexed by segment with a
+        <statistic>_lower and a <statistic>_upper column per statistic (NaN with fewer than two replicates). customers
+        holds the frequency, recency, T, monetary_value and n_transactions columns the point estimates bgf and ggf were
+        fitted on, and segments the segment (0 .. n_segments - 1, -1 for none) of every customer.
+        The call returns after at most time_budget seconds (the condensation and the start of the workers included),
+        plus the time to terminate the workers: none of them keeps running afterwards.
+        """
+        start = time.perf_counter()
+        frequency = customers['frequency'].values.astype(float)
+        repeat = customers['n_transactions'].values > 1
+        bg_rows, bg_codes, bg_counts = _condense(pd.DataFrame({
+            'frequency': frequency, 'recency': customers['recency'].values.astype(float),
+            'T': customers['T'].values.astype(float)}))
+        gg_rows, gg_codes, gg_counts = _condense(pd.DataFrame({
+            'frequency': frequency[repeat],
+            'monetary_value': customers['monetary_value'].values[repeat].astype(float)}))
+
+        # the customers without a Gamma-Gamma row take the population mean, stored after the last row
+        customer_gg_rows = np.full(len(customers), len(gg_rows))
+        customer_gg_rows[repeat] = gg_codes
+        segments = np.asarray(segments)
+        in_segment = segments >= 0
+        cells = pd.DataFrame({'segment': segments[in_segment], 'bg_row': bg_codes[in_segment],
+                              'gg_row': customer_gg_rows[in_segment]})
+        cells = cells.groupby(['segment', 'bg_row', 'gg_row'], sort=False).size().rename('n_customers').reset_index()
+
+        # warm start from the point estimates, in the scaled units of BetaGeoFitter.fit
+        r, alpha, a, b = bgf._unload_params('r', 'alpha', 'a', 'b')
+        data = {
+            'bg_rows': bg_rows, 'bg_counts': bg_counts, 'gg_rows': gg_rows, 'gg_counts': gg_counts, 'cells': cells,
+            'n_segments': n_segments, 'horizon': horizon, 'maxiter': maxiter, 'tol': tol,
+            'bg_initial_params': np.log([r, alpha / bg_rows['T'].max(), a, b]),
+            'gg_initial_params': np.log(ggf._unload_params('p', 'q', 'v'))
+        }
+
+        replicates = []
+        seeds = np.random.SeedSequence(self.seed).spawn(self.n_replicates)
+        pool = multiprocessing.get_context(self.mp_context).Pool(self.max_workers, initializer=_init_worker,
+                                                                 initargs=(data,))
+        try:
+            # from the pool creation on, any exception still terminates the workers
+            results = pool.imap_unordered(_replicate, seeds)
+            for _ in range(len(seeds)):
+                remaining = self.time_budget - (time.perf_counter() - start)
+                replicate = results.next(timeout=max(remaining, 0))
+                if replicate is not None:
+                    replicates.append(replicate)
+        except multiprocessing.TimeoutError:
+            pass
+        finally:
+            # the replicates still queued are dropped and the running ones are killed
+            pool.terminate()
+            pool.join()
+        self.n_completed = len(replicates)
+        self.elapsed = time.perf_counter() - start
+
+        columns = [statistic + suffix for statistic in BOOTSTRAP_STATISTICS for suffix in ('_lower', '_upper')]
+        intervals = pd.DataFrame(np.nan, index=pd.RangeIndex(n_segments), columns=columns)
+        if self.n_completed < 2:
+            return intervals
+        tail = 50 * (1 - self.confidence)
+        with warnings.catch_warnings():
+            # all-NaN slices for the empty segments
+            warnings.simplefilter('ignore', RuntimeWarning)
+            lower, upper = np.nanpercentile(np.stack(replicates), [tail, 100 - tail], axis=0)
+        for i, statistic in enumerate(BOOTSTRAP_STATISTICS):
+            intervals[statistic + '_lower'] = lower[i]
+            intervals[statistic + '_upper'] = upper[i]
+        return intervals
@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+"""
+BG/NBD and Gamma-Gamma fitters for the customer lifetime value, drop-in replacements of the lifetimes fitters used by
+the customer plugins (same fit arguments, same prediction methods, same params_).
+
+lifetimes differentiates the negative log-likelihood with autograd on every evaluation and computes its Hessian with
+autograd after the fit. Here the log-likelihood and its analytic gradient (w.r.t. the log-parameters) are evaluated in
+one vectorized NumPy pass, on the distinct (frequency, recency, T) / (frequency, monetary value) patterns only, each
+weighted by its number of customers, as in Fader and Hardie's condensed RFM matrix. The kernels need the digamma
+function, which numba cannot compile in nopython mode, and work on a few thousand patterns even for millions of
+customers: they are not JIT-compiled.
+
+References: Fader, Hardie and Lee (2005), "Counting Your Customers the Easy Way: An Alternative to the Pareto/NBD
+Model"; Fader and Hardie (2013), "The Gamma-Gamma Model of Monetary Value" (http://www.brucehardie.com/notes/025/).
+"""
+
+import numpy as np
+import pandas as pd
+from .lazy_import import lazy_names
+
+# imported by the first fit only (see lazy_import)
+minimize = lazy_names('scipy.optimize', 'minimize')
+gammaln, digamma, hyp2f1, expit = lazy_names('scipy.special', 'gammaln', 'digamma', 'hyp2f1', 'expit')
+
+
+class ConvergenceError(RuntimeError):
+    pass
+
+
+def _check_inputs(frequency, recency=None, T=None, monetary_value=None):
+    """The input checks of lifetimes, so that both fitters accept and reject the same data."""
+    frequency = np.asarray(frequency)
+    if recency is not None:
+        recency, T = np.asarray(recency), np.asarray(T)
+        if (recency > T).any():
+            raise ValueError('Some values in recency vector are larger than T vector.')
+        if ((recency != 0) & (frequency == 0)).any():
+            raise ValueError('There exist non-zero recency values when frequency is zero.')
+    if (frequency % 1 != 0).any():
+        raise ValueError('There exist non-integer values in the frequency vector.')
+    if monetary_value is not None and (np.asarray(monetary_value) <= 0).any():
+        raise ValueError('There exist non-positive values in the monetary_value vector.')
+
+
+def _patterns(*columns, weights=None):
+    """Distinct rows of the columns and the total weight of every distinct row."""
+    frame = pd.DataFrame({i: np.asarray(column, dtype=float) for i, column in enumerate(columns)})
+    frame['weight'] = 1.0 if weights is None else np.asarray(weights, dtype=float)
+    patterns = frame.groupby(list(range(len(columns))), sort=False)['weight'].sum()
+    return [patterns.index.get_level_values(i).values for i in range(len(columns))], patterns.values
+
+
+class _Fitter:
+
+    param_names = []
+
+    def __init__(self, penalizer_coef=0.0):
+        self.penalizer_coef = penalizer_coef
+        self.params_ = None
+        self.n_subjects = 0
+
+    def __repr__(self):
+        if self.params_ is None:
+            return '<{name}: unfitted>'.format(name=type(self).__name__)
+        return '<{name}: fitted with {n:,} subjects, {params}>'.format(
+            name=type(self).__name__, n=self.n_subjects,
+            params=', '.join('{k}: {v:.2f}'.format(k=k, v=v) for k, v in self.params_.sort_index().items()))
+
+    def _unload_params(self, *names):
+        return [self.params_[name] for name in names]
+
+    def _minimize(self, negative_log_likelihood, args, initial_params, verbose, tol, **kwargs):
+        """Minimize the (value, gradient) function of the log-parameters, as lifetimes does (BFGS, 0.1 start)."""
+        def penalized(log_params, *args):
+            value, gradient = negative_log_likelihood(log_params, *args)
+            params = np.exp(log_params)
+            return value + self.penalizer_coef * (params ** 2).sum(), \
+                gradient + 2 * self.penalizer_coef * params ** 2
+
+        options = {'disp': verbose}
+        options.update(kwargs)
+        x0 = 0.1 * np.ones(len(self.param_names)) if initial_params is None else np.asarray(initial_params)
+        output = minimize(penalized, x0=x0, args=args, jac=True, method='BFGS', tol=tol, options=options)
+        if not output.success and not np.isfinite(output.fun):
+            raise ConvergenceError('The model did not converge: {message}'.format(message=output.message))
+        self._negative_log_likelihood_ = output.fun
+        return output.x
+
+
+class BetaGeoFitter(_Fitter):
+    """BG/NBD model of the number of purchases and of the probability for a customer to be alive."""
+
+    param_names = ['r', 'alpha', 'a', 'b']
+
+    @staticmethod
+    def _negative_log_likelihood(log_params, x, t_x, T, weights):
+        """Mean negative log-likelihood and its gradient w.r.t. log(r, alpha, a, b)."""
+        r, alpha, a, b = np.exp(log_params)
+        repeat = x > 0
+
+        a1 = gammaln(r + x) - gammaln(r) + r * np.log(alpha)
+        a2 = gammaln(a + b) + gammaln(b + x) - gammaln(b) - gammaln(a + b + x)
+        a3 = -(r + x) * np.log(alpha + T)
+        a4 = np.log(a) - np.log(b + np.maximum(x, 1) - 1) - (r + x) * np.log(alpha + t_x)
+        top = np.maximum(a3, np.where(repeat, a4, -np.inf))
+        e3, e4 = np.exp(a3 - top), np.exp(a4 - top) * repeat
+        ll = a1 + a2 + np.log(e3 + e4) + top
+        w3, w4 = e3 / (e3 + e4), e4 / (e3 + e4)
+
+        d_r = digamma(r + x) - digamma(r) + np.log(alpha) - w3 * np.log(alpha + T) - w4 * np.log(alpha + t_x)
+        d_alpha = r / alpha - w3 * (r + x) / (alpha + T) - w4 * (r + x) / (alpha + t_x)
+        d_a = digamma(a + b) - digamma(a + b + x) + w4 / a
+        d_b = digamma(a + b) + digamma(b + x) - digamma(b) - digamma(a + b + x) - w4 / (b + np.maximum(x, 1) - 1)
+
+        total = weights.sum()
+        gradient = np.array([(weights * d).sum() for d in (d_r, d_alpha, d_a, d_b)]) * np.exp(log_params)
+        return -(weights * ll).sum() / total, -gradient / total
+
+    def fit(self, frequency, recency, T, weights=None, initial_params=None, verbose=False, tol=1e-7, **kwargs):
+        """Fit the model; kwargs are options of scipy.optimize.minimize (e.g. maxiter)."""
+        _check_inputs(frequency, recency, T)
+        T = np.asarray(T, dtype=float)
+        (x, t_x, age), pattern_weights = _patterns(np.asarray(frequency).astype(int), recency, T, weights=weights)
+        # times scaled to a maximum age of 1 for the conditioning of the optimization, as lifetimes does
+        scale = 1.0 / T.max()
+        log_params = self._minimize(self._negative_log_likelihood, (x, t_x * scale, age * scale, pattern_weights),
+                                    initial_params, verbose, tol, **kwargs)
+        self.params_ = pd.Series(np.exp(log_params), index=self.param_names)
+        self.params_['alpha'] /= scale
+        self.n_subjects = len(T)
+        return self
+
+    def conditional_probability_alive(self, frequency, recency, T):
+        """Probability for a customer with the given history to be alive."""
+        r, alpha, a, b = self._unload_params('r', 'alpha', 'a', 'b')
+        log_div = (r + frequency) * np.log((alpha + T) / (alpha + recency)) + \
+            np.log(a / (b + np.maximum(frequency, 1) - 1))
+        return np.atleast_1d(np.where(frequency == 0, 1.0, expit(-log_div)))
+
+    def conditional_expected_number_of_purchases_up_to_time(self, t, frequency, recency, T):
+        """Expected number of purchases in the next t time units of a customer with the given history."""
+        r, alpha, a, b = self._unload_params('r', 'alpha', 'a', 'b')
+        x = frequency
+        _a, _b, _c = r + x, b + x, a + b + x - 1
+        _z = t / (alpha + T + t)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ln_hyp_term = np.log(hyp2f1(_a, _b, _c, _z))
+            # equivalent formula where the first one overflows
+            ln_hyp_term_alt = np.log(hyp2f1(_c - _a, _c - _b, _c, _z)) + (_c - _a - _b) * np.log(1 - _z)
+        ln_hyp_term = np.where(np.isinf(ln_hyp_term), ln_hyp_term_alt, ln_hyp_term)
+
+        numerator = (a + b + x - 1) / (a - 1) * (1 - np.exp(ln_hyp_term + (r + x) * np.log((alpha + T) /
+                                                                                           (alpha + t + T))))
+        denominator = 1 + (x > 0) * (a / (b + x - 1)) * ((alpha + T) / (alpha + recency)) ** (r + x)
+        return numerator / denominator
+
+    def expected_number_of_purchases_up_to_time(self, t):
+        """Expected number of purchases of a new customer in the first t time units."""
+        r, alpha, a, b = self._unload_params('r', 'alpha', 'a', 'b')
+        hyp = hyp2f1(r, b, a + b - 1, t / (alpha + t))
+        return (a + b - 1) / (a - 1) * (1 - hyp * (alpha / (alpha + t)) ** r)
+
+
+class GammaGammaFitter(_Fitter):
+    """Gamma-Gamma model of the average transaction value of the repeat customers."""
+
+    param_names = ['p', 'q', 'v']
+
+    @staticmethod
+    def _negative_log_likelihood(log_params, x, m, weights):
+        """Mean negative log-likelihood and its gradient w.r.t. log(p, q, v)."""
+        p, q, v = np.exp(log_params)
+        px = p * x
+        ll = gammaln(px + q) - gammaln(px) - gammaln(q) + q * np.log(v) + (px - 1) * np.log(m) + px * np.log(x) - \
+            (px + q) * np.log(x * m + v)
+
+        d_p = x * (digamma(px + q) - digamma(px) + np.log(m) + np.log(x) - np.log(x * m + v))
+        d_q = digamma(px + q) - digamma(q) + np.log(v) - np.log(x * m + v)
+        d_v = q / v - (px + q) / (x * m + v)
+
+        total = weights.sum()
+        gradient = np.array([(weights * d).sum() for d in (d_p, d_q, d_v)]) * np.exp(log_params)
+        return -(weights * ll).sum() / total, -gradient / total
+
+    def fit(self, frequency, monetary_value, weights=None, initial_params=None, verbose=False, tol=1e-7, **kwargs):
+        """Fit the model on the repeat customers; kwargs are options of scipy.optimize.minimize (e.g. maxiter)."""
+        _check_inputs(frequency, monetary_value=monetary_value)
+        (x, m), pattern_weights = _patterns(frequency, monetary_value, weights=weights)
+        log_params = self._minimize(self._negative_log_likelihood, (x, m, pattern_weights), initial_params, verbose,
+                                    tol, **kwargs)
+        self.params_ = pd.Series(np.exp(log_params), index=self.param_names)
+        self.n_subjects = len(np.asarray(frequency))
+        return self
+
+    def conditional_expected_average_profit(self, frequency, monetary_value):
+        """Expected average transaction value of a customer with the given history."""
+        p, q, v = self._unload_params('p', 'q', 'v')
+        individual_weight = p * frequency / (p * frequency + q - 1)
+        population_mean = v * p / (q - 1)
+        return (1 - individual_weight) * population_mean + individual_weight * monetary_value
@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+"""
+Process-wide country lookup of the plugins.
+
+Every plugin that labels countries used to build its own Location from the assets folder, which reloads the country
+asset files per plugin and per run, and then called it once per transaction (Series.apply). CountryLookup.shared
+returns one lookup per assets folder and process: the Location behind it is built on first use only, so constructing
+the lookup again costs nothing, and a lookup built before the workers of a pool are forked is shared by them
+(copy-on-write pages).
+
+iso3() and names() resolve every distinct value once. The lookup is immutable: the values resolved are not cached on
+it, but read from an optional prebuilt binary index, written by CountryLookup.build_index: a NumPy structured array of
+(value, ISO3 code, name) sorted by value, memory-mapped read-only, so that the processes reading it share its pages
+and never need the Location for the values it holds. The values missing from the index go to the Location.
+"""
+
+import threading
+import numpy as np
+import pandas as pd
+from os.path import abspath
+from ...utils.location import Location
+
+# width of the index fields (longer values are not indexed)
+INDEX_VALUE_LENGTH = 64
+INDEX_DTYPE = np.dtype([('value', 'U%d' % INDEX_VALUE_LENGTH), ('iso3', 'U3'),
+                        ('name', 'U%d' % INDEX_VALUE_LENGTH)])
+
+
+class CountryLookup:
+
+    _lock = threading.Lock()
+    _shared = {}
+
+    def __init__(self, assets, index_file=None):
+        self.assets = assets
+        self.index_file = index_file
+        self._location = None
+        self._index = None
+
+    @staticmethod
+    def shared(assets, index_file=None):
+        """The lookup of the process for an assets folder (and index file): built once, then returned as is."""
+        key = (abspath(assets), None if index_file is None else abspath(index_file))
+        with CountryLookup._lock:
+            lookup = CountryLookup._shared.get(key)
+            if lookup is None:
+                lookup = CountryLookup._shared[key] = CountryLookup(assets, index_file)
+            return lookup
+
+    @staticmethod
+    def from_options(options):
+        """The shared lookup of the assets option, with the prebuilt index of the countryIndex option if any."""
+        return CountryLookup.shared(options['assets'], options.get('countryIndex'))
+
+    @property
+    def location(self):
+        """The Location of the assets folder, loaded on first use."""
+        if self._location is None:
+            with CountryLookup._lock:
+                if self._location is None:
+                    self._location = Location(self.assets)
+        return self._location
+
+    @property
+    def index(self):
+        """The prebuilt index (read-only, memory-mapped), None without index file."""
+        if self._index is None and self.index_file is not None:
+            with CountryLookup._lock:
+                if self._index is None:
+                    self._index = np.load(self.index_file, mmap_mode='r')
+        return self._index
+
+    def _resolve(self, values, field, method):
+        values = pd.Series(values).reset_index(drop=True)
+        codes, uniques = pd.factorize(values)
+        uniques = np.asarray(uniques, dtype=object)
+
+        resolved = np.empty(len(uniques) + 1, dtype=object)
+        found = np.zeros(len(uniques), dtype=bool)
+        index = self.index
+        if index is not None and len(index) and len(uniques):
+            keys = np.array([value if isinstance(value, str) else '' for value in uniques])
+            positions = np.minimum(np.searchsorted(index['value'], keys), len(index) - 1)
+            found = (index['value'][positions] == keys) & (keys != '')
+            resolved[:-1][found] = index[field][positions[found]].tolist()
+        get = getattr(self.location, method) if not found.all() or (codes < 0).any() else None
+        for i in np.flatnonzero(~found):
+            resolved[i] = get(uniques[i])
+        if (codes < 0).any():
+            # the missing values (all factorized to -1) go to the Location as they are
+            resolved[-1] = get(values[codes < 0].iloc[0])
+        return resolved[codes]
+
+    def iso3(self, values):
+        """ISO3 codes of the countries (an array aligned with values)."""
+        return self._resolve(values, 'iso3', 'get_country_iso3')
+
+    def names(self, values):
+        """Names of the countries (an array aligned with values)."""
+        return self._resolve(values, 'name', 'get_country_name')
+
+    @staticmethod
+    def build_index(assets, values, index_file):
+        """
+        Write the index of the country values (e.g. the ISO2 codes of the transactions) to index_file (.npy), from the
+        Location of the assets folder. The values the Location does not resolve to strings are left out.
+        """
+        location = CountryLookup.shared(assets).location
+        rows = []
+        for value in sorted(set(value for value in values if isinstance(value, str))):
+            iso3, name = location.get_country_iso3(value), location.get_country_name(value)
+            if len(value) <= INDEX_VALUE_LENGTH and isinstance(iso3, str) and isinstance(name, str) \
+                    and len(iso3) <= 3 and len(name) <= INDEX_VALUE_LENGTH:
+                rows.append((value, iso3, name))
+        np.save(index_file, np.array(rows, dtype=INDEX_DTYPE))
@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+"""
+Customer-flow series on integer period codes (see date_tools.period_codes): new / returning / total active customers
+per period, retention cohorts and churn rates.
+
+The customers are factorized to integer codes and the dates bucketed to integer period codes, so no Python object is
+built per transaction and the cost does not depend on the granularity. Every (customer, period) pair is packed into a
+single int64 key (customer code in the high 32 bits, period offset in the low 32 bits) and deduplicated with one hash
+pass; the per-customer quantities are then groupby-min/max and the series bincounts on the period offsets.
+"""
+
+import numpy as np
+import pandas as pd
+from .date_tools import DEFAULT_GRANULARITY, MISSING_PERIOD, period_codes
+
+PERIOD_BITS = 32
+
+
+def _active_periods(customer_ids, periods):
+    """
+    Distinct (customer, period) pairs of the transactions, as the customer codes, the customer IDs (uniques) and the
+    period codes of the pairs. Transactions with a missing customer or period are ignored.
+    """
+    customers, customer_ids = pd.factorize(np.asarray(customer_ids))
+    known = (customers >= 0) & (periods != MISSING_PERIOD)
+    customers = customers[known].astype(np.int64)
+    periods = periods[known]
+    if not len(periods):
+        return customers, customer_ids, periods
+
+    first_period = periods.min()
+    pairs = pd.unique((customers << PERIOD_BITS) | (periods - first_period))
+    return pairs >> PERIOD_BITS, customer_ids, (pairs & ((1 << PERIOD_BITS) - 1)) + first_period
+
+
+def activity_per_period(customer_ids, dates, granularity=DEFAULT_GRANULARITY):
+    """
+    Number of new, returning and total active customers per period (index: period code), for the periods with at
+    least one active customer. A customer is new in their first active period and returning in every later one.
+    """
+    customers, _, periods = _active_periods(customer_ids, period_codes(dates, granularity))
+
+    columns = ['new_customers', 'returning_customers', 'total_customers']
+    if not len(periods):
+        return pd.DataFrame(columns=columns, index=pd.Index([], name='period', dtype=np.int64), dtype=int)
+
+    first_active_period = pd.Series(periods).groupby(customers).min()
+    is_new = periods == first_active_period.reindex(customers).values
+
+    offsets = periods - periods.min()
+    total = np.bincount(offsets)
+    new = np.bincount(offsets[is_new], minlength=len(total))
+    active = np.flatnonzero(total)
+
+    return pd.DataFrame({
+        'new_customers': new[active],
+        'returning_customers': (total - new)[active],
+        'total_customers': total[active]
+    }, columns=columns, index=pd.Index(active + periods.min(), name='period'))
+
+
+def cohort_counts(customer_ids, dates, first_periods, first_period, n_periods, granularity=DEFAULT_GRANULARITY):
+    """
+    Retention cohorts of the periods first_period .. first_period + n_periods - 1. Cohort i holds the customers whose
+    first period (first_periods: a Series of period codes indexed by customer ID) is period i and who are active in
+    period i. Returns the number of customers of every cohort active at every period offset j (n_periods x n_periods,
+    NaN beyond the last period) and the number of them active at offset j or later (the same shape, NaN in column 0).
+    """
+    customers, customer_ids, periods = _active_periods(customer_ids, period_codes(dates, granularity))
+    n_active = np.full((n_periods, n_periods), np.nan)
+    n_active_later = np.full((n_periods, n_periods), np.nan)
+    valid = np.arange(n_periods)[:, np.newaxis] + np.arange(n_periods)[np.newaxis, :] < n_periods
+    n_active[valid] = 0
+    n_active_later[valid] = 0
+    n_active_later[:, 0] = np.nan
+    if not len(periods):
+        return n_active, n_active_later
+
+    first_periods = first_periods[~first_periods.index.duplicated(keep='first')].reindex(customer_ids).values
+    has_cohort = ~pd.isnull(first_periods) & (first_periods != MISSING_PERIOD)
+    cohorts = np.where(has_cohort, first_periods, first_period - 1).astype(np.int64)[customers] - first_period
+    offsets = periods - first_period - cohorts
+    in_range = (cohorts >= 0) & (cohorts < n_periods) & (offsets >= 0) & (offsets < n_periods - cohorts)
+
+    # only the customers active in the period of their cohort belong to it
+    members = np.unique(customers[in_range & (offsets == 0)])
+    in_range &= np.isin(customers, members)
+    customers, cohorts, offsets = customers[in_range], cohorts[in_range], offsets[in_range]
+
+    n_active[valid] = np.bincount(cohorts * n_periods + offsets, minlength=n_periods * n_periods) \
+        .reshape(n_periods, n_periods)[valid]
+
+    # a customer is active at offset j or later iff their last active offset is >= j
+    last_offsets = pd.Series(offsets).groupby(customers).max()
+    member_cohorts = pd.Series(cohorts).groupby(customers).first()
+    last_counts = np.bincount(member_cohorts.values * n_periods + last_offsets.values,
+                              minlength=n_periods * n_periods).reshape(n_periods, n_periods)
+    later = np.cumsum(last_counts[:, ::-1], axis=1)[:, ::-1]
+    n_active_later[:, 1:][valid[:, 1:]] = later[:, 1:][valid[:, 1:]]
+    return n_active, n_active_later
+
+
+def churn_counts(first_periods, last_periods, first_active_periods, first_period, n_periods):
+    """
+    Churned and at-risk customers of the periods first_period .. first_period + n_periods - 1 (period codes, one
+    array entry per customer). A customer churns in the period of their last purchase if their first purchase is in an
+    earlier period; a customer is at risk in period p if active in p or before and purchasing again after p. Returns
+    the two counts per period.
+    """
+    n_periods = int(n_periods)
+
+    def offsets(periods):
+        return np.asarray(periods, dtype=np.int64) - first_period
+
+    first, last, first_active = offsets(first_periods), offsets(last_periods), offsets(first_active_periods)
+    known = (np.asarray(first_periods) != MISSING_PERIOD) & (np.asarray(last_periods) != MISSING_PERIOD) & \
+        (np.asarray(first_active_periods) != MISSING_PERIOD)
+    first, last, first_active = first[known], last[known], first_active[known]
+
+    churned = (first < last) & (last >= 0) & (last < n_periods)
+    n_churned = np.bincount(last[churned], minlength=n_periods)[:n_periods]
+
+    # at risk over the periods [first_active, last): +1 at the first one, -1 after the last one, then cumulated
+    at_risk = first_active < last
+    starts = np.clip(first_active[at_risk], 0, n_periods)
+    ends = np.clip(last[at_risk], 0, n_periods)
+    steps = np.bincount(starts, minlength=n_periods + 1) - np.bincount(ends, minlength=n_periods + 1)
+    n_at_risk = np.cumsum(steps)[:n_periods]
+    return n_churned, n_at_risk
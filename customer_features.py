@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+"""
+Sparse customer feature matrix of the retention analysis of CustomerRCLandBenchmarking.
+
+The count features of a customer (the number of its purchases per card category, card brand, payment method,
+weekday, month and period of the day) used to be aggregated into one Python list per customer and expanded into one
+dense column per value, then every column got its own StandardScaler. CustomerFeatureMatrix builds them as a SciPy
+sparse count matrix directly from the (customer code, feature code) pair of every transaction, next to the numeric
+customer features, and scales the whole matrix at once. The scaling divides by the standard deviation without
+centering, which would fill the matrix; the decision trees the matrix is meant for split the same way on both.
+"""
+
+import numpy as np
+import pandas as pd
+from .lazy_import import lazy_module, lazy_names
+
+# imported by the first build (see lazy_import)
+sparse = lazy_module('scipy.sparse')
+preprocessing = lazy_module('sklearn.preprocessing')
+DecisionTreeClassifier = lazy_names('sklearn.tree', 'DecisionTreeClassifier')
+KFold = lazy_names('sklearn.model_selection', 'KFold')
+
+NUMERIC_FEATURES = ['n_transactions', 'monetary_value', 'avg_n_days_between_purchases', 'n_days_since_last_purchase',
+                    'is_periodic_buyer']
+WEEKDAYS = ['monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday']
+MONTHS = ['jan', 'feb', 'mar', 'apr', 'may', 'jun', 'jul', 'aug', 'sep', 'oct', 'nov', 'dec']
+DAY_PERIODS = ['morning', 'noon', 'afternoon', 'evening', 'night']
+# first hour of the morning, noon, afternoon, evening and night periods (the night runs until the morning)
+DAY_PERIOD_HOURS = [6, 10, 14, 18, 22]
+N_SPLITS = 5
+
+
+def feature_name(value):
+    """Name of the count feature of a category value."""
+    return str(value).lower().replace(' ', '_')
+
+
+class CustomerFeatureMatrix:
+
+    def __init__(self, vocabularies, customer_id, transaction_date):
+        # [(column, category values)], the values in the order of their features
+        self.vocabularies = vocabularies
+        self.customer_id = customer_id
+        self.transaction_date = transaction_date
+        self.feature_names = list(NUMERIC_FEATURES)
+        for _, values in vocabularies:
+            self.feature_names += [feature_name(value) for value in values]
+        self.feature_names += ['weekday_' + day for day in WEEKDAYS]
+        self.feature_names += ['transaction_date_month_' + month for month in MONTHS]
+        self.feature_names += ['dayperiod_' + period for period in DAY_PERIODS]
+
+    @staticmethod
+    def from_transactions(transactions, columns, customer_id, transaction_date):
+        """
+        Feature matrix with a count feature per value of the category columns (of those present) in the transactions,
+        missing values left out, so that the features are the same for every subset of the transactions.
+        """
+        vocabularies = [(column, [value for value in transactions[column].unique() if str(value).lower() != 'nan'])
+                        for column in columns if column in transactions.columns]
+        return CustomerFeatureMatrix(vocabularies, customer_id, transaction_date)
+
+    def _count_codes(self, transactions):
+        """Count feature (relative to the first count feature) of every transaction and count block, -1 for none."""
+        dates = transactions[self.transaction_date]
+        hours = dates.dt.hour.values
+        day_periods = np.searchsorted(DAY_PERIOD_HOURS, hours, side='right') - 1
+        day_periods[day_periods < 0] = len(DAY_PERIODS) - 1
+        blocks = [(pd.Index(values).get_indexer(transactions[column]), len(values))
+                  for column, values in self.vocabularies]
+        blocks += [(dates.dt.weekday.values, len(WEEKDAYS)), (dates.dt.month.values - 1, len(MONTHS)),
+                   (day_periods, len(DAY_PERIODS))]
+        offset = 0
+        for codes, n_codes in blocks:
+            yield np.where(codes >= 0, codes + offset, -1)
+            offset += n_codes
+
+    def build(self, customers, transactions):
+        """
+        Features (a CSR matrix, a row per customer and a column per feature name) of the customers, from their
+        NUMERIC_FEATURES columns and from their transactions; the missing numeric values count as 0.
+        """
+        n_customers = len(customers)
+        numeric = customers[NUMERIC_FEATURES].astype(float).fillna(0).values
+
+        customer_codes = pd.Index(customers[self.customer_id]).get_indexer(transactions[self.customer_id])
+        rows, columns = [], []
+        for codes in self._count_codes(transactions):
+            known = (codes >= 0) & (customer_codes >= 0)
+            rows.append(customer_codes[known])
+            columns.append(codes[known])
+        rows, columns = np.concatenate(rows), np.concatenate(columns)
+        # the duplicate (customer, feature) pairs are summed into counts
+        counts = sparse.coo_matrix((np.ones(len(rows)), (rows, columns)),
+                                   shape=(n_customers, len(self.feature_names) - len(NUMERIC_FEATURES)))
+        return sparse.hstack([sparse.csr_matrix(numeric), counts], format='csr')
+
+    @staticmethod
+    def scale(features):
+        """The features divided by their standard deviation, over the whole matrix at once (sparsity kept)."""
+        return preprocessing.StandardScaler(with_mean=False).fit_transform(features)
+
+
+def feature_importances(features, labels, n_splits=N_SPLITS, random_state=0):
+    """
+    Importance of every feature for a decision tree predicting the labels: the mean and the standard deviation of the
+    importances of the trees fitted on the folds of a k-fold split, and the mean accuracy of the trees on their
+    held-out fold. Zeros without at least two customers and two labels.
+    """
+    labels = np.asarray(labels)
+    n_splits = min(n_splits, len(labels))
+    if n_splits < 2 or len(np.unique(labels)) < 2:
+        return np.zeros(features.shape[1]), np.zeros(features.shape[1]), 0
+    importances, accuracies = [], []
+    for train, test in KFold(n_splits=n_splits, shuffle=True, random_state=random_state).split(labels):
+        tree = DecisionTreeClassifier(random_state=random_state).fit(features[train], labels[train])
+        importances.append(tree.feature_importances_)
+        accuracies.append(tree.score(features[test], labels[test]))
+    return np.mean(importances, axis=0), np.std(importances, axis=0), float(np.mean(accuracies))
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+"""
+Purchase timeline of every customer.
+
+CustomerTimeline sorts the transactions once by (customer, date) and keeps the sorted dates with the position of every
+customer's first purchase. The first, second, last or any nth purchase date is then a single take at an offset from
+those positions, and the gaps between consecutive purchases are a single difference of the sorted dates, instead of a
+groupby with a MultiIndex result per feature (groupby(...).nsmallest(2).groupby(level=...).last()).
+"""
+
+import numpy as np
+import pandas as pd
+from .date_tools import day_deltas
+
+
+class CustomerTimeline:
+
+    def __init__(self, transactions, customer_key, date_key):
+        codes, self.customer_ids = pd.factorize(transactions[customer_key])
+        dates = np.asarray(transactions[date_key], dtype='datetime64[ns]')
+        keep = (codes >= 0) & ~np.isnat(dates)
+        codes, dates = codes[keep], dates[keep]
+
+        order = np.lexsort((dates, codes))
+        self.codes = codes[order]
+        self.dates = dates[order]
+        self.counts = np.bincount(self.codes, minlength=len(self.customer_ids))
+        self.starts = np.concatenate([[0], np.cumsum(self.counts)[:-1]])
+
+    def _per_customer(self, values, name):
+        return pd.Series(values, index=pd.Index(self.customer_ids), name=name)
+
+    def rank(self):
+        """0-based rank of every purchase of the sorted timeline within its customer's purchases."""
+        return np.arange(len(self.codes)) - self.starts[self.codes]
+
+    def nth_dates(self, n, name=None):
+        """Date of the nth purchase (1-based; negative from the last one) per customer, NaT if fewer purchases."""
+        positions = self.starts + (n - 1 if n > 0 else self.counts + n)
+        has_nth = self.counts >= abs(n)
+        dates = np.full(len(self.counts), np.datetime64('NaT'), dtype='datetime64[ns]')
+        dates[has_nth] = self.dates[positions[has_nth]]
+        return self._per_customer(dates, name)
+
+    def gaps(self):
+        """Days since the previous purchase of the customer, for every purchase of the sorted timeline (NaN first)."""
+        gaps = np.full(len(self.dates), np.nan)
+        if len(self.dates) > 1:
+            gaps[1:] = day_deltas(self.dates[1:], self.dates[:-1])
+        gaps[self.starts[self.counts > 0]] = np.nan
+        return gaps
+
+    def summary(self):
+        """
+        First, second and last purchase dates, number of purchases, days from the first to the second purchase and
+        mean days between consecutive purchases, per customer.
+        """
+        gaps = np.nan_to_num(self.gaps())
+        repeat = self.counts > 1
+        mean_gaps = np.full(len(self.counts), np.nan)
+        mean_gaps[repeat] = np.bincount(self.codes, weights=gaps, minlength=len(self.counts))[repeat] / \
+            (self.counts[repeat] - 1)
+
+        summary = pd.DataFrame({
+            'first_transaction_date': self.nth_dates(1),
+            'second_transaction_date': self.nth_dates(2),
+            'last_transaction_date': self.nth_dates(-1),
+            'n_transactions': self._per_customer(self.counts, None),
+        })
+        summary['days_first_to_second'] = day_deltas(summary['second_transaction_date'],
+                                                     summary['first_transaction_date'])
+        summary['mean_days_between_purchases'] = mean_gaps
+        return summary
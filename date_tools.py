@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+"""
+Date arithmetic on datetime64 arrays shared by the customer plugins.
+
+The plugins used to compute day deltas and month labels with .apply over Timedelta / Timestamp objects, one Python
+object per row. These helpers work on the int64 nanoseconds behind the datetime64 values instead, and format a label
+only once per distinct month. Series, arrays and scalars (Timestamp, datetime) are accepted; NaT stays missing.
+
+The period helpers bucket the dates into integer period codes at a configurable granularity (day, week starting on
+Monday, month or quarter): consecutive periods have consecutive codes, so the customer-flow series are computed with
+integer arithmetic and bincounts on the codes whatever the granularity, and only the periods of the result are turned
+back into dates, keys and labels.
+"""
+
+import numpy as np
+import pandas as pd
+
+NANOSECONDS_PER_DAY = 24 * 60 * 60 * 10 ** 9
+
+GRANULARITIES = ['day', 'week', 'month', 'quarter']
+DEFAULT_GRANULARITY = 'month'
+# code of the missing dates
+MISSING_PERIOD = np.iinfo(np.int64).min
+# 1970-01-01, day 0, is a Thursday: weeks start 3 days earlier
+_WEEK_OFFSET = 3
+
+
+def _datetime64(dates):
+    return np.asarray(dates, dtype='datetime64[ns]')
+
+
+def day_deltas(end, start):
+    """
+    Whole days from start to end, rounded down like Timedelta.days: an int64 array, or a float array with NaN where
+    either date is missing.
+    """
+    deltas = _datetime64(end) - _datetime64(start)
+    missing = np.isnat(deltas)
+    days = deltas.view('int64') // NANOSECONDS_PER_DAY
+    if not missing.any():
+        return days
+    days = days.astype(float)
+    days[missing] = np.nan
+    return days
+
+
+def month_buckets(dates):
+    """First day of the month of every date, as datetime64[ns]."""
+    return _datetime64(dates).astype('datetime64[M]').astype('datetime64[ns]')
+
+
+def month_labels(dates, date_format='%b-%y'):
+    """Label ('Jan-20') of the month of every date, as a list; each distinct month is formatted once."""
+    codes, months = pd.factorize(month_buckets(dates))
+    labels = np.array([month.strftime(date_format) for month in pd.DatetimeIndex(months)] + [None], dtype=object)
+    return labels[codes].tolist()
+
+
+def granularity_option(options):
+    """The granularity option of a plugin (default DEFAULT_GRANULARITY)."""
+    granularity = options.get('granularity', DEFAULT_GRANULARITY)
+    if granularity not in GRANULARITIES:
+        raise ValueError('Unknown granularity {granularity}, expected one of {granularities}'
+                         .format(granularity=granularity, granularities=GRANULARITIES))
+    return granularity
+
+
+def period_codes(dates, granularity=DEFAULT_GRANULARITY):
+    """Integer code of the period of every date (an int64 array, MISSING_PERIOD for NaT)."""
+    dates = _datetime64(dates)
+    if granularity in ('day', 'week'):
+        codes = dates.astype('datetime64[D]').astype(np.int64)
+        if granularity == 'week':
+            codes = (codes + _WEEK_OFFSET) // 7
+    else:
+        codes = dates.astype('datetime64[M]').astype(np.int64)
+        if granularity == 'quarter':
+            codes = codes // 3
+    return np.where(np.isnat(dates), MISSING_PERIOD, codes)
+
+
+def period_starts(codes, granularity=DEFAULT_GRANULARITY):
+    """First instant of the period of every code, as datetime64[ns]."""
+    codes = np.asarray(codes, dtype=np.int64)
+    if granularity == 'day':
+        starts = codes.astype('datetime64[D]')
+    elif granularity == 'week':
+        starts = (codes * 7 - _WEEK_OFFSET).astype('datetime64[D]')
+    elif granularity == 'month':
+        starts = codes.astype('datetime64[M]')
+    else:
+        starts = (codes * 3).astype('datetime64[M]')
+    return starts.astype('datetime64[ns]')
+
+
+def _format_periods(codes, granularity, formatter):
+    codes = np.asarray(codes, dtype=np.int64)
+    unique_codes, inverse = np.unique(codes, return_inverse=True)
+    formatted = np.array([formatter(start) for start in pd.DatetimeIndex(period_starts(unique_codes, granularity))],
+                         dtype=object)
+    return formatted[inverse].tolist()
+
+
+def period_keys(codes, granularity=DEFAULT_GRANULARITY):
+    """
+    Key of the period of every code, as a list: 'm-YYYY' for the months (the keys the plugins always used),
+    'Qq-YYYY' for the quarters and the ISO date of the first day for the days and weeks.
+    """
+    if granularity == 'month':
+        return _format_periods(codes, granularity, lambda start: '{m}-{y}'.format(m=start.month, y=start.year))
+    if granularity == 'quarter':
+        return _format_periods(codes, granularity, lambda start: 'Q{q}-{y}'.format(q=start.quarter, y=start.year))
+    return _format_periods(codes, granularity, lambda start: start.strftime('%Y-%m-%d'))
+
+
+def period_labels(codes, granularity=DEFAULT_GRANULARITY, date_format=None):
+    """
+    Display label of the period of every code, as a list: the first day formatted with date_format (default '%b-%y'
+    for the months, '%d %b %y' for the days and weeks), or 'Qq-yy' for the quarters.
+    """
+    if granularity == 'quarter':
+        return _format_periods(codes, granularity, lambda start: 'Q{q}-{y}'.format(q=start.quarter,
+                                                                                  y=start.strftime('%y')))
+    date_format = date_format or ('%b-%y' if granularity == 'month' else '%d %b %y')
+    return _format_periods(codes, granularity, lambda start: start.strftime(date_format))
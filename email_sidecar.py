@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+"""
+Customer email lists written next to out.pickle instead of into it.
+
+The mailing lists of the customer plugins (the emails of every segment, and of every segment and country) used to be
+joined into one '; '-separated string per list and pickled with the rest of the result, so that plot() and report(),
+which never use them, loaded hundreds of MB for millions of customers. EmailSidecar streams every list to its own
+gzip-compressed text file (one email per line) under the emails folder of the process output, and the result only
+keeps the number of emails and the file of every list, relative to the process output folder.
+"""
+
+import gzip
+import shutil
+import numpy as np
+import pandas as pd
+from os import makedirs
+from os.path import join
+
+EMAILS_FOLDER = 'emails'
+COMPRESS_LEVEL = 6
+# emails joined per write call
+WRITE_BATCH = 100000
+
+
+def valid_emails(emails):
+    """Mask of the usable emails: not missing, empty or the 'nan' left by a string conversion."""
+    emails = pd.Series(emails)
+    return (emails.notnull() & ~emails.astype(str).isin(['', 'nan'])).values
+
+
+def read_emails(output_folder, email_file):
+    """The emails of a list, from the folder of out.pickle and the file reference of the list ([] for None)."""
+    if email_file is None:
+        return []
+    with gzip.open(join(output_folder, email_file), 'rt', encoding='utf-8') as handle:
+        return handle.read().splitlines()
+
+
+class EmailSidecar:
+
+    def __init__(self, output_folder):
+        self.output_folder = output_folder
+        # the lists of a previous run are dropped
+        shutil.rmtree(join(output_folder, EMAILS_FOLDER), ignore_errors=True)
+        makedirs(join(output_folder, EMAILS_FOLDER))
+
+    def write(self, name, emails):
+        """Write a list of emails to emails/<name>.txt.gz; returns the file, relative to the output folder."""
+        email_file = join(EMAILS_FOLDER, name + '.txt.gz')
+        with gzip.open(join(self.output_folder, email_file), 'wt', encoding='utf-8', compresslevel=COMPRESS_LEVEL) \
+                as email_out:
+            for start in range(0, len(emails), WRITE_BATCH):
+                email_out.write(''.join(email + '\n' for email in emails[start:start + WRITE_BATCH]))
+        return email_file
+
+    def export(self, emails, groups, name_format):
+        """
+        Write the valid emails of every group to its own file, named by name_format formatted with the group levels
+        ('segment_{0}_{1}'). groups is a list of arrays aligned with emails, one per level; the rows with a missing
+        level are left out. Returns {group: (number of emails, file)} for the groups with at least one valid email,
+        the group being the level value, or the tuple of the level values for several levels.
+        """
+        valid = valid_emails(emails)
+        emails = pd.Series(np.asarray(emails, dtype=object)[valid]).astype(str)
+        groups = [pd.Series(np.asarray(levels, dtype=object)[valid]) for levels in groups]
+
+        exported = {}
+        for group, group_emails in emails.groupby(groups if len(groups) > 1 else groups[0], sort=True):
+            levels = group if isinstance(group, tuple) else (group,)
+            exported[group] = (len(group_emails), self.write(name_format.format(*levels), group_emails.tolist()))
+        return exported
@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+"""
+Managed matplotlib figures for the plugins drawing with matplotlib/seaborn.
+
+The figures are created with the object-oriented API on an Agg canvas, so they are never registered in pyplot's global
+figure manager and are released as soon as the context exits. The rc settings given to the context only apply while
+it is open: plugins must not mutate plt.rcParams (or call sns.set) any more.
+"""
+
+from contextlib import contextmanager
+
+
+@contextmanager
+def managed_figure(figsize=None, rc=None, **kwargs):
+    """
+    Yield a new Figure attached to an Agg canvas. The rc parameters are isolated to the with-block, the figure has to be
+    saved inside it (fig.savefig) and is cleared deterministically on exit, even on error.
+    """
+    # imported on the first figure, not with the plugins (see lazy_import)
+    import matplotlib
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+    with matplotlib.rc_context(rc):
+        fig = Figure(figsize=figsize, **kwargs)
+        FigureCanvasAgg(fig)
+        try:
+            yield fig
+        finally:
+            fig.clear()
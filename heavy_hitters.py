@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+"""
+Space-Saving sketch of the heaviest keys of a weighted stream.
+
+The sketch keeps at most `capacity` counters. Every chunk is first aggregated per key (exact within the chunk) and then
+merged: known keys are incremented, new keys start from the current eviction threshold (the largest count evicted so
+far), which is recorded as their error, and only the `capacity` largest counters are kept. For every key of the sketch,
+count - error <= true weight <= count, and any key outside the sketch has a true weight <= threshold. Weights must be
+non-negative.
+"""
+
+import pandas as pd
+
+
+class SpaceSaving:
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.counts = pd.Series(dtype=float)
+        self.errors = pd.Series(dtype=float)
+        self.threshold = 0.0
+
+    def update(self, keys, weights):
+        """Add a chunk of (key, weight) pairs to the sketch."""
+        chunk = pd.Series(weights).groupby(pd.Series(keys).values).sum()
+        self.merge_counts(chunk)
+
+    def merge_counts(self, chunk):
+        """Add a Series of weights summed per key (index) to the sketch."""
+        known = chunk.index.isin(self.counts.index)
+        new = chunk[~known]
+
+        counts = self.counts.add(chunk[known], fill_value=0)
+        counts = pd.concat([counts, new + self.threshold])
+        errors = pd.concat([self.errors, pd.Series(self.threshold, index=new.index)])
+
+        if len(counts) > self.capacity:
+            counts = counts.sort_values(ascending=False, kind='mergesort')
+            self.threshold = max(self.threshold, counts.iloc[self.capacity])
+            counts = counts.iloc[:self.capacity]
+        self.counts = counts
+        self.errors = errors.reindex(counts.index)
+
+    def top(self, n):
+        """
+        The n heaviest keys as a DataFrame indexed by key, with the estimated weight ('count'), its lower bound
+        ('lower') and whether the key is guaranteed to be among the true n heaviest ('guaranteed').
+        """
+        top = pd.DataFrame({'count': self.counts, 'lower': self.counts - self.errors}) \
+            .sort_values(by='count', ascending=False, kind='mergesort')
+        # a key is surely in the top n if its lower bound beats the estimate of every key outside the top n
+        outside = top['count'].iloc[n] if len(top) > n else self.threshold
+        top = top.iloc[:n].copy()
+        top['guaranteed'] = top['lower'] >= max(outside, self.threshold)
+        return top
@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+"""
+Lazy imports of the rendering and modelling libraries of the plugins.
+
+plotly, reportlab, matplotlib, seaborn and sklearn take seconds and hundreds of MB to import, and most of the plugins
+only need them in plot() / report() or in a fit step. The plugin modules bind these names to stand-ins instead: the
+real module (or module attribute) is imported on the first attribute access or call, so a worker that only runs
+process() never loads them. The stand-ins work for calls and attribute access (go.Figure(...), Report.draw_text_right,
+colors.black); code that needs the real object (isinstance, subclassing) goes through an attribute of a lazy module
+(isinstance(palette, mcolors.Colormap)).
+
+Benchmark.startup measures the import time and memory of every plugin module.
+"""
+
+from importlib import import_module
+
+_UNRESOLVED = object()
+
+
+class LazyImport:
+    """Stand-in for a module, or for an attribute of a module, imported on first use."""
+
+    def __init__(self, module_name, attribute=None, package=None):
+        self._module_name = module_name
+        self._attribute = attribute
+        self._package = package
+        self._target = _UNRESOLVED
+
+    def _resolve(self):
+        if self._target is _UNRESOLVED:
+            module = import_module(self._module_name, self._package)
+            self._target = module if self._attribute is None else getattr(module, self._attribute)
+        return self._target
+
+    def __getattr__(self, name):
+        # only called for the attributes the stand-in does not have itself
+        return getattr(self._resolve(), name)
+
+    def __call__(self, *args, **kwargs):
+        return self._resolve()(*args, **kwargs)
+
+    def __repr__(self):
+        name = self._module_name if self._attribute is None else self._module_name + '.' + self._attribute
+        state = 'unresolved' if self._target is _UNRESOLVED else 'resolved'
+        return '<LazyImport {name} ({state})>'.format(name=name, state=state)
+
+
+def lazy_module(module_name, package=None):
+    """Stand-in for 'import module_name' (package: anchor of a relative module name, as in importlib)."""
+    return LazyImport(module_name, package=package)
+
+
+def lazy_names(module_name, *names, package=None):
+    """Stand-ins for 'from module_name import names': a single one for one name, a tuple for several."""
+    stand_ins = tuple(LazyImport(module_name, name, package) for name in names)
+    return stand_ins[0] if len(stand_ins) == 1 else stand_ins
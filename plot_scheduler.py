@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+"""
+Plot scheduler: runs the chart jobs declared by the plugins on a process pool.
+
+Once out.pickle exists every chart is independent, so a plugin can describe its plot phase as a list of ChartJob
+(returned by its plot_jobs method) instead of drawing the figures one by one. The scheduler collects the jobs of all
+the plugins, runs them in worker processes that each own their matplotlib (Agg) and plotly state, and reports the
+render time of every chart. Plugins without plot_jobs are plotted in the main process while the pool is busy.
+
+The workers are spawned rather than forked, so that none of them inherits the render thread pool or the orca server of
+the main process (which exist after a first run or any plot() in the main process). Every worker starts its own orca
+server instead of sharing the single warm one of the main process: the charts render in parallel, at the cost of one
+server (and RenderService.MAX_WORKERS export threads) per worker, which is why the pool is capped at
+DEFAULT_MAX_WORKERS workers.
+"""
+
+import os
+import time
+import multiprocessing
+from collections import namedtuple
+from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from .render_service import RenderService
+from .result_bus import ResultBus
+from .lazy_import import lazy_module
+from wepair.utils_common.log import Log
+
+# imported by the plot phase only (see lazy_import)
+plt = lazy_module('matplotlib.pyplot')
+
+# log
+logger = Log(__name__).get_logger()
+
+# function(data, *args) draws one chart from the content of data_file (the out.pickle of the plugin)
+ChartJob = namedtuple('ChartJob', ['plugin_name', 'chart_name', 'function', 'data_file', 'args'])
+
+# start method of the plot workers (see the module docstring)
+MP_CONTEXT = 'spawn'
+# every worker runs its own orca server
+DEFAULT_MAX_WORKERS = 4
+
+
+def _init_worker():
+    """Give the worker its own non-interactive matplotlib state and its own renderer (started on first use)."""
+    # no-op in a spawned worker; drops the state of the parent if the pool forks
+    RenderService.reset()
+    plt.switch_backend('Agg')
+    plt.rcdefaults()
+    _load_data.cache_clear()
+
+
+@lru_cache(maxsize=4)
+def _load_data(data_file):
+    return ResultBus.load_file(data_file)
+
+
+def _run_job(job):
+    """Draw one chart and return its render time in seconds."""
+    start = time.perf_counter()
+    try:
+        job.function(_load_data(job.data_file), *job.args)
+        RenderService.flush()
+    finally:
+        plt.close('all')
+    return time.perf_counter() - start
+
+
+class PlotScheduler:
+
+    @staticmethod
+    def run_jobs(jobs):
+        """Run the chart jobs of a single plugin sequentially in the current process (used by Plugin.plot)."""
+        timings = []
+        for job in jobs:
+            timings.append({'plugin': job.plugin_name, 'chart': job.chart_name, 'seconds': _run_job(job)})
+        _load_data.cache_clear()
+        return timings
+
+    @staticmethod
+    def run(plugins, max_workers=None, mp_context=MP_CONTEXT, **kwargs):
+        """
+        Plot all the plugins. The chart jobs are rendered on a pool of max_workers processes (default: the number of
+        CPUs, at most DEFAULT_MAX_WORKERS) started with mp_context; kwargs are the plot keyword arguments (cmap, ...).
+        Returns the list of per-chart timings, sorted from the slowest to the fastest.
+        """
+        if max_workers is None:
+            max_workers = min(os.cpu_count() or 1, DEFAULT_MAX_WORKERS)
+        jobs = []
+        sequential_plugins = []
+        for plugin in plugins:
+            if hasattr(plugin, 'plot_jobs'):
+                jobs.extend(plugin.plot_jobs(**kwargs))
+            else:
+                sequential_plugins.append(plugin)
+
+        _load_data.cache_clear()
+        timings = []
+        errors = []
+        with ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context(mp_context),
+                                 initializer=_init_worker) as executor:
+            futures = {executor.submit(_run_job, job): job for job in jobs}
+
+            # plugins that do not declare their charts are plotted here while the pool works
+            for plugin in sequential_plugins:
+                start = time.perf_counter()
+                plugin.plot(**kwargs)
+                timings.append({'plugin': plugin.plugin_name, 'chart': 'plot', 'seconds': time.perf_counter() - start})
+
+            for future in as_completed(futures):
+                job = futures[future]
+                try:
+                    timings.append({'plugin': job.plugin_name, 'chart': job.chart_name, 'seconds': future.result()})
+                except Exception as e:
+                    logger.warning('Plot scheduler: chart {chart} of plugin {plugin} failed: {error}'
+                                   .format(chart=job.chart_name, plugin=job.plugin_name, error=e))
+                    errors.append(e)
+
+        timings.sort(key=lambda x: x['seconds'], reverse=True)
+        for timing in timings:
+            logger.info('{plugin} - {chart}: {seconds:.2f}s'.format(**timing))
+
+        if errors:
+            raise errors[0]
+
+        return timings
@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+"""
+Run-time hooks of the plugins.
+
+Every plugin calls instrument_plugin(self) once, at the end of its constructor (its options and process output folder
+set). The hooks wrap the phases of the plugin in a fixed order, innermost first:
+
+1. SharedInput.attach: process() warns if it modified the structure of its shared input frames;
+2. ResultBus.attach: report() releases the in-memory result of the plugin when it returns;
+3. Profiler.attach: with the profile option (or WEPAIR_PROFILE), process / plot / report run in a profiled stage.
+
+The profiled stages therefore include the input check and the result release, and the profile of the plugin is
+written once its result is released.
+"""
+
+from .profiling import Profiler
+from .result_bus import ResultBus
+from .shared_input import SharedInput
+
+# innermost first
+HOOKS = [SharedInput.attach, ResultBus.attach, Profiler.attach]
+
+
+def instrument_plugin(plugin):
+    """Attach the HOOKS to a plugin, in order, once; returns the plugin."""
+    if not getattr(plugin, '_hooks_attached', False):
+        for attach in HOOKS:
+            attach(plugin)
+        plugin._hooks_attached = True
+    return plugin
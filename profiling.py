@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+"""
+Per-stage profiling of a report run.
+
+Profiler.instrument wraps the process/plot/report methods of a plugin in a stage. Inside a stage, a plugin splits its
+work in named sections with Profiler.mark (a section ends where the next one starts, or with the stage), and nested
+stages can be opened with the Profiler.stage context manager. Every stage and section records its wall time, CPU time,
+the number of rows processed, the peak RSS of the whole process at its end (ru_maxrss, so a later stage reports at least
+the maximum of the earlier ones) and how much the stage raised that peak; Profiler.save writes the run profile as JSON.
+Outside of a stage, Profiler.mark does nothing, so the plugins run unchanged when nobody profiles them.
+
+Profiler.attach is one of the hooks every plugin attaches when it is built (see plugin_hooks): with the profile
+option set (or the WEPAIR_PROFILE environment variable), the plugin is instrumented and its report() writes the
+profile of the plugin to profile.json in its process output folder, then drops its records.
+"""
+
+import os
+import json
+import time
+import functools
+from contextlib import contextmanager
+from datetime import datetime
+from os.path import join
+from wepair.utils_common.log import Log
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+# log
+logger = Log(__name__).get_logger()
+
+PROFILE_OPTION = 'profile'
+PROFILE_ENVIRONMENT = 'WEPAIR_PROFILE'
+PROFILE_FILENAME = 'profile.json'
+
+
+def _peak_rss_mb():
+    if resource is None:
+        return None
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+class Profiler:
+
+    _run_started = datetime.now()
+    _records = []
+    _stack = []
+
+    @staticmethod
+    def _open(name, rows):
+        path = '/'.join([entry['path'] for entry in Profiler._stack[-1:]] + [name])
+        return {'path': path, 'rows': rows, 'wall': time.perf_counter(), 'cpu': time.process_time(),
+                'peak_rss': _peak_rss_mb(), 'section': None}
+
+    @staticmethod
+    def _close(entry):
+        peak_rss = _peak_rss_mb()
+        record = {
+            'stage': entry['path'],
+            'wall_time': time.perf_counter() - entry['wall'],
+            'cpu_time': time.process_time() - entry['cpu'],
+            'process_peak_rss_mb': peak_rss,
+            'peak_rss_increase_mb': None if peak_rss is None else peak_rss - entry['peak_rss'],
+            'rows': entry['rows']
+        }
+        Profiler._records.append(record)
+        logger.debug('{stage}: {wall_time:.2f}s wall, {cpu_time:.2f}s cpu'.format(**record))
+
+    @staticmethod
+    @contextmanager
+    def stage(name, rows=None):
+        """Profile the with-block as a stage nested in the current one."""
+        entry = Profiler._open(name, rows)
+        Profiler._stack.append(entry)
+        try:
+            yield
+        finally:
+            Profiler._stack.pop()
+            if entry['section'] is not None:
+                Profiler._close(entry['section'])
+            Profiler._close(entry)
+
+    @staticmethod
+    def mark(name, rows=None):
+        """End the current section of the innermost stage and start a new one called name."""
+        if not Profiler._stack:
+            return
+        entry = Profiler._stack[-1]
+        if entry['section'] is not None:
+            Profiler._close(entry['section'])
+        entry['section'] = Profiler._open(name, rows)
+
+    @staticmethod
+    def instrument(plugin, profile_file=None):
+        """
+        Profile the process, plot and report methods of a plugin instance (once: an instrumented plugin is returned as
+        is). With profile_file, report() then saves the records of the plugin to it and drops them.
+        """
+        if getattr(plugin, '_profiled', False):
+            return plugin
+
+        def wrap(lifecycle_stage, method):
+            @functools.wraps(method)
+            def wrapper(*args, **kwargs):
+                rows = len(args[0]) if lifecycle_stage == 'process' and args and hasattr(args[0], '__len__') else None
+                try:
+                    with Profiler.stage(plugin.plugin_name + '.' + lifecycle_stage, rows=rows):
+                        return method(*args, **kwargs)
+                finally:
+                    if lifecycle_stage == 'report' and profile_file is not None:
+                        Profiler.save(profile_file, plugin.plugin_name + '.')
+                        Profiler.reset(plugin.plugin_name + '.')
+            return wrapper
+
+        for lifecycle_stage in ['process', 'plot', 'report']:
+            setattr(plugin, lifecycle_stage, wrap(lifecycle_stage, getattr(plugin, lifecycle_stage)))
+        plugin._profiled = True
+        return plugin
+
+    @staticmethod
+    def requested(options):
+        """Whether a run is profiled: the profile option of the plugin, or the WEPAIR_PROFILE environment variable."""
+        return bool((options or {}).get(PROFILE_OPTION)) or os.environ.get(PROFILE_ENVIRONMENT, '') not in ('', '0')
+
+    @staticmethod
+    def attach(plugin):
+        """Instrument a plugin if its run is profiled, its report() writing process_output_folder/profile.json."""
+        if Profiler.requested(plugin.options):
+            Profiler.instrument(plugin, join(plugin.process_output_folder, PROFILE_FILENAME))
+        return plugin
+
+    @staticmethod
+    def records():
+        return list(Profiler._records)
+
+    @staticmethod
+    def reset(stage_prefix=None):
+        """Drop the records (only those of the stages starting with stage_prefix if given) and restart the run."""
+        if stage_prefix is not None:
+            Profiler._records = [record for record in Profiler._records
+                                 if not record['stage'].startswith(stage_prefix)]
+            return
+        Profiler._run_started = datetime.now()
+        Profiler._records = []
+        Profiler._stack = []
+
+    @staticmethod
+    def save(filename, stage_prefix=None):
+        """
+        Write the run profile (one entry per stage and section, in completion order; only the stages starting with
+        stage_prefix if given) as JSON.
+        """
+        profile = {
+            'started': Profiler._run_started.strftime('%Y-%m-%d %H:%M:%S'),
+            'stages': [record for record in Profiler._records
+                       if stage_prefix is None or record['stage'].startswith(stage_prefix)]
+        }
+        with open(filename, 'w') as profile_out:
+            json.dump(profile, profile_out, indent=2)
+        return profile
@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+"""
+Rendering service for the plotly charts of the plugins.
+
+Instead of paying one renderer round-trip per figure, a single orca server is started on the first request and kept
+alive for the whole run. Export requests are queued, dispatched in batches to a thread pool and rendered concurrently
+by the warm server. A plugin queues its figures with RenderService.write_image and calls RenderService.flush at the
+end of its plot method so that every PNG exists on disk before the report phase reads it.
+
+The service belongs to one process: the plot workers of the PlotScheduler each run their own server (see
+PlotScheduler.run for the trade-off), and a forked process must call RenderService.reset before using it.
+"""
+
+import atexit
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from .lazy_import import lazy_module
+from wepair.utils_common.log import Log
+
+# log
+logger = Log(__name__).get_logger()
+
+# imported (and orca configured) when the first figure is queued, not with the plugins (see lazy_import)
+pio = lazy_module('plotly.io')
+go = lazy_module('plotly.graph_objs')
+
+# Number of concurrent export requests sent to the renderer
+MAX_WORKERS = 4
+# Number of queued figures that triggers a dispatch to the renderer
+BATCH_SIZE = 16
+
+
+class RenderService:
+
+    _lock = threading.Lock()
+    _executor = None
+    _pending = []
+    _futures = []
+
+    @staticmethod
+    def _start():
+        """Start the renderer once for the whole run (no-op if it is already running)."""
+        if RenderService._executor is not None:
+            return
+        # orca config; keep the server alive until the end of the run instead of shutting it down when idle
+        pio.orca.config.use_xvfb = 'auto'
+        pio.orca.config.timeout = None
+        pio.orca.ensure_server()
+        RenderService._executor = ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix='render')
+        atexit.register(RenderService.shutdown)
+        logger.debug('Render service started (pid={pid})'.format(pid=pio.orca.status.pid))
+
+    @staticmethod
+    def _export(fig, filename, format, scale, width, height):
+        image = pio.to_image(fig, format=format, scale=scale, width=width, height=height)
+        with open(filename, 'wb') as image_out:
+            image_out.write(image)
+        return filename
+
+    @staticmethod
+    def _dispatch():
+        """Send the queued export requests to the renderer (the caller holds the lock)."""
+        if not RenderService._pending:
+            return
+        RenderService._start()
+        for request in RenderService._pending:
+            RenderService._futures.append(RenderService._executor.submit(RenderService._export, *request))
+        RenderService._pending = []
+
+    @staticmethod
+    def write_image(fig, filename, format='png', scale=None, width=None, height=None):
+        """
+        Queue the export of a plotly figure. Same signature as plotly.io.write_image; the image is only guaranteed to
+        exist on disk once flush() has returned.
+        """
+        # snapshot the figure so that the caller can keep mutating its data while the export is pending
+        fig = go.Figure(fig).to_dict()
+        with RenderService._lock:
+            RenderService._pending.append((fig, filename, format, scale, width, height))
+            if len(RenderService._pending) >= BATCH_SIZE:
+                RenderService._dispatch()
+
+    @staticmethod
+    def flush():
+        """Render every queued figure and wait for the images to be written. Re-raises the first export error."""
+        with RenderService._lock:
+            RenderService._dispatch()
+            futures = RenderService._futures
+            RenderService._futures = []
+
+        errors = []
+        for future in futures:
+            try:
+                future.result()
+            except Exception as e:
+                errors.append(e)
+
+        if errors:
+            logger.warning('Render service: {n} image(s) could not be exported'.format(n=len(errors)))
+            raise errors[0]
+
+    @staticmethod
+    def reset():
+        """
+        Forget the renderer inherited from the parent process by a forked child: the threads of its pool do not exist in
+        the child, and its orca server is the parent's (it is left running, the parent shuts it down). plotly keeps its
+        own orca process state as well, which is why the PlotScheduler spawns its workers instead of forking them.
+        """
+        RenderService._lock = threading.Lock()
+        RenderService._executor = None
+        RenderService._pending = []
+        RenderService._futures = []
+
+    @staticmethod
+    def shutdown():
+        """Stop the renderer. Called automatically at exit."""
+        with RenderService._lock:
+            if RenderService._executor is None:
+                return
+            RenderService._executor.shutdown(wait=True)
+            RenderService._executor = None
+            pio.orca.shutdown_server()
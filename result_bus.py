@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+"""
+Result bus: hands the result of the process phase of a plugin over to its plot and report phases.
+
+Every plugin writes its result to out.pickle at the end of process(), and plot() and report() used to open and
+unpickle that file again, each one, even within the run that had just computed it. ResultBus.publish keeps the result
+in memory, keyed by the path of its file, and still writes the file; ResultBus.load returns the in-memory result of
+the same process, and only falls back to the file when the phases run in separate processes (plot workers of the
+PlotScheduler, report of an earlier run).
+
+The file is written with pickle protocol 5: the long numeric lists of the result are written as typed columns (see
+typed_result), and the large buffers (typed columns, NumPy arrays, DataFrame blocks) are kept out of the pickle stream
+in a .buffers file next to it: a small header (format magic and version, offset and length of every buffer) followed
+by the raw buffers, aligned. The fallback memory-maps it (copy-on-write) instead of reading it, so the buffers are
+paged in only when used, and the arrays are built on the mapping without a copy. ResultBus.load presents the legacy
+shape (lists) to the existing plot() / report() code; with arrays=True the typed columns are handed over as the
+arrays themselves. The file is meant to be read with ResultBus, not with pickle.load.
+The results handed over are shared between the phases: they must be treated as read-only.
+
+An in-memory result lives until the report phase of its plugin ends: ResultBus.attach, one of the hooks every
+plugin attaches when it is built (see plugin_hooks), releases the result of the plugin when its report() returns, so
+that a long-lived worker does not keep every result it ever computed. An in-memory result is also dropped as soon as
+its file no longer is the one written by publish (rewritten by another process): load then reads the file.
+"""
+
+import mmap
+import pickle
+import functools
+import threading
+import numpy as np
+from os import remove, stat
+from os.path import abspath, isfile, join
+from .typed_result import TYPED_MIN_LENGTH, to_typed, from_typed
+
+RESULT_FILENAME = 'out.pickle'
+BUFFERS_SUFFIX = '.buffers'
+BUFFERS_MAGIC = np.frombuffer(b'WPRESULT', dtype=np.uint64)[0]
+BUFFERS_VERSION = 1
+# buffers from this size (in bytes) on are kept out of the pickle stream: every int64 / float64 typed column
+OUT_OF_BAND_BYTES = 8 * TYPED_MIN_LENGTH
+# alignment of the buffers in the .buffers file
+BUFFER_ALIGNMENT = 64
+
+
+class ResultBus:
+
+    _lock = threading.Lock()
+    _results = {}
+
+    @staticmethod
+    def result_file(output_folder):
+        """The result file of a plugin, from its process output folder."""
+        return join(output_folder, RESULT_FILENAME)
+
+    @staticmethod
+    def _write(result_file, result):
+        buffers = []
+
+        def out_of_band(buffer):
+            # a false value keeps the buffer out of the pickle stream
+            if buffer.raw().nbytes < OUT_OF_BAND_BYTES:
+                return True
+            buffers.append(buffer.raw())
+            return False
+
+        with open(result_file, 'wb') as pickle_out:
+            pickle.dump(to_typed(result), pickle_out, protocol=5, buffer_callback=out_of_band)
+
+        buffers_file = result_file + BUFFERS_SUFFIX
+        if not buffers:
+            if isfile(buffers_file):
+                remove(buffers_file)
+            return
+
+        # header: magic, version, number of buffers, then the (offset, length) of each; then the aligned buffers
+        lengths = np.array([buffer.nbytes for buffer in buffers], dtype=np.uint64)
+        header_bytes = 8 * (3 + 2 * len(buffers))
+        aligned = -(-lengths.astype(np.int64) // BUFFER_ALIGNMENT) * BUFFER_ALIGNMENT
+        offsets = -(-header_bytes // BUFFER_ALIGNMENT) * BUFFER_ALIGNMENT + \
+            np.concatenate([[0], np.cumsum(aligned)[:-1]])
+        header = np.concatenate([np.array([BUFFERS_MAGIC, BUFFERS_VERSION, len(buffers)], dtype=np.uint64),
+                                 np.column_stack([offsets, lengths]).ravel().astype(np.uint64)])
+        with open(buffers_file, 'wb') as buffers_out:
+            buffers_out.write(header.tobytes())
+            for offset, buffer in zip(offsets, buffers):
+                buffers_out.seek(int(offset))
+                buffers_out.write(buffer)
+
+    @staticmethod
+    def _read(result_file, arrays):
+        buffers_file = result_file + BUFFERS_SUFFIX
+        buffers = None
+        if isfile(buffers_file):
+            with open(buffers_file, 'rb') as handle:
+                # the mapping stays alive as long as the arrays built on it
+                mapping = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_COPY)
+            magic, version, n_buffers = np.frombuffer(mapping, dtype=np.uint64, count=3)
+            if magic != BUFFERS_MAGIC or version > BUFFERS_VERSION:
+                raise ValueError('{filename} is not a result buffers file of version {version} or older'
+                                 .format(filename=buffers_file, version=BUFFERS_VERSION))
+            table = np.frombuffer(mapping, dtype=np.uint64, count=2 * int(n_buffers), offset=24).reshape(-1, 2)
+            view = memoryview(mapping)
+            buffers = [view[int(offset):int(offset) + int(length)] for offset, length in table]
+        with open(result_file, 'rb') as handle:
+            return from_typed(pickle.load(handle, buffers=buffers), arrays)
+
+    @staticmethod
+    def _signature(result_file):
+        """Modification time and size of a result file, None if it does not exist."""
+        try:
+            file_stat = stat(result_file)
+        except OSError:
+            return None
+        return file_stat.st_mtime_ns, file_stat.st_size
+
+    @staticmethod
+    def publish(output_folder, result):
+        """Hand the result of the process phase over to the later phases, in memory and in the result file."""
+        result_file = ResultBus.result_file(output_folder)
+        ResultBus._write(result_file, result)
+        with ResultBus._lock:
+            ResultBus._results[abspath(result_file)] = (ResultBus._signature(result_file), result)
+
+    @staticmethod
+    def load_file(result_file, arrays=False):
+        """
+        The result stored in a result file: the in-memory one if it was published by this process. With arrays=True,
+        the long numeric lists are NumPy arrays (memory-mapped when read from the file).
+        """
+        key = abspath(result_file)
+        with ResultBus._lock:
+            signature, result = ResultBus._results.get(key, (None, None))
+            if result is not None and signature != ResultBus._signature(result_file):
+                # the file was rewritten since it was published: the in-memory result is stale
+                del ResultBus._results[key]
+                result = None
+        if result is not None:
+            return from_typed(to_typed(result), arrays=True) if arrays else result
+        return ResultBus._read(result_file, arrays)
+
+    @staticmethod
+    def load(output_folder, arrays=False):
+        """The result of the process phase of a plugin, from its process output folder (arrays as in load_file)."""
+        return ResultBus.load_file(ResultBus.result_file(output_folder), arrays)
+
+    @staticmethod
+    def release(output_folder=None):
+        """Drop the in-memory result of a plugin (all of them without output_folder); the files stay."""
+        with ResultBus._lock:
+            if output_folder is None:
+                ResultBus._results.clear()
+            else:
+                ResultBus._results.pop(abspath(ResultBus.result_file(output_folder)), None)
+
+    @staticmethod
+    def attach(plugin):
+        """Release the in-memory result of a plugin when its report() returns (the report is its last phase)."""
+        report = plugin.report
+
+        @functools.wraps(report)
+        def wrapper(*args, **kwargs):
+            try:
+                return report(*args, **kwargs)
+            finally:
+                ResultBus.release(plugin.process_output_folder)
+
+        plugin.report = wrapper
+        return plugin
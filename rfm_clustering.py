@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+"""
+Persistent RFM clustering of the customers.
+
+RFMClustering keeps the MiniBatchKMeans model, the normalization statistics (mean and standard deviation of R, F and
+M_sum) and a fingerprint of the activity of every customer in a state file between runs. A full fit (the ten k-means++
+restarts) only runs when there is no state yet or when the last one is older than recluster_days; in between, the model
+is updated with partial_fit on the customers whose activity changed since the previous run, and every customer is
+assigned to its nearest centroid. The normalization statistics are recomputed on every run, since the recency of the
+customers who did not transact keeps drifting, and the stored centroids are re-expressed in the new units first.
+
+The segment IDs stay stable across runs: after a full fit, the new clusters are matched to the previous ones by the
+distance between their centroids (in R, F, M_sum units), and each new cluster takes over the segment ID of its match.
+"""
+
+import os
+import pickle
+import numpy as np
+import pandas as pd
+from os.path import isfile
+from .lazy_import import lazy_names
+
+# imported by the first fit only (see lazy_import)
+linear_sum_assignment = lazy_names('scipy.optimize', 'linear_sum_assignment')
+MiniBatchKMeans = lazy_names('sklearn.cluster', 'MiniBatchKMeans')
+
+RFM_FEATURES = ['R', 'F', 'M_sum']
+DEFAULT_RECLUSTER_DAYS = 30
+
+
+class RFMClustering:
+
+    def __init__(self, n_clusters, random_state=None, state_file=None, recluster_days=DEFAULT_RECLUSTER_DAYS,
+                 verbose=False):
+        self.n_clusters = n_clusters
+        self.random_state = random_state
+        self.state_file = state_file
+        self.recluster_days = recluster_days
+        self.verbose = verbose
+
+    @staticmethod
+    def from_options(n_clusters, random_state, options, verbose=False):
+        """
+        Clustering persisted to the clusteringState file, re-clustered every reclusterDays days (default
+        DEFAULT_RECLUSTER_DAYS); without clusteringState, a full fit on every run.
+        """
+        return RFMClustering(n_clusters, random_state, options.get('clusteringState'),
+                             int(options.get('reclusterDays', DEFAULT_RECLUSTER_DAYS)), verbose)
+
+    def _load(self):
+        if self.state_file is None or not isfile(self.state_file):
+            return None
+        with open(self.state_file, 'rb') as handle:
+            return pickle.load(handle)
+
+    def _save(self, state):
+        if self.state_file is None:
+            return
+        temp_filename = self.state_file + '.tmp'
+        with open(temp_filename, 'wb') as state_out:
+            pickle.dump(state, state_out, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_filename, self.state_file)
+
+    @staticmethod
+    def _statistics(features):
+        """Normalization statistics; a constant feature (std 0, or NaN for a single customer) is only centered."""
+        return {'mean': features.mean(), 'std': features.std().replace(0, 1).fillna(1)}
+
+    @staticmethod
+    def _normalized(features, state):
+        return ((features - state['mean']) / state['std']).values
+
+    @staticmethod
+    def _centroids(state, statistics):
+        """The centroids of a state, in the units of other normalization statistics."""
+        centroids = state['kmeans'].cluster_centers_ * state['std'].values + state['mean'].values
+        return (centroids - statistics['mean'].values) / statistics['std'].values
+
+    @staticmethod
+    def _activity(customers, key, activity_columns):
+        """Fingerprint of the activity of every customer, by customer ID: changes when the customer transacted."""
+        return pd.Series(pd.util.hash_pandas_object(customers[activity_columns], index=False).values,
+                         index=customers[key].values)
+
+    def _full_fit(self, features, previous):
+        state = self._statistics(features)
+        kmeans = MiniBatchKMeans(n_clusters=self.n_clusters, init='k-means++', max_iter=1000, tol=1e-6, n_init=10,
+                                 random_state=self.random_state, batch_size=1000, verbose=self.verbose)
+        kmeans.fit(self._normalized(features, state))
+        state['kmeans'] = kmeans
+        state['segment_ids'] = np.arange(self.n_clusters)
+
+        if previous is not None and previous['kmeans'].n_clusters == self.n_clusters:
+            # match the new centroids to the previous ones, compared in the units of the new normalization
+            previous_centroids = self._centroids(previous, state)
+            distances = ((kmeans.cluster_centers_[:, np.newaxis, :] - previous_centroids[np.newaxis, :, :]) ** 2) \
+                .sum(axis=2)
+            clusters, previous_clusters = linear_sum_assignment(distances)
+            state['segment_ids'][clusters] = previous['segment_ids'][previous_clusters]
+        return state
+
+    def segments(self, customers, as_of, key, activity_columns):
+        """
+        Segment ID of every customer (an array aligned with the rows of customers), as of the given date. key is the
+        customer ID column and activity_columns the columns whose change marks a customer as changed.
+        """
+        features = customers[RFM_FEATURES].astype(float)
+        activity = self._activity(customers, key, activity_columns)
+        previous = self._load()
+
+        if previous is None or previous['kmeans'].n_clusters != self.n_clusters or \
+                (as_of - previous['fitted_at']).days >= self.recluster_days:
+            state = self._full_fit(features, previous)
+            state['fitted_at'] = as_of
+        else:
+            state = previous
+            statistics = self._statistics(features)
+            state['kmeans'].cluster_centers_ = self._centroids(state, statistics)
+            state.update(statistics)
+            known = activity.index.isin(state['activity'].index)
+            changed = ~known
+            changed[known] = state['activity'].reindex(activity.index[known]).values != activity.values[known]
+            if changed.any():
+                state['kmeans'].partial_fit(self._normalized(features[changed], state))
+
+        # assign-only: every customer goes to its nearest centroid
+        labels = state['segment_ids'][state['kmeans'].predict(self._normalized(features, state))]
+
+        state['activity'] = activity
+        self._save(state)
+        return labels
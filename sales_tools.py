@@ -0,0 +1,312 @@
+# -*- coding: utf-8 -*-
+"""
+Gross sales / sales returns / net sales aggregation shared by the Sales plugins.
+
+The amounts are first summed per transaction reference (captures and returns separately), the net amount of a
+reference is its gross amount minus its returns (a hash join on the reference index), and the three amounts are then
+summed per group key into a single table. Gross, returns and net are therefore aligned on the same key index and never
+have to be re-ordered against each other afterwards.
+
+SalesAggregator folds the same aggregation chunk by chunk for inputs that do not fit in memory: every chunk is reduced
+to mergeable per-reference partial aggregates, hash-partitioned on the reference (and optionally spilled to disk), so
+that a reference spanning several chunks is always reduced within a single partition.
+
+top_sales_table ranks the keys with a Space-Saving sketch over chunks of transactions instead, so only a bounded number
+of counters is held at any time, and re-aggregates the exact amounts of the top keys only. It reads the chunks twice:
+ChunkReplay slices a frame again, and spills the chunks of any other input to disk on the first pass.
+"""
+
+import pickle
+import shutil
+import pandas as pd
+from os import makedirs
+from os.path import join, isfile
+from ...globals import COLNAMES_PE
+from .heavy_hitters import SpaceSaving
+
+AMOUNT_IN_EUR = COLNAMES_PE['Amount in EUR']
+TRANSACTION_IS_CAPTURE = COLNAMES_PE['Is capture']
+TRANSACTION_IS_RETURN = COLNAMES_PE['Is return']
+TRANSACTION_REF_ID = COLNAMES_PE['Transaction Reference ID']
+
+SALES_COLUMNS = ['gross_sales', 'sales_returns', 'net_sales']
+DEFAULT_SPILL_PARTITIONS = 64
+
+
+def _per_reference(transactions, group_key):
+    """Amount summed per reference and group key of the first transaction of the reference."""
+    amounts = transactions.groupby(TRANSACTION_REF_ID, sort=False)[AMOUNT_IN_EUR].sum()
+    keys = transactions.drop_duplicates(subset=[TRANSACTION_REF_ID], keep='first') \
+        .set_index(TRANSACTION_REF_ID)[group_key]
+    return amounts, keys.reindex(amounts.index)
+
+
+def _reference_partials(transactions, group_key):
+    """Partial aggregates of a chunk, indexed by reference: amount and group key, for the captures and the returns."""
+    transactions = transactions[[TRANSACTION_REF_ID, group_key, AMOUNT_IN_EUR, TRANSACTION_IS_CAPTURE,
+                                 TRANSACTION_IS_RETURN]]
+    partials = []
+    for is_return, flag in [(False, TRANSACTION_IS_CAPTURE), (True, TRANSACTION_IS_RETURN)]:
+        amounts, keys = _per_reference(transactions[transactions[flag]], group_key)
+        partials.append(pd.DataFrame({'is_return': is_return, 'amount': amounts, 'key': keys},
+                                     columns=['is_return', 'amount', 'key']))
+    partials = pd.concat(partials)
+    # an empty part (a chunk without captures or returns) can upcast the flag to object, on which ~ is not a negation
+    partials['is_return'] = partials['is_return'].astype(bool)
+    return partials
+
+
+def _sales_frame(partials, group_key, key_normalizer, abs_returns):
+    """Gross sales, sales returns and net sales per group key of a set of partials (NaN where there are none)."""
+    def merge(partials):
+        if partials.index.is_unique:
+            amounts, keys = partials['amount'], partials['key']
+        else:
+            # the reference spans several chunks: sum its amounts, keep the key of its first chunk
+            amounts = partials.groupby(level=0, sort=False)['amount'].sum()
+            keys = partials.loc[~partials.index.duplicated(keep='first'), 'key'].reindex(amounts.index)
+        if key_normalizer is not None:
+            keys = key_normalizer(keys)
+        return amounts, keys
+
+    # the partials of several chunks are concatenated by the caller: same cast as in _reference_partials
+    is_return = partials['is_return'].astype(bool)
+    gross_amounts, gross_keys = merge(partials[~is_return])
+    returns_amounts, returns_keys = merge(partials[is_return])
+
+    returns_per_gross_reference = returns_amounts.reindex(gross_amounts.index, fill_value=0)
+    if abs_returns:
+        returns_per_gross_reference = returns_per_gross_reference.abs()
+    net_amounts = gross_amounts - returns_per_gross_reference
+
+    frame = pd.DataFrame({
+        'gross_sales': gross_amounts.groupby(gross_keys).sum(),
+        'sales_returns': returns_amounts.groupby(returns_keys).sum(),
+        'net_sales': net_amounts.groupby(gross_keys).sum()
+    }, columns=SALES_COLUMNS)
+    frame.index.name = group_key
+    return frame
+
+
+class SalesAggregator:
+    """
+    Gross sales, sales returns and net sales per group key, folded chunk by chunk.
+
+    The partials of every chunk are split in n_partitions partitions by a hash of the reference. With a spill_folder,
+    they are appended to one file per partition instead of being kept in memory, and only one partition is loaded at a
+    time when the table is computed.
+    """
+
+    def __init__(self, group_key, n_partitions=1, spill_folder=None):
+        self.group_key = group_key
+        self.n_partitions = n_partitions
+        self.spill_folder = spill_folder
+        self.has_captures = False
+        self.has_returns = False
+        self._partials = [[] for _ in range(n_partitions)]
+        if spill_folder is not None:
+            shutil.rmtree(spill_folder, ignore_errors=True)
+            makedirs(spill_folder)
+
+    @staticmethod
+    def from_options(group_key, options, work_folder):
+        """
+        In-memory aggregator, or with the chunkSize option an aggregator spilling its spillPartitions partitions
+        (default DEFAULT_SPILL_PARTITIONS) to work_folder/spill.
+        """
+        if not options.get('chunkSize'):
+            return SalesAggregator(group_key)
+        return SalesAggregator(group_key, int(options.get('spillPartitions', DEFAULT_SPILL_PARTITIONS)),
+                               join(work_folder, 'spill'))
+
+    def _spill_file(self, partition):
+        return join(self.spill_folder, 'partition_{partition}.pickle'.format(partition=partition))
+
+    def add(self, chunk):
+        """Fold a chunk of transactions into the partial aggregates."""
+        self.has_captures = self.has_captures or bool(chunk[TRANSACTION_IS_CAPTURE].any())
+        self.has_returns = self.has_returns or bool(chunk[TRANSACTION_IS_RETURN].any())
+
+        partials = _reference_partials(chunk, self.group_key)
+        if self.n_partitions == 1:
+            partitions = [(0, partials)]
+        else:
+            partitions = partials.groupby(pd.util.hash_array(partials.index.values) % self.n_partitions, sort=False)
+
+        for partition, partition_partials in partitions:
+            if self.spill_folder is None:
+                self._partials[partition].append(partition_partials)
+            else:
+                with open(self._spill_file(partition), 'ab') as spill_out:
+                    pickle.dump(partition_partials, spill_out, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def _load(self, partition):
+        if self.spill_folder is None:
+            return self._partials[partition]
+        partials = []
+        if isfile(self._spill_file(partition)):
+            with open(self._spill_file(partition), 'rb') as handle:
+                while True:
+                    try:
+                        partials.append(pickle.load(handle))
+                    except EOFError:
+                        break
+        return partials
+
+    def frame(self, key_normalizer=None, abs_returns=False):
+        """
+        Gross sales, sales returns and net sales per group key, sorted by key; NaN where a key has no captures (gross
+        and net sales) or no returns. key_normalizer and abs_returns are as in sales_table.
+        """
+        frames = []
+        for partition in range(self.n_partitions):
+            partials = self._load(partition)
+            if partials:
+                frames.append(_sales_frame(pd.concat(partials), self.group_key, key_normalizer, abs_returns))
+
+        if not frames:
+            return pd.DataFrame(columns=SALES_COLUMNS, index=pd.Index([], name=self.group_key), dtype=float)
+        if len(frames) == 1:
+            return frames[0]
+        # every reference is in a single partition: the partition tables just add up
+        frame = pd.concat(frames).groupby(level=0).sum(min_count=1)
+        frame.index.name = self.group_key
+        return frame
+
+    def table(self, key_normalizer=None, abs_returns=False):
+        """The frame with zeros for the missing amounts, sorted by decreasing gross sales."""
+        return self.frame(key_normalizer, abs_returns).fillna(0) \
+            .sort_values(by='gross_sales', ascending=False, kind='mergesort')
+
+    def close(self):
+        """Drop the partial aggregates (and the spill files)."""
+        self._partials = [[] for _ in range(self.n_partitions)]
+        if self.spill_folder is not None:
+            shutil.rmtree(self.spill_folder, ignore_errors=True)
+
+
+def sales_table(transactions, group_key, key_normalizer=None, abs_returns=False):
+    """
+    Gross sales, sales returns and net sales per value of group_key, sorted by decreasing gross sales.
+
+    key_normalizer is applied to the group keys (one per reference) before the aggregation, e.g. to map missing
+    values to 'Unknown'; keys that are still missing afterwards are dropped. With abs_returns, the absolute value of
+    the returns is subtracted for the net sales (for sources where the returns are signed).
+    """
+    aggregator = SalesAggregator(group_key)
+    aggregator.add(transactions)
+    return aggregator.table(key_normalizer, abs_returns)
+
+
+def table_to_dict(table, key_name):
+    """Compact, picklable form of a sales table: one list per column, the keys under key_name."""
+    table_dict = {key_name: table.index.tolist()}
+    table_dict.update({column: table[column].tolist() for column in table.columns})
+    return table_dict
+
+
+def iter_chunks(transactions, chunk_size):
+    """Consecutive row slices of at most chunk_size transactions (views, no copy)."""
+    for start in range(0, len(transactions), chunk_size):
+        yield transactions.iloc[start:start + chunk_size]
+
+
+def transaction_chunks(transactions, chunk_size=None):
+    """
+    Iterator over the chunks of the transactions: a frame is sliced in chunks of chunk_size rows (a single chunk without
+    chunk_size), any other iterable of frames (e.g. pd.read_csv(..., chunksize=n)) is consumed as it is.
+    """
+    if isinstance(transactions, pd.DataFrame):
+        return iter_chunks(transactions, int(chunk_size)) if chunk_size else iter([transactions])
+    return iter(transactions)
+
+
+class ChunkReplay:
+    """
+    Callable returning a fresh iterable over the chunks of the transactions on every call, for the passes of
+    top_sales_table. A frame is sliced again in chunks of chunk_size rows on every pass. Any other iterable of frames
+    can be read only once: its chunks (restricted to columns if given) are pickled to spill_folder while the first pass
+    reads them, and the later passes read them back. The first pass must be read to the end before the next one starts.
+    """
+
+    def __init__(self, transactions, chunk_size=None, spill_folder=None, columns=None):
+        self.transactions = transactions
+        self.chunk_size = chunk_size
+        self.spill_folder = None if isinstance(transactions, pd.DataFrame) else spill_folder
+        self.columns = columns
+        self.has_captures = False
+        self.has_returns = False
+        self._n_passes = 0
+        if self.spill_folder is None and not isinstance(transactions, pd.DataFrame):
+            raise ValueError('ChunkReplay: a spill_folder is required to read an iterable of chunks twice')
+        if self.spill_folder is not None:
+            shutil.rmtree(self.spill_folder, ignore_errors=True)
+            makedirs(self.spill_folder)
+
+    def _spill_file(self):
+        return join(self.spill_folder, 'chunks.pickle')
+
+    def _first_pass(self):
+        spill_out = None if self.spill_folder is None else open(self._spill_file(), 'wb')
+        try:
+            for chunk in transaction_chunks(self.transactions, self.chunk_size):
+                self.has_captures = self.has_captures or bool(chunk[TRANSACTION_IS_CAPTURE].any())
+                self.has_returns = self.has_returns or bool(chunk[TRANSACTION_IS_RETURN].any())
+                if spill_out is not None:
+                    pickle.dump(chunk if self.columns is None else chunk[self.columns], spill_out,
+                                protocol=pickle.HIGHEST_PROTOCOL)
+                yield chunk
+        finally:
+            if spill_out is not None:
+                spill_out.close()
+
+    def _replay(self):
+        if self.spill_folder is None:
+            yield from transaction_chunks(self.transactions, self.chunk_size)
+            return
+        with open(self._spill_file(), 'rb') as handle:
+            while True:
+                try:
+                    yield pickle.load(handle)
+                except EOFError:
+                    break
+
+    def __call__(self):
+        self._n_passes += 1
+        return self._first_pass() if self._n_passes == 1 else self._replay()
+
+    def close(self):
+        """Drop the spilled chunks."""
+        if self.spill_folder is not None:
+            shutil.rmtree(self.spill_folder, ignore_errors=True)
+
+
+def top_sales_table(chunks, group_key, n, key_normalizer=None, abs_returns=False, capacity=None):
+    """
+    Gross sales, sales returns and net sales of the n values of group_key with the largest gross sales.
+
+    chunks is a callable returning a fresh iterable of transaction chunks (e.g. a ChunkReplay); it is read twice. The
+    first pass feeds the captured amounts of every chunk to a Space-Saving sketch of capacity counters (default
+    max(100 * n, 10000)); the second pass keeps only the transactions of the n candidate keys, whose amounts are then
+    aggregated exactly with sales_table. Returns the table and the sketch bounds of the candidates (estimated gross
+    sales 'count', its lower bound 'lower' and whether the key is guaranteed to be in the true top n, 'guaranteed').
+    """
+    def chunk_keys(chunk):
+        keys = chunk[group_key]
+        return key_normalizer(keys) if key_normalizer is not None else keys
+
+    sketch = SpaceSaving(capacity or max(100 * n, 10000))
+    for chunk in chunks():
+        captures = chunk[chunk[TRANSACTION_IS_CAPTURE]]
+        keys = chunk_keys(captures)
+        known = keys.notnull()
+        sketch.update(keys[known], captures.loc[known, AMOUNT_IN_EUR].clip(lower=0))
+    bounds = sketch.top(n)
+    bounds.index.name = group_key
+
+    candidates = [chunk[chunk_keys(chunk).isin(bounds.index)] for chunk in chunks()]
+    if not candidates:
+        return pd.DataFrame(columns=SALES_COLUMNS, index=pd.Index([], name=group_key)), bounds
+    table = sales_table(pd.concat(candidates), group_key, key_normalizer=key_normalizer, abs_returns=abs_returns)
+
+    return table.iloc[:n], bounds
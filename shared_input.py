@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+"""
+Read-only contract of the input frames shared by the plugins.
+
+The same transactions / customers frames are handed to every plugin of a report run, so a plugin never modifies them.
+It derives narrow frames with a single selection (frame.loc[mask, columns]) and, when it needs to add columns to the
+whole input, works on a shallow copy (frame.copy(deep=False)), instead of deep-copying the input defensively.
+
+SharedInput.fingerprint catches the structural changes (columns added, dropped or replaced, rows dropped in place) and,
+with content=True, the values written into the frame: the content checksum hashes every value, so only the Benchmark
+computes it, while the frames stay writable and owned by the caller.
+
+SharedInput.attach is one of the hooks every plugin attaches when it is built (see plugin_hooks): its process() logs a
+warning if it changed the structure of its input frames, so that the contract is checked in every run, not only in the
+Benchmark.
+"""
+
+import functools
+import pandas as pd
+from wepair.utils_common.log import Log
+
+# log
+logger = Log(__name__).get_logger()
+
+
+class SharedInput:
+
+    @staticmethod
+    def fingerprint(frame, content=False):
+        """
+        Shape, columns and dtypes of the frame, and with content the checksum of its index and values; changes if a
+        plugin modified the frame object in place.
+        """
+        fingerprint = frame.shape, tuple(frame.columns), tuple(str(dtype) for dtype in frame.dtypes)
+        if content:
+            fingerprint += (int(pd.util.hash_pandas_object(frame, index=True).sum()),)
+        return fingerprint
+
+    @staticmethod
+    def attach(plugin):
+        """Warn if the process() of a plugin modifies the structure of its input frames."""
+        process = plugin.process
+
+        @functools.wraps(process)
+        def wrapper(*args, **kwargs):
+            frames = [arg for arg in args if isinstance(arg, pd.DataFrame)]
+            fingerprints = [SharedInput.fingerprint(frame) for frame in frames]
+            try:
+                return process(*args, **kwargs)
+            finally:
+                if [SharedInput.fingerprint(frame) for frame in frames] != fingerprints:
+                    logger.warning('{plugin}: process() modified the structure of its shared input frames'
+                                   .format(plugin=plugin.plugin_name))
+
+        plugin.process = wrapper
+        return plugin
+
+    @staticmethod
+    def nbytes(frame):
+        """Memory used by the frame, including the Python objects of its object columns."""
+        return int(frame.memory_usage(index=True, deep=True).sum())
@@ -0,0 +1,242 @@
+# -*- coding: utf-8 -*-
+"""
+Synthetic input data with the PE / chargeback / fraud / risk management schemas, used to benchmark the plugins at
+production scale.
+
+SyntheticData.generate writes tx.pickle, customers.pickle, tx_fps.pickle, tx_chbck.pickle and tx_fraud.pickle in an
+output folder. Customer activity follows a heavy-tailed distribution (most customers buy once, a few buy very often),
+shops are spread over merchants, organizational units and countries, and chargeback reasons are skewed towards the
+most common Visa / Mastercard reason codes. customers.pickle is built with the same customer tools as the ETL.
+
+The data sets are built in memory, as the customer tools need all the transactions of a customer: the transactions
+frame takes about 1 KB per transaction, and its generation peaks at a few times that. The default sizes of the
+Benchmark stop at 10**6 transactions for this reason.
+"""
+
+import pickle
+import numpy as np
+import pandas as pd
+from os.path import join
+from ...globals import COLNAMES_PE, COLNAMES_CHARGEBACK, COLNAMES_FRAUD, COLNAMES_RISK_MANAGEMENT
+from ...utils.customer_tools import Feature, identify_customers, add_feature
+from wepair.utils_common.log import Log
+
+# log
+logger = Log(__name__).get_logger()
+
+TRANSACTION_REF_ID = COLNAMES_PE['Transaction Reference ID']
+TRANSACTION_DATE = COLNAMES_PE['Transaction Creation Date and Time']
+AMOUNT_IN_EUR = COLNAMES_PE['Amount in EUR']
+CUSTOMER_ID = COLNAMES_PE['Customer Unique ID']
+TRANSACTION_IS_CAPTURE = COLNAMES_PE['Is capture']
+TRANSACTION_IS_RETURN = COLNAMES_PE['Is return']
+SHOP_NAME = COLNAMES_PE['Merchant Account Short Name']
+MERCHANT_NAME = COLNAMES_PE['Merchant Short Name']
+ORG_UNIT = COLNAMES_PE['Organizational Unit']
+SHOP_COUNTRY = COLNAMES_PE['Merchant Country']
+PAYMENT_METHOD = COLNAMES_PE['Payment Method']
+CARD_BRAND = COLNAMES_PE['Card Brand']
+CARD_CATEGORY = COLNAMES_PE['Card Category']
+CARD_NUMBER = COLNAMES_PE['Card Number (PAN)']
+CARD_HOLDER_NAME = COLNAMES_PE['Card Holder Name']
+CARD_EXPIRY_DATE = COLNAMES_PE['Card Expiry Date']
+CUSTOMER_EMAIL = COLNAMES_PE['Email (Consumer)']
+CUSTOMER_CITY = COLNAMES_PE['City (Consumer Address)']
+CUSTOMER_COUNTRY = COLNAMES_PE['Country (Consumer Address)']
+
+COUNTRIES = ['DE', 'PL', 'FR', 'NL', 'AT', 'IT', 'ES', 'GB', 'BE', 'CZ']
+COUNTRY_WEIGHTS = [.3, .15, .12, .1, .08, .07, .06, .05, .04, .03]
+CITIES = {
+    'DE': ['Berlin', 'Munich', 'Hamburg', 'Cologne', 'Frankfurt'],
+    'PL': ['Warsaw', 'Krakow', 'Lodz', 'Wroclaw', 'Poznan'],
+    'FR': ['Paris', 'Marseille', 'Lyon', 'Toulouse', 'Nice'],
+    'NL': ['Amsterdam', 'Rotterdam', 'The Hague', 'Utrecht', 'Eindhoven'],
+    'AT': ['Vienna', 'Graz', 'Linz', 'Salzburg', 'Innsbruck'],
+    'IT': ['Rome', 'Milan', 'Naples', 'Turin', 'Palermo'],
+    'ES': ['Madrid', 'Barcelona', 'Valencia', 'Seville', 'Zaragoza'],
+    'GB': ['London', 'Birmingham', 'Manchester', 'Leeds', 'City of London'],
+    'BE': ['Brussels', 'Antwerp', 'Ghent', 'Charleroi', 'Liege'],
+    'CZ': ['Prague', 'Brno', 'Ostrava', 'Plzen', 'Liberec'],
+}
+PAYMENT_METHODS = ['CARD', 'PAYPAL', 'SOFORTBANKING', 'IDEAL', 'INVOICE']
+PAYMENT_METHOD_WEIGHTS = [.7, .15, .06, .05, .04]
+CARD_BRANDS = ['Visa', 'Master Card', 'American Express']
+CARD_BRAND_WEIGHTS = [.55, .4, .05]
+CARD_CATEGORIES = ['Consumer', 'Commercial', 'Prepaid', 'UnspecifiedCard', 'nan']
+CARD_CATEGORY_WEIGHTS = [.7, .12, .08, .07, .03]
+CHARGEBACK_REASONS = {
+    'Visa': ['10.4 Other Fraud - Card Absent Environment', '13.1 Merchandise/Services Not Received',
+             '13.3 Not as Described or Defective Merchandise', '13.6 Credit Not Processed',
+             '12.6.1 Duplicate Processing', '13.2 Cancelled Recurring'],
+    'Master Card': ['4837 No Cardholder Authorization', '4853 Cardholder Dispute',
+                    '4855 Goods or Services Not Provided', '4863 Cardholder Does Not Recognize',
+                    '4834 Point-of-Interaction Error'],
+}
+DISPUTE_STATUSES = ['Open', 'Won', 'Lost']
+CASE_STATUSES = ['Chargeback', 'Second Presentment', 'Pre-Arbitration']
+
+
+def _skewed_choice(rng, values, size, exponent=1.2):
+    """Pick values with a Zipf-like skew: the first values of the list are the most frequent."""
+    weights = 1.0 / np.arange(1, len(values) + 1) ** exponent
+    return np.asarray(values)[rng.choice(len(values), size=size, p=weights / weights.sum())]
+
+
+class SyntheticData:
+
+    @staticmethod
+    def _shops(rng, n_shops, n_merchants, n_org_units):
+        merchant_idx = rng.integers(0, n_merchants, n_shops)
+        countries = rng.choice(COUNTRIES, size=n_shops, p=COUNTRY_WEIGHTS)
+        channels = rng.choice(['EE', 'WEB', 'APP'], size=n_shops)
+        types = rng.choice(['CC3D', 'CC', 'INV'], size=n_shops, p=[.6, .3, .1])
+        return pd.DataFrame({
+            # "<MERCHANT> <COUNTRY> <CHANNEL> <TYPE>" like the real shop names (the FPS analysis relies on it)
+            SHOP_NAME: ['M{m:03d}-S{s:03d} {c} {ch} {t}'.format(m=m, s=s, c=c, ch=ch, t=t)
+                        for s, (m, c, ch, t) in enumerate(zip(merchant_idx, countries, channels, types))],
+            MERCHANT_NAME: ['MERCHANT {m:03d}'.format(m=m) for m in merchant_idx],
+            ORG_UNIT: ['ORG UNIT {o:02d}'.format(o=m % n_org_units) for m in merchant_idx],
+            SHOP_COUNTRY: countries
+        })
+
+    @staticmethod
+    def transactions(n_transactions, seed=0, start_date='2017-01-01', n_months=24, n_shops=50, n_merchants=10,
+                     n_org_units=5, return_rate=.08, mean_purchases=2.5):
+        """PE transactions (captures and returns) of about n_transactions rows."""
+        rng = np.random.default_rng(seed)
+        n_captures = int(n_transactions / (1 + return_rate))
+        n_customers = max(1, int(n_captures / mean_purchases))
+
+        # Heavy-tailed customer activity: Pareto weights give many one-time buyers and a few very loyal customers
+        weights = rng.pareto(1.5, n_customers) + 1
+        customer_idx = rng.choice(n_customers, size=n_captures, p=weights / weights.sum())
+
+        # Each customer has a home shop (80% of the purchases) and a country / city
+        shops = SyntheticData._shops(rng, n_shops, n_merchants, n_org_units)
+        home_shop = rng.integers(0, n_shops, n_customers)
+        shop_idx = np.where(rng.random(n_captures) < .8, home_shop[customer_idx], rng.integers(0, n_shops, n_captures))
+        country_idx = rng.choice(len(COUNTRIES), size=n_customers, p=COUNTRY_WEIGHTS)
+        customer_country = np.asarray(COUNTRIES)[country_idx]
+        customer_city = np.array([CITIES[c] for c in COUNTRIES])[country_idx,
+                                                                 _skewed_choice(rng, range(5), n_customers)]
+
+        start = np.datetime64(start_date, 's')
+        end = np.datetime64(pd.Timestamp(start_date) + pd.DateOffset(months=n_months), 's')
+        dates = start + rng.integers(0, int((end - start).astype(int)), n_captures).astype('timedelta64[s]')
+
+        captures = shops.iloc[shop_idx].reset_index(drop=True)
+        captures[TRANSACTION_REF_ID] = np.char.add('REF', np.arange(n_captures).astype(str))
+        captures[TRANSACTION_DATE] = pd.to_datetime(dates)
+        captures[AMOUNT_IN_EUR] = np.round(rng.lognormal(4, .8, n_captures), 2)
+        captures[PAYMENT_METHOD] = rng.choice(PAYMENT_METHODS, size=n_captures, p=PAYMENT_METHOD_WEIGHTS)
+        is_card = captures[PAYMENT_METHOD] == 'CARD'
+        captures[CARD_BRAND] = np.where(is_card, rng.choice(CARD_BRANDS, size=n_captures, p=CARD_BRAND_WEIGHTS), None)
+        captures[CARD_CATEGORY] = np.where(is_card, rng.choice(CARD_CATEGORIES, size=n_captures,
+                                                               p=CARD_CATEGORY_WEIGHTS), None)
+        captures[CARD_NUMBER] = np.char.add(np.char.add((400000 + customer_idx % 99999).astype(str), '****'),
+                                            np.char.zfill((customer_idx % 10000).astype(str), 4))
+        captures[CARD_HOLDER_NAME] = np.char.add('CHName', customer_idx.astype(str))
+        captures[CARD_EXPIRY_DATE] = '2022/07'
+        captures[CUSTOMER_EMAIL] = np.char.add(np.char.add('email', customer_idx.astype(str)), '@net.com')
+        captures[CUSTOMER_CITY] = customer_city[customer_idx]
+        captures[CUSTOMER_COUNTRY] = customer_country[customer_idx]
+        captures[CUSTOMER_ID] = customer_idx.astype(str)
+        captures[TRANSACTION_IS_CAPTURE] = True
+        captures[TRANSACTION_IS_RETURN] = False
+
+        # Returns: partial or full refund of a capture, a few days later
+        returned = rng.random(n_captures) < return_rate
+        returns = captures[returned].copy()
+        returns[TRANSACTION_DATE] += pd.to_timedelta(rng.integers(1, 30, len(returns)), unit='D')
+        returns[AMOUNT_IN_EUR] = np.round(returns[AMOUNT_IN_EUR] * rng.choice([1, .5, .25], size=len(returns)), 2)
+        returns[TRANSACTION_IS_CAPTURE] = False
+        returns[TRANSACTION_IS_RETURN] = True
+
+        return pd.concat([captures, returns], ignore_index=True).sort_values(TRANSACTION_DATE).reset_index(drop=True)
+
+    @staticmethod
+    def fps_transactions(transactions, seed=0, decline_rate=.05):
+        """Fraud prevention (risk management) checks of the card captures."""
+        rng = np.random.default_rng(seed)
+        captures = transactions[transactions[TRANSACTION_IS_CAPTURE]]
+        n_txs = len(captures)
+        score = np.round(rng.beta(1, 8, n_txs) * 100, 1)
+        declined = rng.random(n_txs) < decline_rate * 2 * score / max(score.mean(), 1)
+        return pd.DataFrame({
+            COLNAMES_RISK_MANAGEMENT['Transaction Date']: captures[TRANSACTION_DATE].values,
+            COLNAMES_RISK_MANAGEMENT['Transaction Result']: np.where(declined, 'NOK', 'OK'),
+            COLNAMES_RISK_MANAGEMENT['Merchant Account Short Name']: captures[SHOP_NAME].values,
+            COLNAMES_RISK_MANAGEMENT['Order Amount']: captures[AMOUNT_IN_EUR].values,
+            COLNAMES_RISK_MANAGEMENT['Order Amount Currency']: 'EUR',
+            COLNAMES_RISK_MANAGEMENT['Order Number']: captures[TRANSACTION_REF_ID].values,
+            COLNAMES_RISK_MANAGEMENT['Card Brand']: captures[CARD_BRAND].values,
+            COLNAMES_RISK_MANAGEMENT['Card Category']: captures[CARD_CATEGORY].values,
+            COLNAMES_RISK_MANAGEMENT['FPS Overall Score']: score,
+            COLNAMES_RISK_MANAGEMENT['FPS Reason Code List']: np.where(declined, 'R01;R07', ''),
+            COLNAMES_RISK_MANAGEMENT['FPS Intercept Reason Code']: np.where(declined, 'R01', '')
+        })
+
+    @staticmethod
+    def chargeback_transactions(transactions, seed=0, chargeback_rate=.005):
+        """Chargebacks raised on Visa / Mastercard captures, 5 to 90 days after the purchase."""
+        rng = np.random.default_rng(seed)
+        captures = transactions[transactions[TRANSACTION_IS_CAPTURE]
+                                & transactions[CARD_BRAND].isin(list(CHARGEBACK_REASONS.keys()))]
+        captures = captures[rng.random(len(captures)) < chargeback_rate]
+        reasons = np.empty(len(captures), dtype=object)
+        for brand, brand_reasons in CHARGEBACK_REASONS.items():
+            is_brand = (captures[CARD_BRAND] == brand).values
+            reasons[is_brand] = _skewed_choice(rng, brand_reasons, is_brand.sum())
+        return pd.DataFrame({
+            COLNAMES_CHARGEBACK['Transaction Reference ID']: captures[TRANSACTION_REF_ID].values,
+            COLNAMES_CHARGEBACK['Chargeback Date']: (captures[TRANSACTION_DATE]
+                                                     + pd.to_timedelta(rng.integers(5, 90, len(captures)),
+                                                                       unit='D')).values,
+            COLNAMES_CHARGEBACK['Currency']: 'EUR',
+            COLNAMES_CHARGEBACK['Amount']: captures[AMOUNT_IN_EUR].values,
+            COLNAMES_CHARGEBACK['Dispute Status']: _skewed_choice(rng, DISPUTE_STATUSES, len(captures)),
+            COLNAMES_CHARGEBACK['Case Status']: _skewed_choice(rng, CASE_STATUSES, len(captures), exponent=2),
+            COLNAMES_CHARGEBACK['Chargeback Reason']: reasons,
+            COLNAMES_CHARGEBACK['Card Brand']: captures[CARD_BRAND].values,
+            COLNAMES_CHARGEBACK['Merchant Short Name']: captures[MERCHANT_NAME].values
+        }).sort_values(COLNAMES_CHARGEBACK['Chargeback Date']).reset_index(drop=True)
+
+    @staticmethod
+    def fraud_transactions(transactions, seed=0, fraud_rate=.002):
+        """Fraud reports: TC40 for Visa, SAFE for Mastercard."""
+        rng = np.random.default_rng(seed)
+        captures = transactions[transactions[TRANSACTION_IS_CAPTURE]
+                                & transactions[CARD_BRAND].isin(['Visa', 'Master Card'])]
+        captures = captures[rng.random(len(captures)) < fraud_rate]
+        return pd.DataFrame({
+            COLNAMES_FRAUD['Transaction Date']: captures[TRANSACTION_DATE].values,
+            COLNAMES_FRAUD['Amount']: captures[AMOUNT_IN_EUR].values,
+            COLNAMES_FRAUD['Data Source']: np.where(captures[CARD_BRAND] == 'Visa', 'TC40', 'SAFE')
+        })
+
+    @staticmethod
+    def generate(n_transactions, output_folder, seed=0, **kwargs):
+        """
+        Generate and pickle all the input data sets in output_folder. kwargs are passed to transactions().
+        Returns the dict {pickle file name: data frame}.
+        """
+        logger.info('Generating {n:,} synthetic transactions in {folder}'.format(n=n_transactions,
+                                                                                 folder=output_folder))
+        transactions = SyntheticData.transactions(n_transactions, seed=seed, **kwargs)
+
+        customers, transactions = identify_customers(transactions)
+        customers = add_feature(customers, transactions[transactions[TRANSACTION_IS_CAPTURE]], Feature.ALL,
+                                end_period=transactions[TRANSACTION_DATE].max())
+
+        data = {
+            'tx.pickle': transactions,
+            'customers.pickle': customers,
+            'tx_fps.pickle': SyntheticData.fps_transactions(transactions, seed=seed),
+            'tx_chbck.pickle': SyntheticData.chargeback_transactions(transactions, seed=seed),
+            'tx_fraud.pickle': SyntheticData.fraud_transactions(transactions, seed=seed)
+        }
+        for filename, df in data.items():
+            with open(join(output_folder, filename), 'wb') as pickle_out:
+                pickle.dump(df, pickle_out, protocol=pickle.HIGHEST_PROTOCOL)
+
+        return data
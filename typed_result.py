@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+"""
+Typed columns of the plugin results.
+
+The plugin results are dicts of Python lists (per-segment averages, monthly series, per-filter RCL lists, ...): pickled
+as such, every number is boxed into a Python object on load. Before the result is written, to_typed replaces every
+long homogeneous list of numbers by a TypedColumn holding an int64 / float64 / bool NumPy array, which pickle protocol
+5 writes as a raw buffer out of the pickle stream (see ResultBus), so that a reader maps it instead of unboxing it.
+from_typed turns the columns back into the legacy lists for the existing plot() / report() code, or hands over the
+arrays themselves to the readers that want them.
+"""
+
+import numpy as np
+
+# shorter lists stay lists: their boxing costs nothing
+TYPED_MIN_LENGTH = 256
+
+_FLOAT_TYPES = {float, np.float64, np.float32}
+_INT_TYPES = {int, np.int64, np.int32}
+_BOOL_TYPES = {bool, np.bool_}
+
+
+class TypedColumn:
+    """A numeric list of a result, stored as a NumPy array."""
+
+    __slots__ = ['values']
+
+    def __init__(self, values):
+        self.values = values
+
+    def __reduce__(self):
+        return TypedColumn, (self.values,)
+
+
+def _column(values):
+    """The TypedColumn of a list of numbers of a single kind, None for any other list."""
+    if len(values) < TYPED_MIN_LENGTH:
+        return None
+    types = set(map(type, values))
+    try:
+        if types <= _FLOAT_TYPES:
+            return TypedColumn(np.array(values, dtype=np.float64))
+        if types <= _INT_TYPES:
+            return TypedColumn(np.array(values, dtype=np.int64))
+    except OverflowError:
+        return None
+    if types <= _BOOL_TYPES:
+        return TypedColumn(np.array(values, dtype=bool))
+    return None
+
+
+def _map_items(result, function):
+    """Copy of a tuple (or namedtuple) with function applied to its items."""
+    items = [function(value) for value in result]
+    return type(result)(*items) if hasattr(result, '_fields') else tuple(items)
+
+
+def _map_values(result, function):
+    """Copy of a dict (of any dict class) with function applied to its values."""
+    mapped = result.copy()
+    for key, value in result.items():
+        mapped[key] = function(value)
+    return mapped
+
+
+def to_typed(result):
+    """The result (nested dicts, lists and tuples) with its long numeric lists replaced by TypedColumn."""
+    if isinstance(result, dict):
+        return _map_values(result, to_typed)
+    if isinstance(result, list):
+        column = _column(result)
+        return column if column is not None else [to_typed(value) for value in result]
+    if isinstance(result, tuple):
+        return _map_items(result, to_typed)
+    return result
+
+
+def from_typed(result, arrays=False):
+    """The result with its TypedColumn turned back into lists (the legacy shape), or into arrays with arrays=True."""
+    if isinstance(result, TypedColumn):
+        return result.values if arrays else result.values.tolist()
+    if isinstance(result, dict):
+        return _map_values(result, lambda value: from_typed(value, arrays))
+    if isinstance(result, list):
+        return [from_typed(value, arrays) for value in result]
+    if isinstance(result, tuple):
+        return _map_items(result, lambda value: from_typed(value, arrays))
+    return result